@@ -59,7 +59,7 @@ class AssetViewSet(IDInFilterMixin, LabelFilter, BulkModelViewSet):
             self.queryset = self.queryset.filter(nodes=node).distinct()
         else:
             self.queryset = self.queryset.filter(
-                nodes__key__regex='^{}(:[0-9]+)*$'.format(node.key),
+                node.get_subtree_q(field='nodes__key')
             ).distinct()
 
     def filter_admin_user_id(self):
@@ -60,6 +60,12 @@ class NodeViewSet(viewsets.ModelViewSet):
                 )
         return super().update(request, *args, **kwargs)
 
+    def list(self, request, *args, **kwargs):
+        queryset = list(self.filter_queryset(self.get_queryset()))
+        Node.prefetch_assets_amount(queryset)
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
 
 class NodeChildrenApi(mixins.ListModelMixin, generics.CreateAPIView):
     queryset = Node.objects.all()
@@ -112,7 +118,6 @@ class NodeChildrenApi(mixins.ListModelMixin, generics.CreateAPIView):
 
         if node is None:
             node = Node.root()
-            node.assets__count = node.get_all_assets().count()
             queryset.append(node)
 
         if query_all:
@@ -132,6 +137,7 @@ class NodeChildrenApi(mixins.ListModelMixin, generics.CreateAPIView):
                 node_fake.value = asset.hostname
                 queryset.append(node_fake)
         queryset = sorted(queryset, key=lambda x: x.is_node, reverse=True)
+        Node.prefetch_assets_amount(queryset)
         return queryset
 
     def get(self, request, *args, **kwargs):
@@ -161,9 +167,10 @@ class NodeAddChildrenApi(generics.UpdateAPIView):
     def put(self, request, *args, **kwargs):
         instance = self.get_object()
         nodes_id = request.data.get("nodes")
-        children = [get_object_or_none(Node, id=pk) for pk in nodes_id]
+        children = Node.objects.filter(id__in=nodes_id or [])
         for node in children:
-            if not node:
+            # 不能移动到自身或者自己的子孙节点下
+            if node == instance or node.is_ancestor_of(instance):
                 continue
             node.parent = instance
         return Response("OK")
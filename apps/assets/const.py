@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 #
 
+# 只收集 min 和 hardware 子集, 不收集网络, 虚拟化, facter 和 ohai 等
 UPDATE_ASSETS_HARDWARE_TASKS = [
    {
        'name': "setup",
        'action': {
-           'module': 'setup'
+           'module': 'setup',
+           'args': 'gather_subset=!all,hardware gather_timeout=10',
        }
    }
 ]
@@ -32,7 +34,7 @@ TEST_SYSTEM_USER_CONN_TASKS = [
    }
 ]
 
+# forks 由 ops.concurrency.ForksLimiter 按主机数自动计算, 设置时作为上限
 TASK_OPTIONS = {
     'timeout': 10,
-    'forks': 10,
 }
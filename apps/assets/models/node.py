@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 #
 import uuid
+import copy
+import time
+import threading
+from collections import defaultdict
 
 from django.db import models, transaction
-from django.db.models import Q
+from django.db.models import Q, F, Value
+from django.db.models.functions import Concat, Substr
 from django.utils.translation import ugettext_lazy as _
 from django.core.cache import cache
 
@@ -14,6 +19,207 @@ from orgs.models import Organization
 __all__ = ['Node']
 
 
+def split_ancestor_keys(key, with_self=False):
+    _key = key.split(':')
+    if not with_self:
+        _key.pop()
+    ancestor_keys = []
+    for i in range(len(_key)):
+        ancestor_keys.append(':'.join(_key))
+        _key.pop()
+    return ancestor_keys
+
+
+class NodeTreeSnapshot:
+    """
+    组织节点树的进程内快照, 一次查询构建, 保存每个节点的字段和 full_value
+    redis 中保存每个组织的版本号, 节点变化时更新版本号, 各进程发现版本变化后重建
+    """
+    VERSION_CACHE_KEY = '_NODE_TREE_VERSION_{}'
+    VERSION_CHECK_INTERVAL = 1
+
+    _snapshots = {}
+    _lock = threading.Lock()
+
+    def __init__(self, org_id, version):
+        self.org_id = org_id
+        self.version = version
+        self.checked = time.time()
+        self.nodes = {}
+        self.full_values = {}
+
+    @classmethod
+    def get_version(cls, org_id):
+        key = cls.VERSION_CACHE_KEY.format(org_id)
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, uuid.uuid4().hex, None)
+            version = cache.get(key)
+        return version
+
+    @classmethod
+    def expire(cls, org_id):
+        cls._snapshots.pop(org_id, None)
+
+        def bump_version():
+            cache.set(cls.VERSION_CACHE_KEY.format(org_id), uuid.uuid4().hex, None)
+            cls._snapshots.pop(org_id, None)
+        # 事务提交后再更新版本号, 避免其他进程读到未提交的数据后缓存
+        transaction.on_commit(bump_version)
+
+    @classmethod
+    def get(cls, org_id):
+        snapshot = cls._snapshots.get(org_id)
+        now = time.time()
+        if snapshot and now - snapshot.checked < cls.VERSION_CHECK_INTERVAL:
+            return snapshot
+        version = cls.get_version(org_id)
+        if snapshot and snapshot.version == version:
+            snapshot.checked = now
+            return snapshot
+        with cls._lock:
+            snapshot = cls._snapshots.get(org_id)
+            if not snapshot or snapshot.version != version:
+                snapshot = cls(org_id, version)
+                snapshot.build()
+                cls._snapshots[org_id] = snapshot
+        return snapshot
+
+    def build(self):
+        # 字段数量完整时 from_db 按 concrete_fields 的顺序赋值, 查询的字段顺序需要一致
+        fields = [f.attname for f in Node._meta.concrete_fields]
+        queryset = Node._base_manager.filter(org_id=self.org_id)\
+            .values_list(*fields)
+        for values in queryset:
+            node = Node.from_db('default', fields, values)
+            self.nodes[node.key] = node
+        root = self.get_root()
+        for key in sorted(self.nodes, key=lambda k: k.count(':')):
+            node = self.nodes[key]
+            parent = self.nodes.get(node.parent_key, root)
+            if node.is_root() or parent is None:
+                self.full_values[key] = node.value
+            else:
+                self.full_values[key] = \
+                    self.full_values[parent.key] + ' / ' + node.value
+
+    def get_root(self):
+        for key, node in self.nodes.items():
+            if node.is_root():
+                return node
+        return None
+
+    def get_node(self, key):
+        # 快照在线程间共享, 返回副本避免调用方修改
+        node = self.nodes.get(key)
+        return copy.copy(node) if node is not None else None
+
+    def get_full_value(self, key):
+        return self.full_values.get(key)
+
+
+class NodeAssetsAmount:
+    """
+    节点(包含子孙节点)下去重后的资产数量, 按组织一次查询计算全部节点,
+    每个节点一个缓存 key, 资产和节点关系变化时使用 incr 增量更新,
+    无法增量更新时删除组织的版本号, 下次读取时重新计算
+    """
+    VERSION_CACHE_KEY = '_NODE_ASSETS_AMOUNT_VERSION_{}'
+    AMOUNT_CACHE_KEY = '_NODE_ASSETS_AMOUNT_{}_{}'
+    CACHE_TIMEOUT = 3600 * 24
+
+    @classmethod
+    def calculate(cls, org_id):
+        from .asset import Asset
+        nodes_key = dict(
+            Node._base_manager.filter(org_id=org_id).values_list('id', 'key')
+        )
+        subtree_assets = defaultdict(set)
+        relations = Asset.nodes.through.objects.filter(node__org_id=org_id)\
+            .values_list('node_id', 'asset_id')
+        for node_id, asset_id in relations:
+            key = nodes_key.get(node_id)
+            if key is None:
+                continue
+            for ancestor_key in split_ancestor_keys(key, with_self=True):
+                subtree_assets[ancestor_key].add(asset_id)
+        amount = {
+            key: len(subtree_assets.get(key, ()))
+            for key in nodes_key.values()
+        }
+        # 默认节点包含没有节点的资产
+        if '0' in amount:
+            amount['0'] += Asset._base_manager.filter(
+                org_id=org_id, nodes__isnull=True
+            ).count()
+        return amount
+
+    @classmethod
+    def refresh(cls, org_id):
+        amount = cls.calculate(org_id)
+        version = uuid.uuid4().hex
+        cache.set_many({
+            cls.AMOUNT_CACHE_KEY.format(version, key): value
+            for key, value in amount.items()
+        }, cls.CACHE_TIMEOUT)
+        cache.set(cls.VERSION_CACHE_KEY.format(org_id), version, cls.CACHE_TIMEOUT)
+        return amount
+
+    @classmethod
+    def get_many(cls, org_id, keys):
+        version = cache.get(cls.VERSION_CACHE_KEY.format(org_id))
+        if version:
+            cache_keys = {
+                cls.AMOUNT_CACHE_KEY.format(version, key): key for key in keys
+            }
+            cached = cache.get_many(list(cache_keys.keys()))
+            if len(cached) == len(cache_keys):
+                return {cache_keys[k]: v for k, v in cached.items()}
+        amount = cls.refresh(org_id)
+        return {key: amount.get(key, 0) for key in keys}
+
+    @classmethod
+    def expire(cls, org_id):
+        transaction.on_commit(
+            lambda: cache.delete(cls.VERSION_CACHE_KEY.format(org_id))
+        )
+
+    @classmethod
+    def incr(cls, org_id, deltas):
+        """
+        :param deltas: {node_key: delta}
+        """
+        def apply_deltas():
+            version = cache.get(cls.VERSION_CACHE_KEY.format(org_id))
+            if not version:
+                return
+            try:
+                for key, delta in deltas.items():
+                    if delta:
+                        cache.incr(cls.AMOUNT_CACHE_KEY.format(version, key), delta)
+            except ValueError:
+                cache.delete(cls.VERSION_CACHE_KEY.format(org_id))
+        transaction.on_commit(apply_deltas)
+
+    @staticmethod
+    def get_changed_deltas(changed_keys, other_keys, delta):
+        """
+        资产增加/移除了 changed_keys 节点, 资产仍然属于 other_keys 节点,
+        祖先节点的子树中已经有该资产时数量不变
+        """
+        other_ancestors = set()
+        for key in other_keys:
+            other_ancestors.update(split_ancestor_keys(key, with_self=True))
+        deltas = {}
+        for key in changed_keys:
+            for ancestor_key in split_ancestor_keys(key, with_self=True):
+                # 默认节点的数量包含没有节点的资产, 只随资产创建删除变化
+                if ancestor_key in other_ancestors or ancestor_key == '0':
+                    continue
+                deltas[ancestor_key] = delta
+        return deltas
+
+
 class Node(OrgModelMixin):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     key = models.CharField(unique=True, max_length=64, verbose_name=_("Key"))  # '1:1:1:1'
@@ -22,7 +228,7 @@ class Node(OrgModelMixin):
     date_create = models.DateTimeField(auto_now_add=True)
 
     is_node = True
-    _full_value_cache_key_prefix = '_NODE_VALUE_{}'
+    children_key_in_limit = 1000
 
     class Meta:
         verbose_name = _("Node")
@@ -33,6 +239,9 @@ class Node(OrgModelMixin):
     def __eq__(self, other):
         return self.key == other.key
 
+    def __hash__(self):
+        return hash(self.key)
+
     def __gt__(self, other):
         if self.is_root():
             return True
@@ -49,15 +258,16 @@ class Node(OrgModelMixin):
     def name(self):
         return self.value
 
+    @property
+    def tree(self):
+        return NodeTreeSnapshot.get(self.org_id)
+
     @property
     def full_value(self):
-        key = self._full_value_cache_key_prefix.format(self.key)
-        cached = cache.get(key)
-        if cached:
-            return cached
-        value = self.get_full_value()
-        self.cache_full_value(value)
-        return value
+        value = self.tree.get_full_value(self.key)
+        if value is not None:
+            return value
+        return self.get_full_value()
 
     def get_full_value(self):
         # ancestor = [a.value for a in self.get_ancestor(with_self=True)]
@@ -67,23 +277,49 @@ class Node(OrgModelMixin):
         value = parent_full_value + ' / ' + self.value
         return value
 
-    def cache_full_value(self, value):
-        key = self._full_value_cache_key_prefix.format(self.key)
-        cache.set(key, value, 3600)
-
     def expire_full_value(self):
-        key = self._full_value_cache_key_prefix.format(self.key)
-        cache.delete_pattern(key+'*')
+        """
+        节点树快照按组织缓存, 节点变化后使整个组织的快照失效
+        """
+        NodeTreeSnapshot.expire(self.org_id)
+
+    @property
+    def assets_amount(self):
+        if not self.is_node:
+            return 0
+        if not hasattr(self, '_assets_amount'):
+            self.prefetch_assets_amount([self])
+        return self._assets_amount
+
+    @classmethod
+    def prefetch_assets_amount(cls, nodes):
+        """
+        批量从缓存获取节点资产数量, 避免每个节点单独 count
+        """
+        org_nodes = defaultdict(list)
+        for node in nodes:
+            if node.is_node:
+                org_nodes[node.org_id].append(node)
+        for org_id, _nodes in org_nodes.items():
+            amount = NodeAssetsAmount.get_many(org_id, [n.key for n in _nodes])
+            for node in _nodes:
+                node._assets_amount = amount.get(node.key, 0)
+
+    def expire_assets_amount(self):
+        NodeAssetsAmount.expire(self.org_id)
 
     @property
     def level(self):
         return len(self.key.split(':'))
 
     def get_next_child_key(self):
-        mark = self.child_mark
-        self.child_mark += 1
-        self.save()
-        return "{}:{}".format(self.key, mark)
+        # 使用数据库原子自增, 实例可能来自快照, child_mark 不一定是最新的
+        with transaction.atomic():
+            queryset = self.__class__._base_manager.filter(pk=self.pk)
+            queryset.update(child_mark=F('child_mark') + 1)
+            self.child_mark = queryset.values_list('child_mark', flat=True)[0]
+        self.expire_full_value()
+        return "{}:{}".format(self.key, self.child_mark - 1)
 
     def create_child(self, value):
         with transaction.atomic():
@@ -91,24 +327,41 @@ class Node(OrgModelMixin):
             child = self.__class__.objects.create(key=child_key, value=value)
             return child
 
+    def get_subtree_q(self, field='key', with_self=True):
+        """
+        子孙节点查询条件, 使用 key 前缀匹配, 可以走 key 的唯一索引范围扫描
+        :param field: key 字段的查询路径, 如 `nodes__key`
+        """
+        q = Q(**{'{}__startswith'.format(field): '{}:'.format(self.key)})
+        if with_self:
+            q |= Q(**{field: self.key})
+        return q
+
     def get_children(self, with_self=False):
-        pattern = r'^{0}$|^{}:[0-9]+$' if with_self else r'^{}:[0-9]+$'
-        return self.__class__.objects.filter(
-            key__regex=pattern.format(self.key)
+        # 子节点 key 由 child_mark 递增生成, 数量不大时直接按 key 精确查询
+        if self.child_mark <= self.children_key_in_limit:
+            keys = ['{}:{}'.format(self.key, i) for i in range(self.child_mark)]
+            if with_self:
+                keys.append(self.key)
+            return self.__class__.objects.filter(key__in=keys)
+        children = self.__class__.objects.filter(
+            key__startswith='{}:'.format(self.key),
+            key__regex=r'^{}:[0-9]+$'.format(self.key),
         )
+        if with_self:
+            children |= self.__class__.objects.filter(key=self.key)
+        return children
 
     def get_all_children(self, with_self=False):
-        pattern = r'^{0}$|^{0}:' if with_self else r'^{0}'
         return self.__class__.objects.filter(
-            key__regex=pattern.format(self.key)
+            self.get_subtree_q(with_self=with_self)
         )
 
     def get_sibling(self, with_self=False):
-        key = ':'.join(self.key.split(':')[:-1])
-        pattern = r'^{}:[0-9]+$'.format(key)
-        sibling = self.__class__.objects.filter(
-            key__regex=pattern.format(self.key)
-        )
+        if self.is_root():
+            sibling = self.__class__.objects.filter(key=self.key)
+        else:
+            sibling = self.parent.get_children()
         if not with_self:
             sibling = sibling.exclude(key=self.key)
         return sibling
@@ -131,14 +384,10 @@ class Node(OrgModelMixin):
 
     def get_all_assets(self):
         from .asset import Asset
-        pattern = r'^{0}$|^{0}:'.format(self.key)
-        args = []
-        kwargs = {}
+        q = self.get_subtree_q(field='nodes__key')
         if self.is_default_node():
-            args.append(Q(nodes__key__regex=pattern) | Q(nodes=None))
-        else:
-            kwargs['nodes__key__regex'] = pattern
-        assets = Asset.objects.filter(*args, **kwargs)
+            q |= Q(nodes=None)
+        assets = Asset.objects.filter(q).distinct()
         return assets
 
     def get_all_valid_assets(self):
@@ -162,6 +411,9 @@ class Node(OrgModelMixin):
     def parent(self):
         if self.is_root():
             return self
+        parent = self.tree.get_node(self.parent_key)
+        if parent is not None:
+            return parent
         try:
             parent = self.__class__.objects.get(key=self.parent_key)
             return parent
@@ -173,29 +425,38 @@ class Node(OrgModelMixin):
         if not self.is_node:
             self.key = parent.key + ':fake'
             return
-        children = self.get_all_children()
         old_key = self.key
         with transaction.atomic():
             self.key = parent.get_next_child_key()
-            for child in children:
-                child.key = child.key.replace(old_key, self.key, 1)
-                child.save()
+            # 只保存被移动的节点本身, 触发一次 post_save (审计日志, 授权刷新)
             self.save()
+            # 子孙节点使用一条 UPDATE 替换 key 前缀, 不逐个触发信号
+            self.__class__.objects.filter(
+                key__startswith='{}:'.format(old_key)
+            ).update(key=Concat(
+                Value(self.key), Substr('key', len(old_key) + 1),
+                output_field=models.CharField()
+            ))
+            self.expire_full_value()
+            self.expire_assets_amount()
+
+    def is_ancestor_of(self, other):
+        return other.key.startswith('{}:'.format(self.key))
+
+    def get_ancestor_keys(self, with_self=False):
+        return split_ancestor_keys(self.key, with_self=with_self)
 
     def get_ancestor(self, with_self=False):
         if self.is_root():
             root = self.__class__.root()
             return [root]
-        _key = self.key.split(':')
-        if not with_self:
-            _key.pop()
-        ancestor_keys = []
-        for i in range(len(_key)):
-            ancestor_keys.append(':'.join(_key))
-            _key.pop()
-        ancestor = self.__class__.objects.filter(
-            key__in=ancestor_keys
-        ).order_by('key')
+        ancestor_keys = self.get_ancestor_keys(with_self=with_self)
+        tree = self.tree
+        ancestor = [tree.get_node(key) for key in reversed(ancestor_keys)]
+        if None in ancestor:
+            ancestor = self.__class__.objects.filter(
+                key__in=ancestor_keys
+            ).order_by('key')
         return ancestor
 
     @classmethod
@@ -207,7 +468,7 @@ class Node(OrgModelMixin):
                 key = '0'
             else:
                 set_current_org(Organization.root())
-                org_nodes_roots = cls.objects.filter(key__regex=r'^[0-9]+$')
+                org_nodes_roots = cls.objects.exclude(key__contains=':')
                 org_nodes_roots_keys = org_nodes_roots.values_list('key', flat=True) or [0]
                 key = max([int(k) for k in org_nodes_roots_keys]) + 1
                 set_current_org(_current_org)
@@ -216,7 +477,7 @@ class Node(OrgModelMixin):
 
     @classmethod
     def root(cls):
-        root = cls.objects.filter(key__regex=r'^[0-9]+$')
+        root = cls.objects.exclude(key__contains=':')
         if root:
             return root[0]
         else:
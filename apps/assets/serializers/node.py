@@ -68,7 +68,7 @@ class NodeSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_assets_amount(obj):
-        return obj.get_all_assets().count()
+        return obj.assets_amount
 
     @staticmethod
     def get_tree_id(obj):
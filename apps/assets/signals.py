@@ -3,3 +3,6 @@
 from django.dispatch import Signal
 
 on_app_ready = Signal()
+# 批量导入等不经过 save() 的批量创建/更新, 代替逐个资产的 post_save
+post_assets_bulk_create = Signal(providing_args=['assets'])
+post_assets_bulk_update = Signal(providing_args=['assets'])
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 #
-from collections import defaultdict
-from django.db.models.signals import post_save, m2m_changed
+from collections import defaultdict, Counter
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, \
+    m2m_changed
 from django.dispatch import receiver
 
 from common.utils import get_logger
+from orgs.counter import assets_amount_counter, assets_disabled_counter
 from .models import Asset, SystemUser, Node
+from .models.node import NodeAssetsAmount
+from .signals import post_assets_bulk_create, post_assets_bulk_update
+from .utils import HardwareFactCache
 from .tasks import update_assets_hardware_info_util, \
     test_asset_connectability_util, push_system_user_to_assets
 
@@ -36,6 +42,19 @@ def on_asset_created_or_update(sender, instance=None, created=False, **kwargs):
         test_asset_conn_on_created(instance)
 
 
+@receiver(post_assets_bulk_create, sender=Asset)
+def on_assets_bulk_created(sender, assets=None, **kwargs):
+    if not assets:
+        return
+    logger.info("{} assets bulk create signal received".format(len(assets)))
+
+    def run_tasks():
+        # 所有新建的资产合并为一个任务, 而不是每个资产一个任务
+        update_assets_hardware_info_util.delay(assets)
+        test_asset_connectability_util.delay(assets)
+    transaction.on_commit(run_tasks)
+
+
 @receiver(post_save, sender=SystemUser, dispatch_uid="my_unique_identifier")
 def on_system_user_update(sender, instance=None, created=True, **kwargs):
     if instance and not created:
@@ -88,7 +107,136 @@ def on_node_assets_changed(sender, instance=None, **kwargs):
                 system_user.assets.add(*tuple(assets))
 
 
+@receiver(m2m_changed, sender=Asset.nodes.through)
+def on_asset_nodes_changed_update_amount(sender, instance=None, **kwargs):
+    action = kwargs['action']
+    if action == 'pre_clear':
+        instance_nodes = instance.nodes.all() if isinstance(instance, Asset) else [instance]
+        for node in instance_nodes:
+            node.expire_assets_amount()
+        return
+    through = Asset.nodes.through.objects
+    if action == 'pre_remove':
+        # remove 的 pk_set 可能包含本来就没有关联的对象, 先记录真正关联的
+        if isinstance(instance, Asset):
+            related = through.filter(asset=instance, node_id__in=kwargs['pk_set'])\
+                .values_list('node_id', flat=True)
+        else:
+            related = through.filter(node=instance, asset_id__in=kwargs['pk_set'])\
+                .values_list('asset_id', flat=True)
+        instance._assets_amount_removed = set(related)
+        return
+    if action not in ('post_add', 'post_remove'):
+        return
+    delta = 1 if action == 'post_add' else -1
+    pk_set = kwargs['pk_set']
+    if action == 'post_remove':
+        pk_set = getattr(instance, '_assets_amount_removed', pk_set)
+    if not pk_set:
+        return
+    if isinstance(instance, Asset):
+        changed_keys = Node._base_manager.filter(pk__in=pk_set)\
+            .values_list('key', flat=True)
+        other_keys = through.filter(asset=instance)\
+            .exclude(node_id__in=pk_set).values_list('node__key', flat=True)
+        assets_changed = {instance.id: (changed_keys, other_keys)}
+    else:
+        assets_other_keys = defaultdict(list)
+        relations = through.filter(asset_id__in=pk_set).exclude(node=instance)\
+            .values_list('asset_id', 'node__key')
+        for asset_id, key in relations:
+            assets_other_keys[asset_id].append(key)
+        assets_changed = {
+            asset_id: ([instance.key], assets_other_keys[asset_id])
+            for asset_id in pk_set
+        }
+    deltas = defaultdict(int)
+    for changed_keys, other_keys in assets_changed.values():
+        _deltas = NodeAssetsAmount.get_changed_deltas(changed_keys, other_keys, delta)
+        for key, value in _deltas.items():
+            deltas[key] += value
+    org_id = instance.org_id
+    NodeAssetsAmount.incr(org_id, deltas)
+
+
+@receiver(post_save, sender=Asset)
+def on_asset_created_update_amount(sender, instance=None, created=False, **kwargs):
+    # 默认组织中新建的资产先计入默认节点, 见 Node.get_all_assets
+    if created and not instance.org_id:
+        NodeAssetsAmount.incr(instance.org_id, {'0': 1})
+
+
+@receiver(pre_delete, sender=Asset)
+def on_asset_delete_update_amount(sender, instance=None, **kwargs):
+    NodeAssetsAmount.expire(instance.org_id)
+
+
+@receiver(post_save, sender=Asset)
+def on_asset_created_or_update_counter(sender, instance=None, created=False, **kwargs):
+    if created:
+        assets_amount_counter.incr(instance.org_id)
+        if not instance.is_active:
+            assets_disabled_counter.incr(instance.org_id)
+    else:
+        assets_disabled_counter.expire(instance.org_id)
+
+
+@receiver(post_assets_bulk_create, sender=Asset)
+def on_assets_bulk_created_update_amount(sender, assets=None, **kwargs):
+    amount = Counter(asset.org_id for asset in assets or [])
+    disabled = Counter(asset.org_id for asset in assets or [] if not asset.is_active)
+    if amount.get(''):
+        NodeAssetsAmount.incr('', {'0': amount['']})
+    for org_id, count in amount.items():
+        assets_amount_counter.incr(org_id, count)
+    for org_id, count in disabled.items():
+        assets_disabled_counter.incr(org_id, count)
+
+
+@receiver(post_assets_bulk_update, sender=Asset)
+def on_assets_bulk_updated_counter(sender, assets=None, **kwargs):
+    for org_id in {asset.org_id for asset in assets or []}:
+        assets_disabled_counter.expire(org_id)
+
+
+@receiver(post_save, sender=Asset)
+def on_asset_saved_expire_hardware_facts(sender, instance=None, **kwargs):
+    # 资产被创建或修改后, 下次收集硬件信息时重新和数据库比较
+    HardwareFactCache.expire([instance])
+
+
+@receiver(post_delete, sender=Asset)
+def on_asset_deleted_expire_hardware_facts(sender, instance=None, **kwargs):
+    # 删除后重新添加的同名资产不沿用之前的缓存
+    HardwareFactCache.expire([instance])
+
+
+@receiver(post_assets_bulk_create, sender=Asset)
+def on_assets_bulk_created_expire_hardware_facts(sender, assets=None, **kwargs):
+    if assets:
+        HardwareFactCache.expire(assets)
+
+
+@receiver(post_assets_bulk_update, sender=Asset)
+def on_assets_bulk_updated_expire_hardware_facts(sender, assets=None, **kwargs):
+    if assets:
+        HardwareFactCache.expire(assets)
+
+
+@receiver(post_delete, sender=Asset)
+def on_asset_deleted_counter(sender, instance=None, **kwargs):
+    assets_amount_counter.incr(instance.org_id, -1)
+    assets_disabled_counter.expire(instance.org_id)
+
+
 @receiver(post_save, sender=Node)
 def on_node_update_or_created(sender, instance=None, created=False, **kwargs):
-    if instance and not created:
+    if instance:
+        instance.expire_full_value()
+
+
+@receiver(post_delete, sender=Node)
+def on_node_deleted(sender, instance=None, **kwargs):
+    if instance:
         instance.expire_full_value()
+        instance.expire_assets_amount()
@@ -1,19 +1,17 @@
 # ~*~ coding: utf-8 ~*~
-import json
-import re
 import os
 
 from celery import shared_task
 from django.core.cache import cache
 from django.utils.translation import ugettext as _
 
-from common.utils import get_object_or_none, capacity_convert, \
-    sum_capacity, encrypt_password, get_logger
+from common.utils import get_object_or_none, encrypt_password, get_logger
 from ops.celery.utils import register_as_period_task, after_app_shutdown_clean, \
     after_app_ready_start
 from ops.celery import app as celery_app
 
 from .models import SystemUser, AdminUser, Asset
+from .utils import HardwareFactCache
 from . import const
 
 
@@ -21,7 +19,6 @@ FORKS = 10
 TIMEOUT = 60
 logger = get_logger(__file__)
 CACHE_MAX_TIME = 60*60*60
-disk_pattern = re.compile(r'^hd|sd|xvd|vd')
 PERIOD_TASK = os.environ.get("PERIOD_TASK", "off")
 
 
@@ -33,53 +30,37 @@ def set_assets_hardware_info(result, **kwargs):
     @shared_task must be exit, because we using it as a task callback, is must
     be a celery task also
     :param result:
-    :param kwargs: {task_name: ""}
+    :param kwargs: {task_name: "", history_id: ""}
     :return:
     """
-    result_raw = result[0]
+    history_id = kwargs.get('history_id')
+    if history_id:
+        # 主机结果已经写入执行记录, 分批读取, 不一次加载所有主机的 facts
+        from ops.results import iter_host_results
+        results = (
+            (r.hostname, r.result)
+            for r in iter_host_results(history_id, status='ok', task_name='setup')
+        )
+    else:
+        results = (
+            (hostname, info.get('setup', {}))
+            for hostname, info in result[0].get('ok', {}).items()
+        )
+
     assets_updated = []
-    for hostname, info in result_raw.get('ok', {}).items():
-        info = info.get('setup', {}).get('ansible_facts', {})
+    hosts_facts = {}
+    for hostname, info in results:
+        info = info.get('ansible_facts', {})
         if not info:
             logger.error("Get asset info failed: {}".format(hostname))
             continue
-
-        asset = Asset.objects.get_object_by_fullname(hostname)
-        if not asset:
-            continue
-
-        ___vendor = info.get('ansible_system_vendor', 'Unknown')
-        ___model = info.get('ansible_product_name', 'Unknown')
-        ___sn = info.get('ansible_product_serial', 'Unknown')
-
-        for ___cpu_model in info.get('ansible_processor', []):
-            if ___cpu_model.endswith('GHz') or ___cpu_model.startswith("Intel"):
-                break
-        else:
-            ___cpu_model = 'Unknown'
-        ___cpu_model = ___cpu_model[:64]
-        ___cpu_count = info.get('ansible_processor_count', 0)
-        ___cpu_cores = info.get('ansible_processor_cores', None) or len(info.get('ansible_processor', []))
-        ___cpu_vcpus = info.get('ansible_processor_vcpus', 0)
-        ___memory = '%s %s' % capacity_convert('{} MB'.format(info.get('ansible_memtotal_mb')))
-        disk_info = {}
-        for dev, dev_info in info.get('ansible_devices', {}).items():
-            if disk_pattern.match(dev) and dev_info['removable'] == '0':
-                disk_info[dev] = dev_info['size']
-        ___disk_total = '%s %s' % sum_capacity(disk_info.values())
-        ___disk_info = json.dumps(disk_info)
-
-        ___platform = info.get('ansible_system', 'Unknown')
-        ___os = info.get('ansible_distribution', 'Unknown')
-        ___os_version = info.get('ansible_distribution_version', 'Unknown')
-        ___os_arch = info.get('ansible_architecture', 'Unknown')
-        ___hostname_raw = info.get('ansible_hostname', 'Unknown')
-
-        for k, v in locals().items():
-            if k.startswith('___'):
-                setattr(asset, k.strip('_'), v)
-        asset.save()
-        assets_updated.append(asset)
+        hosts_facts[hostname] = info
+        if len(hosts_facts) >= HardwareFactCache.chunk_size:
+            assets_updated.extend(HardwareFactCache(hosts_facts).run())
+            hosts_facts = {}
+    # 只写入硬件信息有变化的资产
+    if hosts_facts:
+        assets_updated.extend(HardwareFactCache(hosts_facts).run())
     return assets_updated
 
 
@@ -92,6 +73,7 @@ def update_assets_hardware_info_util(assets, task_name=None):
     :return: result summary ['contacted': {}, 'dark': {}]
     """
     from ops.utils import update_or_create_ansible_task
+    from ops.models import AdHocRunHistory
     if task_name is None:
         task_name = _("Update some assets hardware info")
         # task_name = _("更新资产硬件信息")
@@ -104,10 +86,11 @@ def update_assets_hardware_info_util(assets, task_name=None):
         task_name, hosts=hostname_list, tasks=tasks, pattern='all',
         options=const.TASK_OPTIONS, run_as_admin=True, created_by='System',
     )
-    result = task.run()
+    history_id = AdHocRunHistory.get_current_id()
+    result = task.run(history_id=history_id)
     # Todo: may be somewhere using
     # Manual run callback function
-    set_assets_hardware_info(result)
+    set_assets_hardware_info(result, history_id=history_id)
     return result
 
 
@@ -1,3 +1,49 @@
 from django.test import TestCase
 
-# Create your tests here.
+from orgs.models import Organization
+from orgs.utils import set_current_org
+from .models import Node
+from .models.node import NodeTreeSnapshot
+
+
+class NodeTreeSnapshotTestCase(TestCase):
+    def setUp(self):
+        set_current_org(Organization.default())
+        self.root = Node.root()
+        self.child = self.root.create_child('child')
+        # value 和其他节点的 key 相同, 快照字段错位时会找到错误的节点
+        self.grandchild = self.child.create_child(self.child.key)
+        NodeTreeSnapshot.expire(self.root.org_id)
+
+    def get_db_full_value(self, node):
+        ancestors = Node.objects.filter(
+            key__in=node.get_ancestor_keys(with_self=True)
+        )
+        ancestors = sorted(ancestors, key=lambda n: n.key.count(':'))
+        return ' / '.join(n.value for n in ancestors)
+
+    def test_snapshot_nodes_match_db(self):
+        tree = NodeTreeSnapshot.get(self.root.org_id)
+        for node in Node.objects.all():
+            cached = tree.get_node(node.key)
+            self.assertIsNotNone(cached)
+            for field in ('id', 'key', 'value', 'child_mark', 'org_id'):
+                self.assertEqual(getattr(cached, field), getattr(node, field))
+
+    def test_full_value_and_parent_match_db(self):
+        tree = NodeTreeSnapshot.get(self.root.org_id)
+        for node in (self.child, self.grandchild):
+            self.assertEqual(tree.get_full_value(node.key), self.get_db_full_value(node))
+            self.assertEqual(node.full_value, self.get_db_full_value(node))
+            db_parent = Node.objects.get(key=node.parent_key)
+            self.assertEqual(node.parent.id, db_parent.id)
+            self.assertEqual(node.parent.value, db_parent.value)
+
+    def test_ancestor_match_db(self):
+        ancestor = self.grandchild.get_ancestor(with_self=True)
+        db_ancestor = Node.objects.filter(
+            key__in=self.grandchild.get_ancestor_keys(with_self=True)
+        )
+        self.assertEqual(
+            sorted(n.id for n in ancestor), sorted(n.id for n in db_ancestor)
+        )
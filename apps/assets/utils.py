@@ -1,11 +1,24 @@
 # ~*~ coding: utf-8 ~*~
 #
 import os
+import re
+import json
+import hashlib
 import paramiko
 from paramiko.ssh_exception import SSHException
 
-from common.utils import get_object_or_none
-from .models import Asset, SystemUser, Label
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils.translation import ugettext as _
+
+from common.utils import get_object_or_none, get_logger, is_uuid, \
+    bulk_update_fields, capacity_convert, sum_capacity
+from orgs.utils import current_org
+from .models import Asset, SystemUser, Label, AdminUser, Domain
+from .signals import post_assets_bulk_create, post_assets_bulk_update
+
+logger = get_logger(__file__)
+disk_pattern = re.compile(r'^hd|sd|xvd|vd')
 
 
 def get_assets_by_id_list(id_list):
@@ -81,3 +94,298 @@ def test_gateway_connectability(gateway):
     finally:
         client.close()
     return True, None
+
+
+class AssetBulkImporter:
+    """
+    批量导入资产
+
+    管理用户, 网域和已存在的资产都预先批量查询, 新建的资产分批 bulk_create,
+    更新的资产分批用一条 UPDATE 更新, 不逐个触发 post_save;
+    完成后发送批量信号, 所有新建的资产只执行一次获取硬件信息和测试可连接性的任务
+    """
+    chunk_size = 1000
+    int_fields = ('port', 'cpu_count', 'cpu_cores')
+    related_fields = {'admin_user': AdminUser, 'domain': Domain}
+
+    def __init__(self, attrs, rows, node=None):
+        """
+        :param attrs: 每列对应的字段名
+        :param rows: csv 数据, 不包含表头
+        """
+        self.attrs = attrs
+        self.rows = rows
+        self.node = node
+        self.created, self.updated, self.failed = [], [], []
+
+    def chunks(self, seq):
+        seq = list(seq)
+        for i in range(0, len(seq), self.chunk_size):
+            yield seq[i:i + self.chunk_size]
+
+    def parse_row(self, row):
+        asset_dict = dict()
+        for k, v in zip(self.attrs, row):
+            v = v.strip()
+            if k == 'is_active':
+                v = False if v in ['False', 0, 'false'] else True
+            elif k in self.int_fields:
+                try:
+                    v = int(v)
+                except ValueError:
+                    v = ''
+            elif k in self.related_fields:
+                # 找不到时为 None, 和逐个导入时一致
+                asset_dict[k] = v
+                continue
+            if v != '':
+                asset_dict[k] = v
+        return asset_dict
+
+    def resolve_related(self, assets_dict):
+        for field, model in self.related_fields.items():
+            names = {d[field] for d in assets_dict if d.get(field)}
+            objects = {}
+            for chunk in self.chunks(names):
+                objects.update({o.name: o for o in model.objects.filter(name__in=chunk)})
+            for d in assets_dict:
+                if field in d:
+                    d[field] = objects.get(d[field])
+
+    def get_exist_assets(self, assets_id):
+        assets_id = [i for i in assets_id if is_uuid(i)]
+        assets = {}
+        for chunk in self.chunks(assets_id):
+            assets.update({str(a.id): a for a in Asset.objects.filter(id__in=chunk)})
+        return assets
+
+    def get_exist_hostnames(self, hostnames):
+        exists = set()
+        for chunk in self.chunks(hostnames):
+            exists.update(
+                Asset.objects.filter(hostname__in=chunk).values_list('hostname', flat=True)
+            )
+        return exists
+
+    def _bulk_create(self, assets):
+        with transaction.atomic():
+            Asset.objects.bulk_create(assets)
+            if self.node:
+                self.node.assets.add(*assets)
+
+    def create_assets(self, assets):
+        created = []
+        for chunk in self.chunks(assets):
+            try:
+                self._bulk_create(chunk)
+                created.extend(chunk)
+                continue
+            except Exception as e:
+                logger.debug("Bulk create assets error, retry one by one: {}".format(e))
+            # 逐个创建, 找出出错的资产
+            for asset in chunk:
+                try:
+                    self._bulk_create([asset])
+                    created.append(asset)
+                except Exception as e:
+                    self.failed.append('%s: %s' % (asset.hostname, str(e)))
+        self.created.extend(asset.hostname for asset in created)
+        return created
+
+    def update_assets(self, changes):
+        """
+        :param changes: [(asset, {field: value}), ...]
+        """
+        updated = []
+        for chunk in self.chunks(changes):
+            try:
+                with transaction.atomic():
+                    bulk_update_fields(
+                        Asset.objects.all(),
+                        {asset.id: values for asset, values in chunk if values}
+                    )
+                updated.extend(asset for asset, values in chunk)
+                continue
+            except Exception as e:
+                logger.debug("Bulk update assets error, retry one by one: {}".format(e))
+            for asset, values in chunk:
+                try:
+                    with transaction.atomic():
+                        bulk_update_fields(Asset.objects.all(), {asset.id: values})
+                    updated.append(asset)
+                except Exception as e:
+                    self.failed.append('%s: %s' % (asset.hostname, str(e)))
+        self.updated.extend(asset.hostname for asset in updated)
+        return updated
+
+    @staticmethod
+    def get_changes(asset, asset_dict):
+        changes = {}
+        for k, v in asset_dict.items():
+            # 和 save() 一致, 组织由当前组织决定
+            if k == 'org_id':
+                continue
+            field = Asset._meta.get_field(k)
+            old = getattr(asset, field.attname)
+            new = v.pk if isinstance(v, models.Model) else v
+            if old != new:
+                changes[k] = v
+                setattr(asset, k, v)
+        return changes
+
+    def run(self):
+        assets_dict = [
+            self.parse_row(row) for row in self.rows if set(row) != {''}
+        ]
+        self.resolve_related(assets_dict)
+        exist_assets = self.get_exist_assets(
+            [d['id'] for d in assets_dict if d.get('id')]
+        )
+        exist_hostnames = self.get_exist_hostnames(
+            [d['hostname'] for d in assets_dict if d.get('hostname')]
+        )
+
+        to_create, to_update = [], []
+        for asset_dict in assets_dict:
+            asset = exist_assets.get(asset_dict.pop('id', None))
+            if asset:
+                to_update.append((asset, self.get_changes(asset, asset_dict)))
+                continue
+            hostname = asset_dict.get('hostname')
+            if not hostname:
+                self.failed.append('%s: %s' % ('', _('This field is required.')))
+                continue
+            if hostname in exist_hostnames:
+                self.failed.append('%s: %s' % (hostname, _('already exists')))
+                continue
+            exist_hostnames.add(hostname)
+            asset = Asset(**asset_dict)
+            if current_org and current_org.is_real():
+                asset.org_id = current_org.id
+            to_create.append(asset)
+
+        created = self.create_assets(to_create)
+        updated = self.update_assets(to_update)
+        post_assets_bulk_create.send(sender=Asset, assets=created)
+        post_assets_bulk_update.send(sender=Asset, assets=updated)
+        return self.created, self.updated, self.failed
+
+
+def parse_hardware_facts(facts):
+    """
+    从 setup 模块收集的 facts 中解析资产的硬件信息
+    :return: {field: value}
+    """
+    for cpu_model in facts.get('ansible_processor', []):
+        if cpu_model.endswith('GHz') or cpu_model.startswith("Intel"):
+            break
+    else:
+        cpu_model = 'Unknown'
+    disk_info = {}
+    for dev, dev_info in facts.get('ansible_devices', {}).items():
+        if disk_pattern.match(dev) and dev_info['removable'] == '0':
+            disk_info[dev] = dev_info['size']
+    memory = '{} MB'.format(facts.get('ansible_memtotal_mb'))
+
+    return {
+        'vendor': facts.get('ansible_system_vendor', 'Unknown'),
+        'model': facts.get('ansible_product_name', 'Unknown'),
+        'sn': facts.get('ansible_product_serial', 'Unknown'),
+        'cpu_model': cpu_model[:64],
+        'cpu_count': facts.get('ansible_processor_count', 0),
+        'cpu_cores': facts.get('ansible_processor_cores', None) or
+                     len(facts.get('ansible_processor', [])),
+        'cpu_vcpus': facts.get('ansible_processor_vcpus', 0),
+        'memory': '%s %s' % capacity_convert(memory),
+        'disk_total': '%s %s' % sum_capacity(disk_info.values()),
+        'disk_info': json.dumps(disk_info),
+        'platform': facts.get('ansible_system', 'Unknown'),
+        'os': facts.get('ansible_distribution', 'Unknown'),
+        'os_version': facts.get('ansible_distribution_version', 'Unknown'),
+        'os_arch': facts.get('ansible_architecture', 'Unknown'),
+        'hostname_raw': facts.get('ansible_hostname', 'Unknown'),
+    }
+
+
+class HardwareFactCache:
+    """
+    缓存每台资产上次收集到的硬件信息和它的 hash, key 为资产的 fullname,
+    hash 没有变化的资产不再查询数据库, 变化的资产只更新变化的字段
+
+    资产在页面或导入时修改后删除缓存, 下次收集时重新和数据库比较
+    """
+    CACHE_KEY = '_ASSET_HARDWARE_FACTS_{}'
+    CACHE_TIMEOUT = 3600 * 24 * 7
+    chunk_size = 1000
+
+    def __init__(self, hosts_facts):
+        """
+        :param hosts_facts: {fullname: setup 收集的 ansible_facts}
+        """
+        self.hosts_info = {}
+        for fullname, facts in hosts_facts.items():
+            self.hosts_info[fullname] = parse_hardware_facts(facts)
+
+    @classmethod
+    def get_key(cls, fullname):
+        return cls.CACHE_KEY.format(fullname)
+
+    @staticmethod
+    def get_hash(info):
+        value = json.dumps(info, sort_keys=True)
+        return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def expire(cls, assets):
+        cache.delete_many([cls.get_key(asset.fullname) for asset in assets])
+
+    def chunks(self, seq):
+        seq = list(seq)
+        for i in range(0, len(seq), self.chunk_size):
+            yield seq[i:i + self.chunk_size]
+
+    def get_changed_hosts(self):
+        keys = {self.get_key(fullname): fullname for fullname in self.hosts_info}
+        cached = cache.get_many(list(keys))
+        changed = []
+        for key, fullname in keys.items():
+            value = cached.get(key) or {}
+            if value.get('hash') != self.get_hash(self.hosts_info[fullname]):
+                changed.append(fullname)
+        return changed
+
+    def update_assets(self, fullname_list):
+        """
+        只查询需要的字段, 比较后用一条 UPDATE 写入变化的字段
+        """
+        fields = list(next(iter(self.hosts_info.values()), {}))
+        updated = []
+        for chunk in self.chunks(fullname_list):
+            assets = Asset.get_queryset_by_fullname_list(chunk)\
+                .only('id', 'hostname', 'org_id', *fields)
+            changes = {}
+            for asset in assets:
+                info = self.hosts_info.get(asset.fullname)
+                if info is None:
+                    continue
+                changed = {k: v for k, v in info.items() if getattr(asset, k) != v}
+                if changed:
+                    changes[asset.id] = changed
+                    updated.append(asset)
+            bulk_update_fields(Asset._base_manager.all(), changes)
+        return updated
+
+    def run(self):
+        changed = self.get_changed_hosts()
+        updated = self.update_assets(changed)
+        cache.set_many({
+            self.get_key(fullname): {
+                'hash': self.get_hash(self.hosts_info[fullname]),
+                'info': self.hosts_info[fullname],
+            }
+            for fullname in changed
+        }, self.CACHE_TIMEOUT)
+        logger.debug("Hardware info: {} hosts, {} changed, {} assets updated".format(
+            len(self.hosts_info), len(changed), len(updated)
+        ))
+        return updated
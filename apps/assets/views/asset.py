@@ -8,7 +8,6 @@ import codecs
 import chardet
 from io import StringIO
 
-from django.db import transaction
 from django.contrib import messages
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import TemplateView, ListView, View
@@ -19,17 +18,18 @@ from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.core.cache import cache
-from django.utils import timezone
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.shortcuts import redirect
 from django.contrib.messages.views import SuccessMessageMixin
 
 from common.mixins import JSONResponseMixin
+from common.export import CSVExporter
 from common.utils import get_object_or_none, get_logger
 from common.permissions import AdminUserRequiredMixin
 from common.const import create_success_msg, update_success_msg
 from orgs.utils import current_org
 from .. import forms
+from ..utils import AssetBulkImporter
 from ..models import Asset, AdminUser, SystemUser, Label, Node, Domain
 
 
@@ -182,34 +182,45 @@ class AssetDetailView(LoginRequiredMixin, DetailView):
         return super().get_context_data(**kwargs)
 
 
-@method_decorator(csrf_exempt, name='dispatch')
-class AssetExportView(LoginRequiredMixin, View):
-    def get(self, request):
-        spm = request.GET.get('spm', '')
-        assets_id_default = [Asset.objects.first().id] if Asset.objects.first() else []
-        assets_id = cache.get(spm, assets_id_default)
-        fields = [
+class AssetExporter(CSVExporter):
+    filename_prefix = 'assets'
+    select_related = ('domain', 'admin_user')
+
+    def __init__(self, params=None):
+        super().__init__(params)
+        self.fields = [
             field for field in Asset._meta.fields
             if field.name not in [
                 'date_created', 'org_id'
             ]
         ]
-        filename = 'assets-{}.csv'.format(
-            timezone.localtime(timezone.now()).strftime('%Y-%m-%d_%H-%M-%S')
-        )
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-        response.write(codecs.BOM_UTF8)
-        assets = Asset.objects.filter(id__in=assets_id)
-        writer = csv.writer(response, dialect='excel', quoting=csv.QUOTE_MINIMAL)
-
-        header = [field.verbose_name for field in fields]
-        writer.writerow(header)
-
-        for asset in assets:
-            data = [getattr(asset, field.name) for field in fields]
-            writer.writerow(data)
-        return response
+
+    def get_queryset(self):
+        assets_id = self.params.get('assets_id')
+        node_id = self.params.get('node_id')
+        if assets_id:
+            return Asset.objects.filter(id__in=assets_id)
+        if node_id is not None:
+            node = get_object_or_none(Node, id=node_id) if node_id else Node.root()
+            return node.get_all_assets() if node else Asset.objects.none()
+        return Asset.objects.none()
+
+    def get_header(self):
+        return [field.verbose_name for field in self.fields]
+
+    def get_row(self, asset):
+        return [getattr(asset, field.name) for field in self.fields]
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AssetExportView(LoginRequiredMixin, View):
+    def get(self, request):
+        spm = request.GET.get('spm', '')
+        params = cache.get(spm)
+        if params is None:
+            asset = Asset.objects.first()
+            params = {'assets_id': [str(asset.id)] if asset else []}
+        return AssetExporter(params).get_response(request)
 
     def post(self, request, *args, **kwargs):
         try:
@@ -218,14 +229,13 @@ class AssetExportView(LoginRequiredMixin, View):
         except ValueError:
             return HttpResponse('Json object not valid', status=400)
 
-        if not assets_id:
-            node = get_object_or_none(Node, id=node_id) if node_id else Node.root()
-            assets = node.get_all_assets()
-            for asset in assets:
-                assets_id.append(asset.id)
-
+        # 没有选择资产时只保存节点, 导出时再查询节点下的资产
+        if assets_id:
+            params = {'assets_id': assets_id}
+        else:
+            params = {'node_id': node_id or ''}
         spm = uuid.uuid4().hex
-        cache.set(spm, assets_id, 300)
+        cache.set(spm, params, 300)
         url = reverse_lazy('assets:asset-export') + '?spm=%s' % spm
         return JsonResponse({'redirect': url})
 
@@ -259,56 +269,8 @@ class BulkImportAssetView(AdminUserRequiredMixin, JSONResponseMixin, FormView):
                            'template or export file'}
             return self.render_json_response(data)
 
-        created, updated, failed = [], [], []
-        assets = []
-        for row in csv_data[1:]:
-            if set(row) == {''}:
-                continue
-
-            asset_dict_raw = dict(zip(attr, row))
-            asset_dict = dict()
-            for k, v in asset_dict_raw.items():
-                v = v.strip()
-                if k == 'is_active':
-                    v = False if v in ['False', 0, 'false'] else True
-                elif k == 'admin_user':
-                    v = get_object_or_none(AdminUser, name=v)
-                elif k in ['port', 'cpu_count', 'cpu_cores']:
-                    try:
-                        v = int(v)
-                    except ValueError:
-                        v = ''
-                elif k == 'domain':
-                    v = get_object_or_none(Domain, name=v)
-
-                if v != '':
-                    asset_dict[k] = v
-
-            asset = None
-            asset_id = asset_dict.pop('id', None)
-            if asset_id:
-                asset = get_object_or_none(Asset, id=asset_id)
-            if not asset:
-                try:
-                    if len(Asset.objects.filter(hostname=asset_dict.get('hostname'))):
-                        raise Exception(_('already exists'))
-                    with transaction.atomic():
-                        asset = Asset.objects.create(**asset_dict)
-                        if node:
-                            asset.nodes.set([node])
-                        created.append(asset_dict['hostname'])
-                        assets.append(asset)
-                except Exception as e:
-                    failed.append('%s: %s' % (asset_dict['hostname'], str(e)))
-            else:
-                for k, v in asset_dict.items():
-                    if v != '':
-                        setattr(asset, k, v)
-                try:
-                    asset.save()
-                    updated.append(asset_dict['hostname'])
-                except Exception as e:
-                    failed.append('%s: %s' % (asset_dict['hostname'], str(e)))
+        importer = AssetBulkImporter(attr, csv_data[1:], node=node)
+        created, updated, failed = importer.run()
 
         data = {
             'created': created,
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import csv
+import gzip
+import uuid
+import codecs
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import StreamingHttpResponse, JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+
+from .utils import get_logger
+
+logger = get_logger(__file__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Echo:
+    """
+    csv.writer 写入时直接返回写入的内容, 用于逐行生成 CSV
+    """
+    def write(self, value):
+        return value
+
+
+class CSVExporter:
+    """
+    流式导出 CSV, 分批查询数据, 不把全部数据放到内存中
+
+    子类实现 get_queryset, get_header 和 get_row, 可以在请求中直接流式返回,
+    也可以在后台任务中写入 gzip 文件, 完成后再下载 (见 ExportFile)
+    后台任务中通过 params 重新构造导出器, 所以 params 需要可以序列化
+    """
+    filename_prefix = 'export'
+    chunk_size = 2000
+    select_related = ()
+    prefetch_related = ()
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def get_header(self):
+        raise NotImplementedError
+
+    def get_row(self, obj):
+        raise NotImplementedError
+
+    def iter_objects(self):
+        queryset = self.get_queryset()
+        if not hasattr(queryset, 'iterator'):
+            yield from queryset
+            return
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if not self.prefetch_related:
+            yield from queryset.iterator(chunk_size=self.chunk_size)
+            return
+
+        # iterator() 不支持 prefetch_related, 按主键分批查询
+        queryset = queryset.prefetch_related(*self.prefetch_related).order_by('pk')
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            chunk = list(chunk[:self.chunk_size])
+            yield from chunk
+            if len(chunk) < self.chunk_size:
+                break
+            last_pk = chunk[-1].pk
+
+    def iter_lines(self):
+        writer = csv.writer(Echo(), dialect='excel', quoting=csv.QUOTE_MINIMAL)
+        yield codecs.BOM_UTF8.decode()
+        yield writer.writerow(self.get_header())
+        for obj in self.iter_objects():
+            yield writer.writerow(self.get_row(obj))
+
+    def iter_content(self):
+        """
+        多行合并后返回, 减少写入次数
+        """
+        buffer, size = [], 0
+        for line in self.iter_lines():
+            buffer.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer)
+
+    def get_filename(self, ext='csv'):
+        return '{}-{}.{}'.format(
+            self.filename_prefix,
+            timezone.localtime(timezone.now()).strftime('%Y-%m-%d_%H-%M-%S'),
+            ext
+        )
+
+    def as_response(self):
+        response = StreamingHttpResponse(self.iter_content(), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="%s"' % self.get_filename()
+        return response
+
+    def write_gzip(self, path):
+        with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+            for content in self.iter_content():
+                f.write(content)
+
+    def get_response(self, request):
+        """
+        请求中带 background 参数时在后台导出, 返回下载地址
+        """
+        if not request.GET.get('background'):
+            return self.as_response()
+        export_file = ExportFile.start(self, request.user)
+        return JsonResponse({'id': export_file.id, 'url': export_file.url})
+
+
+class ExportFile:
+    """
+    后台导出的 gzip 文件, 保存在 MEDIA_ROOT/exports 目录,
+    状态保存在 cache 中, 只有发起导出的用户可以下载
+    """
+    EXPORT_DIR = 'exports'
+    CACHE_KEY = '_EXPORT_FILE_{}'
+    TIMEOUT = 3600 * 24
+
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCESS = 'success'
+    STATUS_FAILED = 'failed'
+
+    def __init__(self, export_id):
+        self.id = export_id
+        self.key = self.CACHE_KEY.format(export_id)
+
+    @classmethod
+    def get_base_dir(cls):
+        return os.path.join(default_storage.base_location, cls.EXPORT_DIR)
+
+    @property
+    def path(self):
+        return os.path.join(self.get_base_dir(), '{}.csv.gz'.format(self.id))
+
+    @property
+    def url(self):
+        return reverse('common:export-download', kwargs={'pk': self.id})
+
+    def get_info(self):
+        return cache.get(self.key)
+
+    def set_status(self, status, **kwargs):
+        info = self.get_info() or {}
+        info.update(status=status, **kwargs)
+        cache.set(self.key, info, self.TIMEOUT)
+
+    @classmethod
+    def start(cls, exporter, user):
+        from orgs.utils import current_org
+        from .tasks import export_csv_file
+
+        export_file = cls(uuid.uuid4().hex)
+        cache.set(export_file.key, {
+            'status': cls.STATUS_RUNNING,
+            'user': str(user.id),
+            'filename': exporter.get_filename('csv.gz'),
+        }, cls.TIMEOUT)
+        exporter_path = '{}.{}'.format(
+            exporter.__class__.__module__, exporter.__class__.__qualname__
+        )
+        org_id = current_org.id if current_org else ''
+        transaction.on_commit(lambda: export_csv_file.delay(
+            exporter_path, exporter.params, org_id, export_file.id
+        ))
+        return export_file
+
+    def write(self, exporter):
+        os.makedirs(self.get_base_dir(), exist_ok=True)
+        part_path = self.path + '.part'
+        try:
+            exporter.write_gzip(part_path)
+            os.replace(part_path, self.path)
+        except Exception as e:
+            logger.error("Export file {} error: {}".format(self.id, e))
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            self.set_status(self.STATUS_FAILED, msg=str(e))
+            return
+        self.set_status(self.STATUS_SUCCESS)
+
+    @classmethod
+    def clean_expired(cls):
+        base_dir = cls.get_base_dir()
+        if not os.path.isdir(base_dir):
+            return
+        expired = timezone.now().timestamp() - cls.TIMEOUT
+        for name in os.listdir(base_dir):
+            path = os.path.join(base_dir, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                continue
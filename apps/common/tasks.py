@@ -1,8 +1,13 @@
 from django.core.mail import send_mail
 from django.conf import settings
+from django.utils.module_loading import import_string
 from celery import shared_task
+
+from ops.celery.utils import register_as_period_task, after_app_ready_start, \
+    after_app_shutdown_clean
 from .utils import get_logger
 from .models import Setting
+from .export import ExportFile
 
 
 logger = get_logger(__file__)
@@ -36,3 +41,25 @@ def send_mail_async(*args, **kwargs):
         send_mail(*args, **kwargs)
     except Exception as e:
         logger.error("Sending mail error: {}".format(e))
+
+
+@shared_task
+def export_csv_file(exporter_path, params, org_id, export_id):
+    """
+    后台导出 CSV 到 gzip 文件
+    :param exporter_path: CSVExporter 子类的路径
+    """
+    from orgs.models import Organization
+    from orgs.utils import set_current_org
+
+    set_current_org(Organization.get_instance(org_id))
+    exporter = import_string(exporter_path)(params)
+    ExportFile(export_id).write(exporter)
+
+
+@shared_task
+@register_as_period_task(interval=3600)
+@after_app_ready_start
+@after_app_shutdown_clean
+def clean_expired_export_files():
+    ExportFile.clean_expired()
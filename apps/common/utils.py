@@ -420,6 +420,49 @@ def with_cache(func):
     return wrapper
 
 
+def bulk_update_fields(queryset, changes):
+    """
+    一条 UPDATE 更新多个对象的不同字段, Django 2.2 之前没有 bulk_update
+    :param queryset: 更新的范围, 如 Model._base_manager.all()
+    :param changes: {pk: {field: value, ...}, ...}, 外键的值可以是对象或主键
+    """
+    from django.db import models
+    from django.db.models import Case, When, Value, F
+
+    if not changes:
+        return 0
+    model = queryset.model
+    fields = {field for values in changes.values() for field in values}
+    updates = {}
+    for field_name in fields:
+        field = model._meta.get_field(field_name)
+        whens = []
+        for pk, values in changes.items():
+            if field_name not in values:
+                continue
+            value = values[field_name]
+            if isinstance(value, models.Model):
+                value = value.pk
+            whens.append(When(pk=pk, then=Value(value, output_field=field)))
+        updates[field_name] = Case(*whens, default=F(field_name), output_field=field)
+    return queryset.filter(pk__in=list(changes)).update(**updates)
+
+
+_redis_client = None
+
+
+def get_redis_client():
+    """
+    使用 cache 的 redis 配置创建客户端, 连接池在进程内共享
+    """
+    global _redis_client
+    if _redis_client is None:
+        import redis
+        location = settings.CACHES['default']['LOCATION']
+        _redis_client = redis.StrictRedis.from_url(location)
+    return _redis_client
+
+
 class LocalProxy(object):
 
     """
@@ -1,5 +1,9 @@
-from django.views.generic import TemplateView
+import os
+
+from django.views.generic import TemplateView, View
 from django.shortcuts import render, redirect
+from django.http import FileResponse, JsonResponse, Http404
+from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib import messages
 from django.utils.translation import ugettext as _
 from django.conf import settings
@@ -8,6 +12,7 @@ from .forms import EmailSettingForm, LDAPSettingForm, BasicSettingForm, \
     TerminalSettingForm, SecuritySettingForm
 from common.permissions import SuperUserRequiredMixin
 from .signals import ldap_auth_enable
+from .export import ExportFile
 
 
 class BasicSettingView(SuperUserRequiredMixin, TemplateView):
@@ -144,3 +149,23 @@ class SecuritySettingView(SuperUserRequiredMixin, TemplateView):
             context = self.get_context_data()
             context.update({"form": form})
             return render(request, self.template_name, context)
+
+
+class ExportFileDownloadView(LoginRequiredMixin, View):
+    """
+    下载后台导出的文件, 未完成时返回导出状态
+    """
+    def get(self, request, *args, **kwargs):
+        export_file = ExportFile(kwargs.get('pk'))
+        info = export_file.get_info()
+        if not info or info.get('user') != str(request.user.id):
+            raise Http404
+        if info['status'] != ExportFile.STATUS_SUCCESS:
+            return JsonResponse(info)
+        if not os.path.isfile(export_file.path):
+            raise Http404
+        response = FileResponse(
+            open(export_file.path, 'rb'), content_type='application/gzip'
+        )
+        response['Content-Disposition'] = 'attachment; filename="%s"' % info['filename']
+        return response
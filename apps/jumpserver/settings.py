@@ -432,9 +432,27 @@ CAPTCHA_NOISE_FUNCTIONS = ('captcha.helpers.noise_dots',)
 CAPTCHA_TEST_MODE = CONFIG.CAPTCHA_TEST_MODE
 
 COMMAND_STORAGE = {
-    'ENGINE': 'terminal.backends.command.db',
+    'ENGINE': CONFIG.COMMAND_STORAGE_ENGINE or 'terminal.backends.command.db',
 }
 
+# Used by `terminal.backends.command.partition` engine, commands are saved in
+# `month` or `day` tables, tables older than retention days will be dropped,
+# 0 means keep all
+COMMAND_PARTITION_INTERVAL = CONFIG.COMMAND_PARTITION_INTERVAL or 'month'
+COMMAND_PARTITION_RETENTION_DAYS = CONFIG.COMMAND_PARTITION_RETENTION_DAYS or 0
+
+# Build a 3-gram index for command input in `terminal.backends.command.db`,
+# search command input by the index instead of scanning the whole table
+COMMAND_INPUT_INDEX_ENABLED = CONFIG.COMMAND_INPUT_INDEX_ENABLED or False
+COMMAND_INPUT_INDEX_BACKFILL_SIZE = CONFIG.COMMAND_INPUT_INDEX_BACKFILL_SIZE or 100000
+
+# Command ingest mode, `sync`: save commands to COMMAND_STORAGE in request,
+# `queue`: push commands to a redis list, celery flush them in batch
+COMMAND_INGEST_MODE = CONFIG.COMMAND_INGEST_MODE or 'sync'
+COMMAND_INGEST_BATCH_SIZE = CONFIG.COMMAND_INGEST_BATCH_SIZE or 2000
+COMMAND_INGEST_MAX_QUEUE_SIZE = CONFIG.COMMAND_INGEST_MAX_QUEUE_SIZE or 1000000
+COMMAND_INGEST_MAX_RETRY = CONFIG.COMMAND_INGEST_MAX_RETRY or 5
+
 TERMINAL_COMMAND_STORAGE = {
     "default": {
         "TYPE": "server",
@@ -445,12 +463,41 @@ TERMINAL_COMMAND_STORAGE = {
     # },
 }
 
+# Terminal status rollup retention days of each period
+STATUS_ROLLUP_RETENTION_DAYS = {
+    '1m': 1,
+    '1h': 30,
+    '1d': 365,
+}
+
 TERMINAL_REPLAY_STORAGE = {
     "default": {
         "TYPE": "server",
     },
 }
 
+# Max size of replays downloaded from external replay storage and cached
+# in MEDIA_ROOT/replay_cache, least recently viewed will be removed first
+REPLAY_CACHE_MAX_SIZE = CONFIG.REPLAY_CACHE_MAX_SIZE or 10 * 1024 * 1024 * 1024
+
+# Terminal task long polling holds one gunicorn thread (WORKERS * 10 in total)
+# per terminal while waiting, at most TASK_POLL_MAX_TIMEOUT seconds. Keep it
+# short, or raise WORKERS when many terminals poll at the same time
+TASK_POLL_MAX_TIMEOUT = CONFIG.TASK_POLL_MAX_TIMEOUT or 5
+
+# Periodic ansible tasks with more than ADHOC_SHARD_SIZE hosts are split into
+# shards of that size and run as a celery chord across workers, each shard
+# uses at most ADHOC_SHARD_FORKS forks, 0 disables sharding
+ADHOC_SHARD_SIZE = CONFIG.ADHOC_SHARD_SIZE if CONFIG.ADHOC_SHARD_SIZE is not None else 500
+ADHOC_SHARD_FORKS = CONFIG.ADHOC_SHARD_FORKS or 10
+
+# Ansible forks of a run = min(hosts, worker cpu count * ANSIBLE_FORKS_PER_CPU,
+# forks option of the task or ANSIBLE_MAX_FORKS), forks of all concurrent runs
+# share ANSIBLE_MAX_TOTAL_FORKS, 0 disables the global limit
+ANSIBLE_FORKS_PER_CPU = CONFIG.ANSIBLE_FORKS_PER_CPU or 4
+ANSIBLE_MAX_FORKS = CONFIG.ANSIBLE_MAX_FORKS or 50
+ANSIBLE_MAX_TOTAL_FORKS = CONFIG.ANSIBLE_MAX_TOTAL_FORKS if CONFIG.ANSIBLE_MAX_TOTAL_FORKS is not None else 200
+
 
 DEFAULT_PASSWORD_MIN_LENGTH = 6
 DEFAULT_LOGIN_LIMIT_COUNT = 7
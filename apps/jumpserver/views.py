@@ -1,27 +1,30 @@
-import datetime
-
 from django.http import HttpResponse, HttpResponseRedirect
 from django.conf import settings
 from django.views.generic import TemplateView, View
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from django.db.models import Count
+from django.core.cache import cache
+from django.db.models import Count, Sum, Max, Q
 from django.shortcuts import redirect
 from django.contrib.auth.mixins import LoginRequiredMixin
 
-from users.models import User
-from assets.models import Asset
-from terminal.models import Session
+from terminal.models import Session, SessionDailyRollup
 from orgs.utils import current_org
+from orgs.counter import assets_amount_counter, assets_disabled_counter, \
+    users_amount_counter, users_disabled_counter, sessions_online_counter, \
+    users_online_counter
 
 
 class IndexView(LoginRequiredMixin, TemplateView):
     template_name = 'index.html'
 
-    session_week = None
-    session_month = None
-    session_month_dates = []
-    session_month_dates_archive = []
+    CONTEXT_CACHE_KEY = '_DASHBOARD_CONTEXT_{}'
+    CONTEXT_CACHE_TIMEOUT = 60
+
+    week_ago = None
+    rollup_week = None
+    rollup_month = None
+    month_daily_metrics = None
 
     def dispatch(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
@@ -32,119 +35,118 @@ class IndexView(LoginRequiredMixin, TemplateView):
 
     @staticmethod
     def get_user_count():
-        return current_org.get_org_users().count()
+        return users_amount_counter.get()
 
     @staticmethod
     def get_asset_count():
-        return Asset.objects.all().count()
+        return assets_amount_counter.get()
 
     @staticmethod
     def get_online_user_count():
-        return len(set(Session.objects.filter(is_finished=False).values_list('user', flat=True)))
+        return users_online_counter.get()
 
     @staticmethod
     def get_online_session_count():
-        return Session.objects.filter(is_finished=False).count()
+        return sessions_online_counter.get()
 
     def get_top5_user_a_week(self):
-        return self.session_week.values('user').annotate(total=Count('user')).order_by('-total')[:5]
+        return list(self.rollup_week.values('user').annotate(
+            total=Sum('count')).order_by('-total')[:5])
 
     def get_week_login_user_count(self):
-        return self.session_week.values('user').distinct().count()
+        return self.rollup_week.values('user').distinct().count()
 
     def get_week_login_asset_count(self):
-        return self.session_week.count()
+        return self.rollup_week.aggregate(total=Sum('count'))['total'] or 0
+
+    def get_month_daily_metrics(self):
+        """
+        一次查询得到每天的登录次数, 活跃用户数和活跃资产数
+        """
+        if self.month_daily_metrics is None:
+            self.month_daily_metrics = list(
+                self.rollup_month.values('date').annotate(
+                    total=Sum('count'),
+                    users=Count('user', distinct=True),
+                    assets=Count('asset', distinct=True),
+                ).order_by('date')
+            )
+        return self.month_daily_metrics
 
     def get_month_day_metrics(self):
-        month_str = [d.strftime('%m-%d') for d in self.session_month_dates] or ['0']
+        month_str = [d['date'].strftime('%m-%d') for d in self.get_month_daily_metrics()] or ['0']
         return month_str
 
     def get_month_login_metrics(self):
-        data = []
-        time_min = datetime.datetime.min.time()
-        time_max = datetime.datetime.max.time()
-        for d in self.session_month_dates:
-            ds = datetime.datetime.combine(d, time_min).replace(tzinfo=timezone.get_current_timezone())
-            de = datetime.datetime.combine(d, time_max).replace(tzinfo=timezone.get_current_timezone())
-            data.append(self.session_month.filter(date_start__range=(ds, de)).count())
-        return data
+        return [d['total'] for d in self.get_month_daily_metrics()]
 
     def get_month_active_user_metrics(self):
-        if self.session_month_dates_archive:
-            return [q.values('user').distinct().count()
-                    for q in self.session_month_dates_archive]
-        else:
-            return [0]
+        return [d['users'] for d in self.get_month_daily_metrics()] or [0]
 
     def get_month_active_asset_metrics(self):
-        if self.session_month_dates_archive:
-            return [q.values('asset').distinct().count()
-                    for q in self.session_month_dates_archive]
-        else:
-            return [0]
+        return [d['assets'] for d in self.get_month_daily_metrics()] or [0]
 
     def get_month_active_user_total(self):
-        return self.session_month.values('user').distinct().count()
+        return self.rollup_month.values('user').distinct().count()
 
     def get_month_inactive_user_total(self):
-        return current_org.get_org_users().count() - self.get_month_active_user_total()
+        return max(self.get_user_count() - self.get_month_active_user_total(), 0)
 
     def get_month_active_asset_total(self):
-        return self.session_month.values('asset').distinct().count()
+        return self.rollup_month.values('asset').distinct().count()
 
     def get_month_inactive_asset_total(self):
-        return Asset.objects.all().count() - self.get_month_active_asset_total()
+        return max(self.get_asset_count() - self.get_month_active_asset_total(), 0)
 
     @staticmethod
     def get_user_disabled_total():
-        return current_org.get_org_users().filter(is_active=False).count()
+        return users_disabled_counter.get()
 
     @staticmethod
     def get_asset_disabled_total():
-        return Asset.objects.filter(is_active=False).count()
+        return assets_disabled_counter.get()
+
+    def get_week_top10(self, field, last_field):
+        """
+        一周内登录次数最多的 10 个 用户/资产, 以及最后一次登录记录
+        """
+        items = list(self.rollup_week.values(field).annotate(
+            total=Sum('count'), date_last=Max('date_last')
+        ).order_by('-total')[:10])
+        if not items:
+            return items
+        q = Q()
+        for item in items:
+            q |= Q(**{field: item[field], 'date_last': item['date_last']})
+        last_records = {}
+        for row in self.rollup_week.filter(q).values(field, last_field, 'date_last'):
+            last_records.setdefault(row[field], {
+                last_field: row[last_field], 'date_start': row['date_last'],
+            })
+        for item in items:
+            item['last'] = last_records.get(item[field])
+        return items
 
     def get_week_top10_asset(self):
-        assets = list(self.session_week.values('asset').annotate(total=Count('asset')).order_by('-total')[:10])
-        for asset in assets:
-            last_login = self.session_week.filter(asset=asset["asset"]).order_by('date_start').last()
-            asset['last'] = last_login
-        return assets
+        return self.get_week_top10('asset', 'user')
 
     def get_week_top10_user(self):
-        users = list(self.session_week.values('user').annotate(
-            total=Count('asset')).order_by('-total')[:10])
-        for user in users:
-            last_login = self.session_week.filter(user=user["user"]).order_by('date_start').last()
-            user['last'] = last_login
-        return users
+        return self.get_week_top10('user', 'asset')
 
     def get_last10_sessions(self):
-        sessions = self.session_week.order_by('-date_start')[:10]
-        for session in sessions:
-            try:
-                session.avatar_url = User.objects.get(username=session.user).avatar_url()
-            except User.DoesNotExist:
-                session.avatar_url = User.objects.first().avatar_url()
-        return sessions
-
-    def get_context_data(self, **kwargs):
-        week_ago = timezone.now() - timezone.timedelta(weeks=1)
-        month_ago = timezone.now() - timezone.timedelta(days=30)
-        self.session_week = Session.objects.filter(date_start__gt=week_ago)
-        self.session_month = Session.objects.filter(date_start__gt=month_ago)
-        self.session_month_dates = self.session_month.dates('date_start', 'day')
-
-        self.session_month_dates_archive = []
-        time_min = datetime.datetime.min.time()
-        time_max = datetime.datetime.max.time()
-
-        for d in self.session_month_dates:
-            ds = datetime.datetime.combine(d, time_min).replace(
-                tzinfo=timezone.get_current_timezone())
-            de = datetime.datetime.combine(d, time_max).replace(
-                tzinfo=timezone.get_current_timezone())
-            self.session_month_dates_archive.append(
-                self.session_month.filter(date_start__range=(ds, de)))
+        return list(Session.objects.filter(date_start__gt=self.week_ago)
+                    .order_by('-date_start')[:10])
+
+    def get_dashboard_context(self):
+        today = timezone.localtime().date()
+        self.week_ago = timezone.now() - timezone.timedelta(weeks=1)
+        self.rollup_week = SessionDailyRollup.objects.filter(
+            date__gt=today - timezone.timedelta(days=7)
+        )
+        self.rollup_month = SessionDailyRollup.objects.filter(
+            date__gt=today - timezone.timedelta(days=30)
+        )
+        self.month_daily_metrics = None
 
         context = {
             'assets_count': self.get_asset_count(),
@@ -168,7 +170,15 @@ class IndexView(LoginRequiredMixin, TemplateView):
             'last_login_ten': self.get_last10_sessions(),
             'week_user_hot_ten': self.get_week_top10_user(),
         }
+        return context
 
+    def get_context_data(self, **kwargs):
+        # 会话统计来自 SessionDailyRollup, 结果按组织缓存一小段时间
+        cache_key = self.CONTEXT_CACHE_KEY.format(current_org.id)
+        context = cache.get(cache_key)
+        if context is None:
+            context = self.get_dashboard_context()
+            cache.set(cache_key, context, self.CONTEXT_CACHE_TIMEOUT)
         kwargs.update(context)
         return super(IndexView, self).get_context_data(**kwargs)
 
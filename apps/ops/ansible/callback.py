@@ -1,18 +1,20 @@
 # ~*~ coding: utf-8 ~*~
 
 import sys
+import time
 
 from ansible.plugins.callback import CallbackBase
 from ansible.plugins.callback.default import CallbackModule
 
 from .display import TeeObj
+from .executor import ELAPSED_KEY
 
 
 class AdHocResultCallback(CallbackModule):
     """
     Task result Callback
     """
-    def __init__(self, display=None, options=None, file_obj=None):
+    def __init__(self, display=None, options=None, file_obj=None, sink=None, lease=None):
         # result_raw example: {
         #   "ok": {"hostname": {"task_name": {}，...},..},
         #   "failed": {"hostname": {"task_name": {}..}, ..},
@@ -25,6 +27,14 @@ class AdHocResultCallback(CallbackModule):
         # }
         self.results_raw = dict(ok={}, failed={}, unreachable={}, skipped={})
         self.results_summary = dict(contacted=[], dark={})
+        # 设置 sink 时每个主机的结果直接写入 sink, 不再保存在 results_raw 中,
+        # sink 需要实现 write(status, hostname, task_name, result)
+        self.sink = sink
+        # 每台主机在 worker 中执行各个 task 的耗时之和, 用于统计执行速度
+        self.hosts_latency = {}
+        self.time_start = time.time()
+        # 执行期间有主机返回结果时续期 lease, 如 ForksLimiter 申请的配额
+        self.lease = lease
         super().__init__()
         if file_obj is not None:
             sys.stdout = TeeObj(file_obj)
@@ -34,8 +44,15 @@ class AdHocResultCallback(CallbackModule):
         host = res._host.get_name()
         task_name = res.task_name
         task_result = res._result
-
-        if self.results_raw[t].get(host):
+        elapsed = task_result.pop(ELAPSED_KEY, None)
+        if elapsed is not None:
+            self.hosts_latency[host] = self.hosts_latency.get(host, 0) + elapsed
+        if self.lease is not None:
+            self.lease.renew()
+
+        if self.sink is not None:
+            self.sink.write(t, host, task_name, task_result)
+        elif self.results_raw[t].get(host):
             self.results_raw[t][host][task_name] = task_result
         else:
             self.results_raw[t][host] = {task_name: task_result}
@@ -76,7 +93,7 @@ class CommandResultCallback(AdHocResultCallback):
     """
     Command result callback
     """
-    def __init__(self, display=None):
+    def __init__(self, display=None, **kwargs):
         # results_command: {
         #   "cmd": "",
         #   "stderr": "",
@@ -86,7 +103,7 @@ class CommandResultCallback(AdHocResultCallback):
         # }
         #
         self.results_command = dict()
-        super().__init__(display)
+        super().__init__(display, **kwargs)
 
     def gather_result(self, t, res):
         super().gather_result(t, res)
@@ -0,0 +1,28 @@
+# ~*~ coding: utf-8 ~*~
+
+import time
+
+from ansible.executor.task_executor import TaskExecutor
+from ansible.executor.process import worker
+
+__all__ = ['TimedTaskExecutor', 'ELAPSED_KEY']
+
+ELAPSED_KEY = '_jms_host_elapsed'
+
+
+class TimedTaskExecutor(TaskExecutor):
+    """
+    在 worker 进程中记录主机执行 task 的耗时, 随结果返回给 callback,
+    不包含主机在 fork 队列中等待的时间
+    """
+    def run(self):
+        time_start = time.time()
+        result = super().run()
+        if isinstance(result, dict):
+            result[ELAPSED_KEY] = time.time() - time_start
+        return result
+
+
+# ansible 2.4 的 WorkerProcess 使用 worker 模块中导入的 TaskExecutor,
+# 没有 v2_runner_on_start 等主机开始执行的回调
+worker.TaskExecutor = TimedTaskExecutor
@@ -13,6 +13,7 @@ from ansible.utils.display import Display
 
 from .callback import AdHocResultCallback, PlaybookResultCallBack, \
     CommandResultCallback
+from . import executor  # noqa 替换 worker 使用的 TaskExecutor, 记录主机耗时
 from common.utils import get_logger
 from .exceptions import AnsibleError
 
@@ -144,8 +145,10 @@ class AdHocRunner:
             loader=self.loader, inventory=self.inventory
         )
 
-    def get_result_callback(self, file_obj=None):
-        return self.__class__.results_callback_class(file_obj=file_obj)
+    def get_result_callback(self, file_obj=None, sink=None, lease=None):
+        return self.__class__.results_callback_class(
+            file_obj=file_obj, sink=sink, lease=lease
+        )
 
     @staticmethod
     def check_module_args(module_name, module_args=''):
@@ -177,17 +180,19 @@ class AdHocRunner:
             options = self.__class__.default_options
         return options
 
-    def run(self, tasks, pattern, play_name='Ansible Ad-hoc', gather_facts='no', file_obj=None):
+    def run(self, tasks, pattern, play_name='Ansible Ad-hoc', gather_facts='no', file_obj=None, sink=None, lease=None):
         """
         :param tasks: [{'action': {'module': 'shell', 'args': 'ls'}, ...}, ]
         :param pattern: all, *, or others
         :param play_name: The play name
         :param gather_facts:
         :param file_obj: logging to file_obj
+        :param sink: write every host result to sink instead of results_raw
+        :param lease: renew() is called when host results return
         :return:
         """
         self.check_pattern(pattern)
-        self.results_callback = self.get_result_callback(file_obj)
+        self.results_callback = self.get_result_callback(file_obj, sink=sink, lease=lease)
         cleaned_tasks = self.clean_tasks(tasks)
 
         play_source = dict(
@@ -6,12 +6,13 @@ from django.core.cache import cache
 from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext as _
 from rest_framework import viewsets, generics
+from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.views import Response
 
 from common.permissions import IsOrgAdmin
-from .models import Task, AdHoc, AdHocRunHistory, CeleryTask
+from .models import Task, AdHoc, AdHocRunHistory, AdHocHostResult, CeleryTask
 from .serializers import TaskSerializer, AdHocSerializer, \
-    AdHocRunHistorySerializer
+    AdHocRunHistorySerializer, AdHocHostResultSerializer
 from .tasks import run_ansible_task
 
 
@@ -66,6 +67,22 @@ class AdHocRunHistorySet(viewsets.ModelViewSet):
         return self.queryset
 
 
+class AdHocHostResultListApi(generics.ListAPIView):
+    """
+    执行记录中每台主机的结果, 按主机名分页, 可以按 status, task_name 过滤
+    """
+    filter_fields = ("hostname", "status", "task_name")
+    search_fields = ("hostname",)
+    serializer_class = AdHocHostResultSerializer
+    pagination_class = LimitOffsetPagination
+    permission_classes = (IsOrgAdmin,)
+
+    def get_queryset(self):
+        history = get_object_or_404(AdHocRunHistory, id=self.kwargs.get('pk'))
+        return AdHocHostResult.objects.filter(history=history)\
+            .order_by('hostname', 'task_name')
+
+
 class CeleryTaskLogApi(generics.RetrieveAPIView):
     permission_classes = (IsOrgAdmin,)
     buff_size = 1024 * 10
@@ -13,3 +13,4 @@ class OpsConfig(AppConfig):
 
         super().ready()
         from .celery import signal_handler
+        from . import signals_handler
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import time
+import uuid
+
+from django.conf import settings
+
+from common.utils import get_redis_client, get_logger
+
+logger = get_logger(__file__)
+
+__all__ = ['ForksLimiter', 'get_run_stats']
+
+
+class ForksLimiter:
+    """
+    adhoc 执行时的 forks 由主机数, 当前 worker 的 CPU 数和 task 的 forks 上限决定,
+    并从全局配额中申请, 所有 worker 同时执行的 forks 总数不超过 ANSIBLE_MAX_TOTAL_FORKS
+
+    配额保存在 redis 的 sorted set 中, member 为 "lease_id:forks", score 为过期时间,
+    执行期间由 callback 续期, 执行结束后归还, 进程异常退出没有归还的配额过期后回收
+    """
+    KEY = 'OPS_ANSIBLE_FORKS_LEASES'
+    LEASE_TIMEOUT = 3600 * 2
+    RENEW_INTERVAL = 60
+    WAIT_INTERVAL = 1
+    WAIT_TIMEOUT = 600
+
+    # ARGV: now, expire_at, max_total, wanted, lease_id
+    # 返回分配到的 forks, 没有剩余配额时返回 0
+    ACQUIRE_SCRIPT = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    local used = 0
+    for _, member in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+        used = used + tonumber(string.match(member, ':(%d+)$'))
+    end
+    local forks = math.min(tonumber(ARGV[4]), tonumber(ARGV[3]) - used)
+    if forks < 1 then
+        return 0
+    end
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[5] .. ':' .. forks)
+    return forks
+    """
+    _acquire_script = None
+
+    def __init__(self, hosts_amount, max_forks=None):
+        self.wanted = self.get_wanted_forks(hosts_amount, max_forks)
+        self.forks = None
+        self.lease_id = uuid.uuid4().hex
+        self.member = None
+        self.date_renewed = 0
+
+    @staticmethod
+    def get_wanted_forks(hosts_amount, max_forks=None):
+        """
+        min(主机数, CPU 数 * ANSIBLE_FORKS_PER_CPU, task 的 forks 上限), 最少为 1
+        """
+        cpu_forks = (os.cpu_count() or 1) * settings.ANSIBLE_FORKS_PER_CPU
+        max_forks = max_forks or settings.ANSIBLE_MAX_FORKS
+        return max(1, min(hosts_amount, cpu_forks, max_forks))
+
+    @classmethod
+    def get_acquire_script(cls):
+        if cls._acquire_script is None:
+            cls._acquire_script = get_redis_client().register_script(cls.ACQUIRE_SCRIPT)
+        return cls._acquire_script
+
+    def try_acquire(self):
+        now = time.time()
+        forks = self.get_acquire_script()(keys=[self.KEY], args=[
+            now, now + self.LEASE_TIMEOUT, settings.ANSIBLE_MAX_TOTAL_FORKS,
+            self.wanted, self.lease_id,
+        ])
+        return int(forks or 0)
+
+    def acquire(self):
+        """
+        配额不足时等待其他 adhoc 归还, 等待超时后只使用 1 个 fork 执行
+        """
+        if not settings.ANSIBLE_MAX_TOTAL_FORKS:
+            self.forks = self.wanted
+            return self.forks
+        time_start = time.time()
+        while True:
+            try:
+                forks = self.try_acquire()
+            except Exception as e:
+                # redis 不可用时不限制全局并发
+                logger.error("Acquire ansible forks error: {}".format(e))
+                self.forks = self.wanted
+                return self.forks
+            if forks:
+                self.forks = forks
+                self.member = '{}:{}'.format(self.lease_id, forks)
+                self.date_renewed = time.time()
+                return self.forks
+            if time.time() - time_start > self.WAIT_TIMEOUT:
+                logger.warn("Wait ansible forks timeout, run with 1 fork")
+                self.forks = 1
+                return self.forks
+            time.sleep(self.WAIT_INTERVAL)
+
+    def renew(self):
+        """
+        延长配额的过期时间, 每 RENEW_INTERVAL 秒最多续期一次,
+        已经过期被回收的配额不再加回
+        """
+        now = time.time()
+        if not self.member or now - self.date_renewed < self.RENEW_INTERVAL:
+            return
+        self.date_renewed = now
+        try:
+            get_redis_client().execute_command(
+                'ZADD', self.KEY, 'XX', now + self.LEASE_TIMEOUT, self.member
+            )
+        except Exception as e:
+            logger.error("Renew ansible forks error: {}".format(e))
+
+    def release(self):
+        if not self.member:
+            return
+        try:
+            get_redis_client().zrem(self.KEY, self.member)
+        except Exception as e:
+            logger.error("Release ansible forks error: {}".format(e))
+        self.member = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = max(0, int(round(len(values) * percent / 100.0)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def get_run_stats(hosts_latency, duration, forks):
+    """
+    :param hosts_latency: {hostname: 主机在 worker 中执行各个 task 的秒数之和}
+    :return: 执行统计, 保存到 AdHocRunHistory.stats
+    """
+    latency = list(hosts_latency.values())
+    return {
+        'hosts': len(latency),
+        'forks': forks,
+        'duration': round(duration, 3),
+        'hosts_per_second': round(len(latency) / duration, 3) if duration else 0,
+        'latency_p50': round(percentile(latency, 50), 3),
+        'latency_p95': round(percentile(latency, 95), 3),
+        'latency_max': round(max(latency), 3) if latency else 0,
+    }
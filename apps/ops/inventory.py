@@ -1,14 +1,104 @@
 # -*- coding: utf-8 -*-
 #
+import json
+import uuid
+import random
+import hashlib
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
 
 from .ansible.inventory import BaseInventory
+from assets.models import AdminUser, Gateway
 from assets.utils import get_assets_by_fullname_list, get_system_user_by_name
+from orgs.utils import get_current_org
 
 __all__ = [
-    'JMSInventory'
+    'JMSInventory', 'InventorySnapshot',
 ]
 
 
+class InventorySnapshot:
+    """
+    inventory 中不包含认证信息的部分 (主机, 节点/标签分组, 变量), 按主机列表缓存,
+    资产, 节点, 标签, 网域变化时更新版本号, 之前的快照全部失效
+
+    管理用户和网关的认证信息不放到缓存中, 每次使用时按不同的管理用户/网关各解密一次
+    """
+    VERSION_CACHE_KEY = '_OPS_INVENTORY_VERSION'
+    SNAPSHOT_CACHE_KEY = '_OPS_INVENTORY_{}_{}'
+    CACHE_TIMEOUT = 3600 * 24
+
+    def __init__(self, hostname_list):
+        self.hostname_list = hostname_list
+
+    @classmethod
+    def get_version(cls):
+        version = cache.get(cls.VERSION_CACHE_KEY)
+        if version is None:
+            cache.add(cls.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+            version = cache.get(cls.VERSION_CACHE_KEY)
+        return version
+
+    @classmethod
+    def expire(cls):
+        # 事务提交后再更新版本号, 避免其他进程读到未提交的数据后缓存
+        transaction.on_commit(
+            lambda: cache.set(cls.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        )
+
+    def get_key(self, version):
+        # 资产按当前组织过滤, 组织不同时结果可能不同
+        org = get_current_org()
+        org_id = str(org.id) if org else ''
+        hosts = json.dumps([org_id, sorted(self.hostname_list)])
+        digest = hashlib.md5(hosts.encode('utf-8')).hexdigest()
+        return self.SNAPSHOT_CACHE_KEY.format(version, digest)
+
+    def get_hosts(self):
+        version = self.get_version()
+        key = self.get_key(version)
+        hosts = cache.get(key)
+        if hosts is None:
+            hosts = self.build()
+            cache.set(key, hosts, self.CACHE_TIMEOUT)
+        return hosts
+
+    def get_assets(self):
+        assets = get_assets_by_fullname_list(self.hostname_list)
+        return assets.select_related('domain')\
+            .prefetch_related('nodes', 'labels')
+
+    def build(self):
+        hosts = []
+        for asset in self.get_assets():
+            info = {
+                'id': asset.id,
+                'hostname': asset.hostname,
+                'ip': asset.ip,
+                'port': asset.port,
+                'vars': dict(),
+                'groups': [],
+                'admin_user': asset.admin_user_id,
+                'domain': asset.domain_id,
+            }
+            for node in asset.nodes.all():
+                info["groups"].append(node.value)
+            for label in asset.labels.all():
+                info["vars"].update({
+                    label.name: label.value
+                })
+                info["groups"].append("{}:{}".format(label.name, label.value))
+            if asset.domain:
+                info["vars"].update({
+                    "domain": asset.domain.name,
+                })
+                info["groups"].append("domain_" + asset.domain.name)
+            hosts.append(info)
+        return hosts
+
+
 class JMSInventory(BaseInventory):
     """
     JMS Inventory is the manager with jumpserver assets, so you can
@@ -26,12 +116,8 @@ class JMSInventory(BaseInventory):
         self.run_as = run_as
         self.become_info = become_info
 
-        assets = self.get_jms_assets()
-        host_list = []
-
-        for asset in assets:
-            info = self.convert_to_ansible(asset, run_as_admin=run_as_admin)
-            host_list.append(info)
+        hosts = InventorySnapshot(hostname_list).get_hosts()
+        host_list = self.make_host_list(hosts, run_as_admin=run_as_admin)
 
         if run_as:
             run_user_info = self.get_run_user_info()
@@ -43,36 +129,55 @@ class JMSInventory(BaseInventory):
                 host.update(become_info)
         super().__init__(host_list=host_list)
 
-    def get_jms_assets(self):
-        assets = get_assets_by_fullname_list(self.hostname_list)
-        return assets
-
-    def convert_to_ansible(self, asset, run_as_admin=False):
-        info = {
-            'id': asset.id,
-            'hostname': asset.hostname,
-            'ip': asset.ip,
-            'port': asset.port,
-            'vars': dict(),
-            'groups': [],
-        }
-        if asset.domain and asset.domain.has_gateway():
-            info["vars"].update(self.make_proxy_command(asset))
+    def make_host_list(self, hosts, run_as_admin=False):
+        """
+        在快照的基础上加入网关和管理用户的认证信息
+        """
+        domains_proxy = self.get_domains_proxy_command(
+            {host['domain'] for host in hosts if host['domain']}
+        )
+        admin_users_info = {}
         if run_as_admin:
-            info.update(asset.get_auth_info())
-        for node in asset.nodes.all():
-            info["groups"].append(node.value)
-        for label in asset.labels.all():
-            info["vars"].update({
-                label.name: label.value
-            })
-            info["groups"].append("{}:{}".format(label.name, label.value))
-        if asset.domain:
-            info["vars"].update({
-                "domain": asset.domain.name,
-            })
-            info["groups"].append("domain_"+asset.domain.name)
-        return info
+            admin_users_info = self.get_admin_users_auth_info(
+                {host['admin_user'] for host in hosts if host['admin_user']}
+            )
+
+        host_list = []
+        for host in hosts:
+            info = {k: v for k, v in host.items() if k not in ('admin_user', 'domain')}
+            info['vars'] = dict(host['vars'])
+            info['groups'] = list(host['groups'])
+            proxy_commands = domains_proxy.get(host['domain'])
+            if proxy_commands:
+                info['vars'] = dict(random.choice(proxy_commands), **info['vars'])
+            if run_as_admin:
+                auth_info = admin_users_info.get(host['admin_user'])
+                if auth_info:
+                    info.update(auth_info)
+            host_list.append(info)
+        return host_list
+
+    @staticmethod
+    def get_admin_users_auth_info(admin_users_id):
+        admin_users = AdminUser._base_manager.filter(id__in=admin_users_id)
+        return {
+            admin_user.id: {
+                'username': admin_user.username,
+                'password': admin_user.password,
+                'private_key': admin_user.private_key_file,
+                'become': admin_user.become_info,
+            }
+            for admin_user in admin_users
+        }
+
+    def get_domains_proxy_command(self, domains_id):
+        gateways = Gateway._base_manager.filter(
+            domain_id__in=domains_id, is_active=True
+        )
+        domains_proxy = defaultdict(list)
+        for gateway in gateways:
+            domains_proxy[gateway.domain_id].append(self.make_proxy_command(gateway))
+        return domains_proxy
 
     def get_run_user_info(self):
         system_user = get_system_user_by_name(self.run_as)
@@ -82,8 +187,7 @@ class JMSInventory(BaseInventory):
             return system_user._to_secret_json()
 
     @staticmethod
-    def make_proxy_command(asset):
-        gateway = asset.domain.random_gateway()
+    def make_proxy_command(gateway):
         proxy_command_list = [
             "ssh", "-p", str(gateway.port),
             "-o", "StrictHostKeyChecking=no",
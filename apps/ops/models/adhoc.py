@@ -20,8 +20,9 @@ from ..celery.utils import delete_celery_periodic_task, \
     disable_celery_periodic_task
 from ..ansible import AdHocRunner, AnsibleError
 from ..inventory import JMSInventory
+from ..concurrency import ForksLimiter, get_run_stats
 
-__all__ = ["Task", "AdHoc", "AdHocRunHistory"]
+__all__ = ["Task", "AdHoc", "AdHocRunHistory", "AdHocHostResult"]
 
 
 logger = get_logger(__file__)
@@ -83,10 +84,10 @@ class Task(models.Model):
     def get_run_history(self):
         return self.history.all()
 
-    def run(self, record=True):
+    def run(self, record=True, history_id=None):
         set_to_root_org()
         if self.latest_adhoc:
-            return self.latest_adhoc.run(record=record)
+            return self.latest_adhoc.run(record=record, history_id=history_id)
         else:
             return {'error': 'No adhoc'}
 
@@ -184,6 +185,9 @@ class AdHoc(models.Model):
 
     @property
     def inventory(self):
+        return self.get_inventory()
+
+    def get_inventory(self, hosts=None):
         if self.become:
             become_info = {
                 'become': {
@@ -194,7 +198,8 @@ class AdHoc(models.Model):
             become_info = None
 
         inventory = JMSInventory(
-            self.hosts, run_as_admin=self.run_as_admin,
+            hosts if hosts is not None else self.hosts,
+            run_as_admin=self.run_as_admin,
             run_as=self.run_as, become_info=become_info
         )
         return inventory
@@ -206,24 +211,34 @@ class AdHoc(models.Model):
         else:
             return {}
 
-    def run(self, record=True):
+    def run(self, record=True, history_id=None):
+        """
+        :param history_id: 执行记录的 id, 默认为当前 celery 任务的 id,
+            主机的执行结果保存在 AdHocHostResult 中, 通过这个 id 查询
+        """
         set_to_root_org()
         if record:
-            return self._run_and_record()
+            return self._run_and_record(history_id=history_id)
         else:
             return self._run_only()
 
-    def _run_and_record(self):
-        try:
-            hid = current_task.request.id
-        except AttributeError:
-            hid = str(uuid.uuid4())
+    def _run_and_record(self, history_id=None):
+        from ..results import HostResultSink
+
+        hid = history_id or AdHocRunHistory.get_current_id()
+        # 先保存执行记录, 主机结果执行过程中逐批写入
         history = AdHocRunHistory(id=hid, adhoc=self, task=self.task)
+        history.save()
+        sink = HostResultSink(history.id)
         time_start = time.time()
         try:
             date_start = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             print("{} Start task: {}\r\n".format(date_start, self.task.name))
-            raw, summary = self._run_only()
+            try:
+                raw, summary = self._run_only(sink=sink)
+            finally:
+                sink.close()
+            history.stats = self.run_stats
             date_end = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             print("\r\n{} Task finished".format(date_end))
             history.is_finished = True
@@ -242,19 +257,104 @@ class AdHoc(models.Model):
             history.timedelta = time.time() - time_start
             history.save()
 
-    def _run_only(self, file_obj=None):
-        runner = AdHocRunner(self.inventory, options=self.options)
-        try:
-            result = runner.run(
-                self.tasks,
-                self.pattern,
-                self.task.name,
-                file_obj=file_obj,
-            )
-            return result.results_raw, result.results_summary
-        except AnsibleError as e:
-            logger.warn("Failed run adhoc {}, {}".format(self.task.name, e))
-            pass
+    def _run_only(self, file_obj=None, hosts=None, options=None, sink=None):
+        """
+        forks 由主机数, worker 的 CPU 数和全局配额决定, options 中的 forks 作为上限,
+        执行统计保存在 self.run_stats
+        :param hosts: 只在这些主机上执行, 默认全部主机
+        :param options: 覆盖 adhoc 的部分 options, 如 forks
+        :param sink: 主机结果写入 sink, 返回的 raw 中不再包含主机结果
+        """
+        self.run_stats = {}
+        _options = dict(self.options, **(options or {}))
+        hosts = self.hosts if hosts is None else hosts
+        limiter = ForksLimiter(len(hosts), max_forks=_options.get('forks'))
+        with limiter:
+            _options['forks'] = limiter.forks
+            runner = AdHocRunner(self.get_inventory(hosts), options=_options)
+            try:
+                result = runner.run(
+                    self.tasks,
+                    self.pattern,
+                    self.task.name,
+                    file_obj=file_obj,
+                    sink=sink,
+                    lease=limiter,
+                )
+            except AnsibleError as e:
+                logger.warn("Failed run adhoc {}, {}".format(self.task.name, e))
+                return
+        self.run_stats = get_run_stats(
+            result.hosts_latency, time.time() - result.time_start, limiter.forks
+        )
+        return result.results_raw, result.results_summary
+
+    def need_shard(self, shard_size=None):
+        shard_size = shard_size or settings.ADHOC_SHARD_SIZE
+        return bool(shard_size) and len(self.hosts) > shard_size
+
+    def get_shards(self, shard_size=None):
+        shard_size = shard_size or settings.ADHOC_SHARD_SIZE
+        hosts = self.hosts
+        return [hosts[i:i + shard_size] for i in range(0, len(hosts), shard_size)]
+
+    def run_sharded(self, callback=None, shard_size=None, forks=None, history_id=None):
+        """
+        主机分片后作为 celery chord 在多个 worker 上并发执行,
+        全部分片完成后合并结果, 保存为一条执行记录, 再调用 callback
+        :param callback: 和 run_ansible_task 一样, 参数为 (raw, summary)
+        """
+        from celery import chord
+        from ..tasks import run_adhoc_shard, merge_adhoc_shards
+
+        history = AdHocRunHistory.objects.create(
+            id=history_id or AdHocRunHistory.get_current_id(),
+            adhoc=self, task=self.task
+        )
+        forks = forks or settings.ADHOC_SHARD_FORKS
+        shards = self.get_shards(shard_size)
+        logger.info("Run adhoc {} in {} shards".format(self.task.name, len(shards)))
+        header = [
+            run_adhoc_shard.s(str(self.id), hosts, forks=forks, history_id=str(history.id))
+            for hosts in shards
+        ]
+        body = merge_adhoc_shards.s(str(history.id), callback=callback)
+        return chord(header)(body)
+
+    @staticmethod
+    def merge_results(results):
+        """
+        合并多个分片的 (raw, summary, stats)
+        """
+        raw = dict(ok={}, failed={}, unreachable={}, skipped={})
+        summary = dict(contacted=[], dark={})
+        for _raw, _summary, *_ in results:
+            for t, hosts in _raw.items():
+                raw.setdefault(t, {}).update(hosts)
+            summary['dark'].update(_summary.get('dark', {}))
+            summary['contacted'].extend(_summary.get('contacted', []))
+        summary['contacted'] = [
+            host for host in summary['contacted']
+            if host not in summary['dark']
+        ]
+        return raw, summary
+
+    @staticmethod
+    def merge_stats(stats_list, duration):
+        """
+        合并多个分片的执行统计, 分片并发执行, 所以 forks 相加,
+        p95 无法精确合并, 取各分片中的最大值
+        """
+        hosts = sum(stats.get('hosts', 0) for stats in stats_list)
+        return {
+            'hosts': hosts,
+            'forks': sum(stats.get('forks', 0) for stats in stats_list),
+            'duration': round(duration, 3),
+            'hosts_per_second': round(hosts / duration, 3) if duration else 0,
+            'latency_p50': max([s.get('latency_p50', 0) for s in stats_list] or [0]),
+            'latency_p95': max([s.get('latency_p95', 0) for s in stats_list] or [0]),
+            'latency_max': max([s.get('latency_max', 0) for s in stats_list] or [0]),
+        }
 
     @become.setter
     def become(self, item):
@@ -331,6 +431,18 @@ class AdHocRunHistory(models.Model):
     is_success = models.BooleanField(default=False, verbose_name=_('Is success'))
     _result = models.TextField(blank=True, null=True, verbose_name=_('Adhoc raw result'))
     _summary = models.TextField(blank=True, null=True, verbose_name=_('Adhoc result summary'))
+    _stats = models.TextField(blank=True, null=True, verbose_name=_('Adhoc run stats'))
+
+    @staticmethod
+    def get_current_id():
+        """
+        执行记录的 id 和当前 celery 任务的 id 相同, 可以通过它查看任务日志
+        """
+        try:
+            hid = current_task.request.id
+        except AttributeError:
+            hid = None
+        return hid or str(uuid.uuid4())
 
     @property
     def short_id(self):
@@ -366,6 +478,17 @@ class AdHocRunHistory(models.Model):
     def summary(self, item):
         self._summary = json.dumps(item)
 
+    @property
+    def stats(self):
+        if self._stats:
+            return json.loads(self._stats)
+        else:
+            return {}
+
+    @stats.setter
+    def stats(self, item):
+        self._stats = json.dumps(item)
+
     @property
     def success_hosts(self):
         return self.summary.get('contacted', [])
@@ -380,3 +503,42 @@ class AdHocRunHistory(models.Model):
     class Meta:
         db_table = "ops_adhoc_history"
         get_latest_by = 'date_start'
+
+
+class AdHocHostResult(models.Model):
+    """
+    每台主机每个 ansible task 的执行结果, 执行过程中由 HostResultSink 分批写入,
+    不再全部保存在内存和 AdHocRunHistory._result 中
+    """
+    STATUS_CHOICES = (
+        ('ok', 'ok'),
+        ('failed', 'failed'),
+        ('unreachable', 'unreachable'),
+        ('skipped', 'skipped'),
+    )
+    id = models.UUIDField(default=uuid.uuid4, primary_key=True)
+    history = models.ForeignKey(AdHocRunHistory, related_name='host_results', on_delete=models.CASCADE)
+    hostname = models.CharField(max_length=128, verbose_name=_('Hostname'))
+    task_name = models.CharField(max_length=128, default='', verbose_name=_('Task name'))
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, verbose_name=_('Status'))
+    _result = models.TextField(blank=True, null=True, verbose_name=_('Result'))
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def result(self):
+        if self._result:
+            return json.loads(self._result)
+        else:
+            return {}
+
+    @result.setter
+    def result(self, item):
+        self._result = json.dumps(item)
+
+    def __str__(self):
+        return '{}: {}'.format(self.hostname, self.status)
+
+    class Meta:
+        db_table = "ops_adhoc_host_result"
+        ordering = ('hostname', 'task_name')
+        index_together = [('history', 'hostname')]
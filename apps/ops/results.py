@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+import json
+
+from common.utils import get_logger
+from .models import AdHocHostResult
+
+logger = get_logger(__file__)
+
+__all__ = ['HostResultSink', 'iter_host_results']
+
+
+class HostResultSink:
+    """
+    ansible callback 每返回一个主机的结果就写入缓冲区, 满 buffer_size 条后
+    bulk_create 到 AdHocHostResult, 执行过程中内存里最多保留 buffer_size 条结果
+    """
+    buffer_size = 200
+
+    def __init__(self, history_id):
+        self.history_id = history_id
+        self.buffer = []
+
+    def write(self, status, hostname, task_name, result):
+        self.buffer.append(AdHocHostResult(
+            history_id=self.history_id, hostname=hostname[:128],
+            task_name=(task_name or '')[:128], status=status,
+            _result=json.dumps(result),
+        ))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        try:
+            AdHocHostResult.objects.bulk_create(self.buffer)
+        except Exception as e:
+            logger.error("Save adhoc host results error: {}".format(e))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+
+def iter_host_results(history_id, status=None, task_name=None, chunk_size=1000):
+    """
+    逐条读取执行记录的主机结果, 不一次加载到内存
+    """
+    queryset = AdHocHostResult.objects.filter(history_id=history_id)
+    if status:
+        queryset = queryset.filter(status=status)
+    if task_name:
+        queryset = queryset.filter(task_name=task_name)
+    yield from queryset.order_by().iterator(chunk_size=chunk_size)
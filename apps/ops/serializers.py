@@ -2,7 +2,7 @@
 from __future__ import unicode_literals
 from rest_framework import serializers
 
-from .models import Task, AdHoc, AdHocRunHistory
+from .models import Task, AdHoc, AdHocRunHistory, AdHocHostResult
 
 
 class TaskSerializer(serializers.ModelSerializer):
@@ -29,7 +29,7 @@ class AdHocRunHistorySerializer(serializers.ModelSerializer):
 
     class Meta:
         model = AdHocRunHistory
-        exclude = ('_result', '_summary')
+        exclude = ('_result', '_summary', '_stats')
 
     @staticmethod
     def get_adhoc_short_id(obj):
@@ -49,5 +49,16 @@ class AdHocRunHistorySerializer(serializers.ModelSerializer):
 
     def get_field_names(self, declared_fields, info):
         fields = super().get_field_names(declared_fields, info)
-        fields.extend(['summary', 'short_id'])
+        fields.extend(['summary', 'short_id', 'stats'])
+        return fields
+
+
+class AdHocHostResultSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AdHocHostResult
+        exclude = ('_result',)
+
+    def get_field_names(self, declared_fields, info):
+        fields = super().get_field_names(declared_fields, info)
+        fields.extend(['result'])
         return fields
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from assets.models import Asset, Node, Label, Domain
+from assets.signals import post_assets_bulk_create, post_assets_bulk_update
+from .inventory import InventorySnapshot
+
+# 资产这些字段变化时 inventory 才需要重建
+ASSET_INVENTORY_FIELDS = {
+    'hostname', 'ip', 'port', 'domain', 'admin_user', 'org_id',
+}
+
+
+@receiver(post_save, sender=Asset)
+def on_asset_changed_expire_inventory(sender, instance=None, **kwargs):
+    update_fields = kwargs.get('update_fields')
+    if update_fields and not ASSET_INVENTORY_FIELDS & set(update_fields):
+        return
+    InventorySnapshot.expire()
+
+
+@receiver(post_delete, sender=Asset)
+@receiver(post_save, sender=Node)
+@receiver(post_delete, sender=Node)
+@receiver(post_save, sender=Label)
+@receiver(post_delete, sender=Label)
+@receiver(post_save, sender=Domain)
+@receiver(post_delete, sender=Domain)
+@receiver(post_assets_bulk_create, sender=Asset)
+@receiver(post_assets_bulk_update, sender=Asset)
+def on_inventory_related_changed(sender, **kwargs):
+    InventorySnapshot.expire()
+
+
+@receiver(m2m_changed, sender=Asset.nodes.through)
+@receiver(m2m_changed, sender=Asset.labels.through)
+def on_asset_relation_changed_expire_inventory(sender, action=None, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        InventorySnapshot.expire()
@@ -1,8 +1,12 @@
 # coding: utf-8
+
 from celery import shared_task, subtask
+from django.utils import timezone
 
 from common.utils import get_logger, get_object_or_none
-from .models import Task
+from orgs.utils import set_to_root_org
+from .models import Task, AdHoc, AdHocRunHistory
+from .results import HostResultSink
 
 logger = get_logger(__file__)
 
@@ -20,14 +24,72 @@ def run_ansible_task(tid, callback=None, **kwargs):
     """
     task = get_object_or_none(Task, id=tid)
     if task:
-        result = task.run()
+        # callback 通过 history_id 读取每台主机的执行结果
+        history_id = AdHocRunHistory.get_current_id()
+        adhoc = task.latest_adhoc
+        if adhoc and adhoc.need_shard():
+            # 分片执行, 结果由 merge_adhoc_shards 保存并调用 callback
+            adhoc.run_sharded(callback=callback, history_id=history_id)
+            return
+        result = task.run(history_id=history_id)
         if callback is not None:
-            subtask(callback).delay(result, task_name=task.name)
+            subtask(callback).delay(result, task_name=task.name, history_id=history_id)
         return result
     else:
         logger.error("No task found")
 
 
+@shared_task
+def run_adhoc_shard(adhoc_id, hosts, forks=None, history_id=None):
+    """
+    执行 adhoc 的一个主机分片, 主机结果写入 history_id 对应的执行记录
+    :return: (raw, summary, stats)
+    """
+    set_to_root_org()
+    adhoc = get_object_or_none(AdHoc, id=adhoc_id)
+    if not adhoc:
+        return {}, {"dark": {"all": "No adhoc found"}, "contacted": []}, {}
+    options = {'forks': forks} if forks else None
+    sink = HostResultSink(history_id) if history_id else None
+    try:
+        result = adhoc._run_only(hosts=hosts, options=options, sink=sink)
+    except Exception as e:
+        logger.error("Run adhoc shard error: {}".format(e))
+        result = None
+    finally:
+        if sink is not None:
+            sink.close()
+    if not result:
+        # 分片失败时所有主机都算作失败
+        return {}, {"dark": {host: {} for host in hosts}, "contacted": []}, {}
+    raw, summary = result
+    return raw, summary, adhoc.run_stats
+
+
+@shared_task
+def merge_adhoc_shards(results, history_id, callback=None):
+    """
+    合并 run_adhoc_shard 的结果, 更新执行记录
+    """
+    history = get_object_or_none(AdHocRunHistory, id=history_id)
+    raw, summary = AdHoc.merge_results(results)
+    if history:
+        history.is_finished = True
+        history.is_success = not summary.get('dark')
+        history.result = raw
+        history.summary = summary
+        history.date_finished = timezone.now()
+        history.timedelta = (history.date_finished - history.date_start).total_seconds()
+        history.stats = AdHoc.merge_stats(
+            [stats for _, _, stats in results if stats], history.timedelta
+        )
+        history.save()
+    if callback is not None:
+        task_name = history.task.name if history and history.task else ''
+        subtask(callback).delay((raw, summary), task_name=task_name, history_id=history_id)
+    return raw, summary
+
+
 @shared_task
 def hello(name, callback=None):
     print("Hello {}".format(name))
@@ -15,6 +15,7 @@ router.register(r'history', api.AdHocRunHistorySet, 'history')
 
 urlpatterns = [
     path('tasks/<uuid:pk>/run/', api.TaskRun.as_view(), name='task-run'),
+    path('history/<uuid:pk>/hosts/', api.AdHocHostResultListApi.as_view(), name='history-host-result-list'),
     path('celery/task/<uuid:pk>/log/', api.CeleryTaskLogApi.as_view(), name='celery-task-log'),
 ]
 
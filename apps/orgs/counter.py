@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Organization
+from .utils import get_current_org, set_current_org, current_org
+
+
+class OrgCounter:
+    """
+    按组织缓存的计数, 首页等页面直接读取, 不再每次 COUNT
+
+    计数由信号增减或失效, 缓存不存在时在对应组织下重新计算,
+    实例的变更会同时影响所在组织和 ROOT 组织的计数,
+    reconcile_org_counters 任务定期重新计算, 修正误差
+    """
+    CACHE_KEY = '_ORG_COUNTER_{}_{}'
+    CACHE_TIMEOUT = 3600 * 24
+    counters = {}
+
+    def __init__(self, name, calculate):
+        self.name = name
+        self._calculate = calculate
+        self.counters[name] = self
+
+    @staticmethod
+    def get_org_id(org_id):
+        return str(org_id) if org_id else Organization.DEFAULT_ID_NAME
+
+    def get_key(self, org_id):
+        return self.CACHE_KEY.format(self.name, self.get_org_id(org_id))
+
+    def get_affected_keys(self, org_id):
+        return [self.get_key(org_id), self.get_key(Organization.ROOT_ID_NAME)]
+
+    def calculate(self, org):
+        old_org = get_current_org()
+        set_current_org(org)
+        try:
+            return self._calculate()
+        finally:
+            set_current_org(old_org)
+
+    def get(self, org=None):
+        org = org or current_org
+        key = self.get_key(org.id)
+        value = cache.get(key)
+        if value is None:
+            value = self.calculate(org)
+            cache.set(key, value, self.CACHE_TIMEOUT)
+        return value
+
+    def set(self, org_id, value):
+        cache.set(self.get_key(org_id), value, self.CACHE_TIMEOUT)
+
+    def incr(self, org_id, delta=1):
+        keys = self.get_affected_keys(org_id)
+
+        def incr():
+            for key in keys:
+                try:
+                    cache.incr(key, delta)
+                except ValueError:
+                    # 没有缓存, 读取时再计算
+                    pass
+        transaction.on_commit(incr)
+
+    def expire(self, org_id):
+        keys = self.get_affected_keys(org_id)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+    @staticmethod
+    def get_all_orgs():
+        orgs = list(Organization.objects.all())
+        orgs.extend([Organization.default(), Organization.root()])
+        return orgs
+
+    def expire_all(self):
+        keys = [self.get_key(org.id) for org in self.get_all_orgs()]
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+    def reconcile(self):
+        for org in self.get_all_orgs():
+            self.set(org.id, self.calculate(org))
+
+    @classmethod
+    def reconcile_all(cls):
+        for counter in cls.counters.values():
+            counter.reconcile()
+
+
+def _count_assets():
+    from assets.models import Asset
+    return Asset.objects.all().count()
+
+
+def _count_disabled_assets():
+    from assets.models import Asset
+    return Asset.objects.filter(is_active=False).count()
+
+
+def _count_users():
+    return current_org.get_org_users().count()
+
+
+def _count_disabled_users():
+    return current_org.get_org_users().filter(is_active=False).count()
+
+
+def _count_online_sessions():
+    from terminal.models import Session
+    return Session.objects.filter(is_finished=False).count()
+
+
+def _count_online_users():
+    from terminal.models import Session
+    return Session.objects.filter(is_finished=False)\
+        .values('user').distinct().count()
+
+
+assets_amount_counter = OrgCounter('assets_amount', _count_assets)
+assets_disabled_counter = OrgCounter('assets_disabled', _count_disabled_assets)
+users_amount_counter = OrgCounter('users_amount', _count_users)
+users_disabled_counter = OrgCounter('users_disabled', _count_disabled_users)
+# 会话创建或结束时失效, 见 terminal.utils.expire_online_counters
+sessions_online_counter = OrgCounter('sessions_online', _count_online_sessions)
+users_online_counter = OrgCounter('users_online', _count_online_users)
@@ -6,6 +6,7 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 from .models import Organization
+from .counter import users_amount_counter, users_disabled_counter
 from .hands import set_current_org, current_org, Node
 from perms.models import AssetPermission
 from users.models import UserGroup
@@ -41,3 +42,11 @@ def on_org_user_changed(sender, instance=None, **kwargs):
                 for user_group in user_groups:
                     user_group.users.remove(user)
         set_current_org(old_org)
+
+
+@receiver(m2m_changed, sender=Organization.users.through)
+def on_org_user_changed_expire_counter(sender, action=None, **kwargs):
+    # 默认组织的用户是不属于任何组织的用户, 所以失效所有组织的计数
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        users_amount_counter.expire_all()
+        users_disabled_counter.expire_all()
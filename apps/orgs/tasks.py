@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+#
+from celery import shared_task
+
+from ops.celery.utils import register_as_period_task, after_app_ready_start, \
+    after_app_shutdown_clean
+from common.utils import get_logger
+from .counter import OrgCounter
+
+logger = get_logger(__file__)
+
+
+@shared_task
+@register_as_period_task(interval=1800)
+@after_app_ready_start
+@after_app_shutdown_clean
+def reconcile_org_counters():
+    """
+    重新计算各组织的计数, 修正信号遗漏或并发导致的误差
+    """
+    logger.info("Reconcile org counters")
+    OrgCounter.reconcile_all()
@@ -148,7 +148,7 @@ class UserGrantedNodeAssetsApi(RootOrgViewMixin, ListAPIView):
         util = AssetPermissionUtil(user)
         node = get_object_or_404(Node, id=node_id)
         nodes = util.get_nodes_with_assets()
-        assets = nodes.get(node, [])
+        assets = nodes.get(node, {})
         for asset, system_users in assets.items():
             asset.system_users_granted = system_users
         return assets
@@ -230,7 +230,7 @@ class UserGroupGrantedNodeAssetsApi(ListAPIView):
         node = get_object_or_404(Node, id=node_id)
         util = AssetPermissionUtil(user_group)
         nodes = util.get_nodes_with_assets()
-        assets = nodes.get(node, [])
+        assets = nodes.get(node, {})
         for asset, system_users in assets.items():
             asset.system_users_granted = system_users
         return assets
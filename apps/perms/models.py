@@ -74,6 +74,25 @@ class AssetPermission(OrgModelMixin):
         return assets
 
 
+class UserGrantedAsset(models.Model):
+    """
+    用户被授权的 资产-系统用户 物化结果, 由 perms.signals_handler 增量维护,
+    date_expired 取所有授予该关系的授权规则中最晚的过期时间
+    """
+    id = models.UUIDField(default=uuid.uuid4, primary_key=True)
+    user = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name='granted_assets_map', verbose_name=_("User"))
+    asset = models.ForeignKey('assets.Asset', on_delete=models.CASCADE, related_name='granted_users_map', verbose_name=_("Asset"))
+    system_user = models.ForeignKey('assets.SystemUser', on_delete=models.CASCADE, related_name='granted_users_map', verbose_name=_("System user"))
+    date_expired = models.DateTimeField(db_index=True, verbose_name=_('Date expired'))
+
+    class Meta:
+        unique_together = [('user', 'asset', 'system_user')]
+        verbose_name = _("User granted asset")
+
+    def __str__(self):
+        return "{}:{}:{}".format(self.user_id, self.asset_id, self.system_user_id)
+
+
 class NodePermission(OrgModelMixin):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     node = models.ForeignKey('assets.Node', on_delete=models.CASCADE, verbose_name=_("Node"))
@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 #
-from django.db.models.signals import m2m_changed
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, pre_save, \
+    pre_delete
 from django.dispatch import receiver
 
 from common.utils import get_logger
 from .models import AssetPermission
+from .hands import User, UserGroup, Asset, Node
+from .utils import get_permissions_users_id, get_nodes_related_permissions
+from .tasks import refresh_users_granted_assets
 
 
 logger = get_logger(__file__)
+REFRESH_GRANTED_ACTIONS = ('post_add', 'post_remove', 'pre_clear')
 
 
 @receiver(m2m_changed, sender=AssetPermission.nodes.through)
@@ -40,3 +46,121 @@ def on_permission_system_users_changed(sender, instance=None, **kwargs):
         for system_user in system_users:
             system_user.nodes.add(*tuple(nodes))
             system_user.assets.add(*tuple(assets))
+
+
+# 以下信号维护用户授权资产的物化结果, 见 perms.utils.refresh_user_granted_assets
+
+def refresh_users_granted_on_commit(users_id):
+    users_id = list(users_id)
+    if not users_id:
+        return
+    logger.debug("Refresh {} users granted assets on commit".format(len(users_id)))
+    transaction.on_commit(
+        lambda: refresh_users_granted_assets.delay(users_id)
+    )
+
+
+def get_users_id_of_groups(groups_id):
+    users_id = User.objects.filter(groups__id__in=groups_id)\
+        .values_list('id', flat=True)
+    return set(users_id)
+
+
+@receiver(m2m_changed, sender=AssetPermission.users.through)
+@receiver(m2m_changed, sender=AssetPermission.user_groups.through)
+@receiver(m2m_changed, sender=AssetPermission.assets.through)
+@receiver(m2m_changed, sender=AssetPermission.nodes.through)
+@receiver(m2m_changed, sender=AssetPermission.system_users.through)
+def on_permission_m2m_refresh_granted(sender, instance=None, **kwargs):
+    action = kwargs['action']
+    if action not in REFRESH_GRANTED_ACTIONS:
+        return
+    model = kwargs['model']
+    pk_set = kwargs['pk_set']
+
+    if isinstance(instance, AssetPermission):
+        if action == 'pre_clear' or model not in (User, UserGroup):
+            users_id = get_permissions_users_id([instance])
+        elif model is User:
+            users_id = set(pk_set)
+        else:
+            users_id = get_users_id_of_groups(pk_set)
+    else:
+        if action == 'pre_clear':
+            related_name = 'asset_permissions' \
+                if isinstance(instance, (User, UserGroup)) \
+                else 'granted_by_permissions'
+            permissions = getattr(instance, related_name).all()
+        else:
+            permissions = AssetPermission.objects.filter(pk__in=pk_set)
+        users_id = get_permissions_users_id(permissions)
+        if isinstance(instance, User):
+            users_id.add(instance.id)
+        elif isinstance(instance, UserGroup):
+            users_id.update(get_users_id_of_groups([instance.id]))
+    refresh_users_granted_on_commit(users_id)
+
+
+@receiver(post_save, sender=AssetPermission)
+def on_permission_update(sender, instance=None, created=False, **kwargs):
+    # 新建的授权规则还没有关联关系, 由 m2m 信号处理
+    if instance and not created:
+        users_id = get_permissions_users_id([instance])
+        refresh_users_granted_on_commit(users_id)
+
+
+@receiver(pre_delete, sender=AssetPermission)
+def on_permission_delete(sender, instance=None, **kwargs):
+    users_id = get_permissions_users_id([instance])
+    refresh_users_granted_on_commit(users_id)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def on_user_groups_refresh_granted(sender, instance=None, **kwargs):
+    action = kwargs['action']
+    if action not in REFRESH_GRANTED_ACTIONS:
+        return
+    if isinstance(instance, User):
+        users_id = {instance.id}
+    elif action == 'pre_clear':
+        users_id = get_users_id_of_groups([instance.id])
+    else:
+        users_id = kwargs['pk_set']
+    refresh_users_granted_on_commit(users_id)
+
+
+@receiver(m2m_changed, sender=Asset.nodes.through)
+def on_asset_nodes_refresh_granted(sender, instance=None, **kwargs):
+    action = kwargs['action']
+    if action not in REFRESH_GRANTED_ACTIONS:
+        return
+    if isinstance(instance, Node):
+        nodes = [instance]
+    elif action == 'pre_clear':
+        nodes = instance.nodes.all()
+    else:
+        nodes = Node.objects.filter(pk__in=kwargs['pk_set'])
+    permissions = get_nodes_related_permissions(nodes)
+    refresh_users_granted_on_commit(get_permissions_users_id(permissions))
+
+
+@receiver(pre_save, sender=Node)
+def on_node_pre_save_record_key(sender, instance=None, **kwargs):
+    instance._old_key = Node.objects.filter(pk=instance.pk)\
+        .values_list('key', flat=True).first()
+
+
+@receiver(post_save, sender=Node)
+def on_node_key_changed_refresh_granted(sender, instance=None, created=False, **kwargs):
+    old_key = getattr(instance, '_old_key', None)
+    if created or not old_key or old_key == instance.key:
+        return
+    nodes = [instance, Node(key=old_key)]
+    permissions = get_nodes_related_permissions(nodes)
+    refresh_users_granted_on_commit(get_permissions_users_id(permissions))
+
+
+@receiver(pre_delete, sender=Node)
+def on_node_delete_refresh_granted(sender, instance=None, **kwargs):
+    permissions = get_nodes_related_permissions([instance])
+    refresh_users_granted_on_commit(get_permissions_users_id(permissions))
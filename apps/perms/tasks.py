@@ -1,10 +1,49 @@
 # ~*~ coding: utf-8 ~*~
 from __future__ import absolute_import, unicode_literals
 
+import datetime
+
 from celery import shared_task
+from django.core.cache import cache
+from django.utils import timezone
+
 from common.utils import get_logger, encrypt_password
+from orgs.utils import set_to_root_org
+from ops.celery.utils import register_as_period_task, after_app_ready_start, \
+    after_app_shutdown_clean
+from .models import AssetPermission
+from .hands import User
 
 logger = get_logger(__file__)
 
+PERMISSION_START_CHECK_CACHE_KEY = '_PERMS_LAST_START_CHECK'
+
+
+@shared_task
+def refresh_users_granted_assets(users_id):
+    from .utils import refresh_user_granted_assets
+    for user in User.objects.filter(id__in=users_id):
+        refresh_user_granted_assets(user)
 
 
+@shared_task
+@register_as_period_task(interval=300)
+@after_app_ready_start
+@after_app_shutdown_clean
+def refresh_started_permissions_period():
+    """
+    授权规则到达开始时间后才会生效, 这里刷新期间内开始生效的授权规则的用户
+    过期的授权在查询时根据 date_expired 过滤, 不需要刷新
+    """
+    from .utils import get_permissions_users_id
+    set_to_root_org()
+    now = timezone.now()
+    last_check = cache.get(PERMISSION_START_CHECK_CACHE_KEY) or \
+        now - datetime.timedelta(seconds=600)
+    permissions = AssetPermission.objects.filter(
+        date_start__gt=last_check, date_start__lte=now
+    )
+    users_id = get_permissions_users_id(permissions)
+    if users_id:
+        refresh_users_granted_assets(users_id)
+    cache.set(PERMISSION_START_CHECK_CACHE_KEY, now, None)
@@ -2,31 +2,33 @@
 
 from __future__ import absolute_import, unicode_literals
 from collections import defaultdict
+from django.db import transaction, IntegrityError
 from django.db.models import Q
+from django.core.cache import cache
+from django.utils import timezone
 
-from common.utils import get_logger
-from .models import AssetPermission
-from .hands import Node
+from common.utils import get_logger, get_redis_client
+from orgs.utils import set_to_root_org, get_current_org, set_current_org
+from .models import AssetPermission, UserGrantedAsset
+from .hands import Node, User
 
 logger = get_logger(__file__)
 
+USER_GRANTED_BUILT_CACHE_KEY = '_PERMS_USER_GRANTED_BUILT_{}'
+USER_GRANTED_REFRESH_LOCK_KEY = '_PERMS_USER_GRANTED_REFRESH_LOCK_{}'
+USER_GRANTED_REFRESH_LOCK_TIMEOUT = 300
+USER_GRANTED_REFRESH_LOCK_WAIT = 60
+
 
 class Tree:
+    """
+    根据授权的资产构建节点树, 资产需要 prefetch_related('nodes')
+    """
     def __init__(self):
-        self.__all_nodes = Node.objects.all().prefetch_related('assets')
-        self.__node_asset_map = defaultdict(set)
         self.nodes = defaultdict(dict)
-        self.root = Node.root()
-        self.init_node_asset_map()
-
-    def init_node_asset_map(self):
-        for node in self.__all_nodes:
-            assets = [a.id for a in node.assets.all()]
-            for asset in assets:
-                self.__node_asset_map[str(asset)].add(node)
 
     def add_asset(self, asset, system_users):
-        nodes = self.__node_asset_map.get(str(asset.id), [])
+        nodes = asset.nodes.all()
         self.add_nodes(nodes)
         for node in nodes:
             self.nodes[node][asset].update(system_users)
@@ -34,20 +36,24 @@ class Tree:
     def add_node(self, node):
         if node in self.nodes:
             return
-        else:
-            self.nodes[node] = defaultdict(set)
-        if node.key == self.root.key:
-            return
-        parent_key = ':'.join(node.key.split(':')[:-1])
-        for n in self.__all_nodes:
-            if n.key == parent_key:
-                self.add_node(n)
-                break
+        self.nodes[node] = defaultdict(set)
 
     def add_nodes(self, nodes):
         for node in nodes:
             self.add_node(node)
 
+    def add_ancestors(self):
+        """
+        一次查询补全所有节点的祖先节点
+        """
+        ancestor_keys = set()
+        for node in self.nodes:
+            ancestor_keys.update(node.get_ancestor_keys())
+        ancestor_keys -= {node.key for node in self.nodes}
+        if not ancestor_keys:
+            return
+        self.add_nodes(Node.objects.filter(key__in=ancestor_keys))
+
 
 def get_user_permissions(user, include_group=True):
     if include_group:
@@ -83,6 +89,137 @@ def get_system_user_permissions(system_user):
     )
 
 
+def get_permissions_users_id(permissions):
+    """
+    授权规则直接关联的用户和用户组中的用户
+    """
+    users_id = User.objects.filter(
+        Q(asset_permissions__in=permissions) |
+        Q(groups__asset_permissions__in=permissions)
+    ).values_list('id', flat=True)
+    return set(users_id)
+
+
+def get_nodes_related_permissions(nodes):
+    """
+    节点及其祖先节点上的授权规则, 节点下资产变化会影响这些规则
+    """
+    ancestor_keys = set()
+    for node in nodes:
+        ancestor_keys.update(node.get_ancestor_keys(with_self=True))
+    return AssetPermission.objects.filter(nodes__key__in=ancestor_keys)
+
+
+def calculate_user_granted_assets(user):
+    """
+    计算用户被授权的 资产-系统用户 关系
+    :return: {(asset_id, system_user_id): date_expired}
+    """
+    granted = {}
+    permissions = get_user_permissions(user).prefetch_related(
+        'assets', 'nodes', 'system_users'
+    )
+    for perm in permissions:
+        assets_id = {asset.id for asset in perm.assets.all()}
+        for node in perm.nodes.all():
+            assets_id.update(node.get_all_assets().values_list('id', flat=True))
+        system_users_id = [s.id for s in perm.system_users.all()]
+        for asset_id in assets_id:
+            for system_user_id in system_users_id:
+                key = (asset_id, system_user_id)
+                date_expired = granted.get(key)
+                if date_expired is None or date_expired < perm.date_expired:
+                    granted[key] = perm.date_expired
+    return granted
+
+
+def refresh_user_granted_assets(user):
+    """
+    重新计算用户的授权, 与已物化的结果做差量更新
+    celery 任务和请求中的同步刷新可能同时刷新同一个用户, 使用 redis 锁串行执行
+    """
+    lock = get_redis_client().lock(
+        USER_GRANTED_REFRESH_LOCK_KEY.format(user.id),
+        timeout=USER_GRANTED_REFRESH_LOCK_TIMEOUT,
+        blocking_timeout=USER_GRANTED_REFRESH_LOCK_WAIT,
+    )
+    locked = lock.acquire()
+    if not locked:
+        logger.warn("Wait refresh user granted assets lock timeout: {}".format(user))
+    try:
+        _current_org = get_current_org()
+        set_to_root_org()
+        try:
+            granted = calculate_user_granted_assets(user)
+        finally:
+            set_current_org(_current_org)
+        try:
+            created, deleted = update_user_granted_assets(user, dict(granted))
+        except IntegrityError:
+            # 锁超时后其他刷新写入了相同的记录, 重新比较后再更新
+            created, deleted = update_user_granted_assets(user, dict(granted))
+        cache.set(USER_GRANTED_BUILT_CACHE_KEY.format(user.id), timezone.now(), None)
+    finally:
+        if locked:
+            try:
+                lock.release()
+            except Exception as e:
+                logger.warn("Release user granted assets lock error: {}".format(e))
+    logger.debug("Refresh user granted assets: {}, created {}, deleted {}".format(
+        user, created, deleted
+    ))
+
+
+def update_user_granted_assets(user, granted):
+    """
+    :param granted: {(asset_id, system_user_id): date_expired}
+    :return: (created, deleted)
+    """
+    with transaction.atomic():
+        existed = UserGrantedAsset.objects.filter(user=user).values_list(
+            'id', 'asset_id', 'system_user_id', 'date_expired'
+        )
+        to_delete = []
+        to_update = defaultdict(list)
+        for pk, asset_id, system_user_id, date_expired in existed:
+            key = (asset_id, system_user_id)
+            if key not in granted:
+                to_delete.append(pk)
+                continue
+            new_date_expired = granted.pop(key)
+            if new_date_expired != date_expired:
+                to_update[new_date_expired].append(pk)
+        if to_delete:
+            UserGrantedAsset.objects.filter(id__in=to_delete).delete()
+        for date_expired, pks in to_update.items():
+            UserGrantedAsset.objects.filter(id__in=pks)\
+                .update(date_expired=date_expired)
+        UserGrantedAsset.objects.bulk_create([
+            UserGrantedAsset(
+                user=user, asset_id=asset_id, system_user_id=system_user_id,
+                date_expired=date_expired
+            )
+            for (asset_id, system_user_id), date_expired in granted.items()
+        ], batch_size=1000)
+    return len(granted), len(to_delete)
+
+
+def get_user_granted_assets(user):
+    """
+    从物化结果中获取用户授权的资产, 没有构建过时先构建
+    :return: {asset1: set(system_user1,)}
+    """
+    if not cache.get(USER_GRANTED_BUILT_CACHE_KEY.format(user.id)):
+        refresh_user_granted_assets(user)
+    assets = defaultdict(set)
+    queryset = UserGrantedAsset.objects.filter(
+        user=user, date_expired__gt=timezone.now(), asset__is_active=True,
+    ).select_related('asset', 'system_user').prefetch_related('asset__nodes')
+    for granted in queryset:
+        assets[granted.asset].add(granted.system_user)
+    return assets
+
+
 class AssetPermissionUtil:
     get_permissions_map = {
         "User": get_user_permissions,
@@ -92,8 +229,9 @@ class AssetPermissionUtil:
         "SystemUser": get_node_permissions,
     }
 
-    def __init__(self, obj):
+    def __init__(self, obj, use_granted_map=True):
         self.object = obj
+        self.use_granted_map = use_granted_map
         self._permissions = None
         self._assets = None
 
@@ -134,6 +272,9 @@ class AssetPermissionUtil:
     def get_assets(self):
         if self._assets:
             return self._assets
+        if self.use_granted_map and isinstance(self.object, User):
+            self._assets = get_user_granted_assets(self.object)
+            return self._assets
         assets = self.get_assets_direct()
         nodes = self.get_nodes_direct()
         for node, system_users in nodes.items():
@@ -153,6 +294,7 @@ class AssetPermissionUtil:
         tree = Tree()
         for asset, system_users in assets.items():
             tree.add_asset(asset, system_users)
+        tree.add_ancestors()
         return tree.nodes
 
 
@@ -3,19 +3,22 @@
 from collections import OrderedDict
 import logging
 import os
+import re
 import uuid
 
 from django.core.cache import cache
 from django.shortcuts import get_object_or_404, redirect
+from django.urls import reverse
 from django.utils import timezone
 from django.core.files.storage import default_storage
 from django.http.response import HttpResponseRedirectBase
 from django.http import HttpResponseNotFound
 from django.conf import settings
-
-import jms_storage
+from django.db import transaction
 
 from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 from rest_framework import viewsets
 from rest_framework.views import APIView, Response
 from rest_framework.permissions import AllowAny
@@ -23,12 +26,20 @@ from rest_framework_bulk import BulkModelViewSet
 
 from common.utils import get_object_or_none, is_uuid
 from .hands import SystemUser
-from .models import Terminal, Status, Session, Task
+from .models import Terminal, Status, Session, Task, StatusRollup
 from .serializers import TerminalSerializer, StatusSerializer, \
     SessionSerializer, TaskSerializer, ReplaySerializer
-from common.permissions import IsAppUser, IsOrgAdminOrAppUser
+from common.permissions import IsAppUser, IsOrgAdminOrAppUser, IsOrgAdmin
 from .backends import get_command_storage, get_multi_command_storage, \
     SessionCommandSerializer
+from .backends.command.queue import CommandQueue
+from .backends.task import TaskChannel
+from .backends.replay import ReplayCache, ranged_file_response, \
+    following_file_response
+from .tasks import flush_command_queue, push_session_replay
+from .const import REPLAY_LOCAL_PATH_CACHE_KEY
+from .utils import reconcile_terminal_sessions, parse_date_param, \
+    paginate_sessions
 
 logger = logging.getLogger(__file__)
 
@@ -114,48 +125,24 @@ class StatusViewSet(viewsets.ModelViewSet):
         if not from_gua:
             self.handle_sessions()
         super().create(request, *args, **kwargs)
-        tasks = self.request.user.terminal.task_set.filter(is_finished=False)
+        return Response(self.get_pending_tasks(), status=201)
+
+    def get_pending_tasks(self):
+        """
+        任务通过 TaskChannel 推送, 只有定期检查时才查询数据库中未完成的任务
+        """
+        terminal = self.request.user.terminal
+        channel = TaskChannel(terminal.id)
+        if not channel.need_check_db():
+            return channel.pop_all()
+        channel.pop_all()
+        tasks = terminal.task_set.filter(is_finished=False)
         serializer = self.task_serializer_class(tasks, many=True)
-        return Response(serializer.data, status=201)
+        return serializer.data
 
     def handle_sessions(self):
-        sessions_active = []
-        for session_data in self.request.data.get("sessions", []):
-            self.create_or_update_session(session_data)
-            if not session_data["is_finished"]:
-                sessions_active.append(session_data["id"])
-
-        sessions_in_db_active = Session.objects.filter(
-            is_finished=False,
-            terminal=self.request.user.terminal.id
-        )
-
-        for session in sessions_in_db_active:
-            if str(session.id) not in sessions_active:
-                session.is_finished = True
-                session.date_end = timezone.now()
-                session.save()
-
-    def create_or_update_session(self, session_data):
-        session_data["terminal"] = self.request.user.terminal.id
-        _id = session_data["id"]
-        session = get_object_or_none(Session, id=_id)
-        if session:
-            serializer = SessionSerializer(
-                data=session_data, instance=session
-            )
-        else:
-            serializer = SessionSerializer(data=session_data)
-
-        if serializer.is_valid():
-            session = serializer.save()
-            return session
-        else:
-            msg = "session data is not valid {}: {}".format(
-                serializer.errors, str(serializer.data)
-            )
-            logger.error(msg)
-            return None
+        sessions = self.request.data.get("sessions", [])
+        reconcile_terminal_sessions(self.request.user.terminal, sessions)
 
     def get_queryset(self):
         terminal_id = self.kwargs.get("terminal", None)
@@ -165,8 +152,8 @@ class StatusViewSet(viewsets.ModelViewSet):
         return self.queryset
 
     def perform_create(self, serializer):
-        serializer.validated_data["terminal"] = self.request.user.terminal
-        return super().perform_create(serializer)
+        # 不再保存每次心跳的完整状态, 只记录最新状态和汇总数据
+        StatusRollup.record(self.request.user.terminal, serializer.validated_data)
 
     def get_permissions(self):
         if self.action == "create":
@@ -174,10 +161,92 @@ class StatusViewSet(viewsets.ModelViewSet):
         return super().get_permissions()
 
 
+class TerminalStatusTrendApi(APIView):
+    """
+    终端状态趋势, period: 1m/1h/1d, 默认 1h
+    """
+    permission_classes = (IsOrgAdmin,)
+    default_ranges = {
+        StatusRollup.PERIOD_MINUTE: timezone.timedelta(hours=1),
+        StatusRollup.PERIOD_HOUR: timezone.timedelta(days=1),
+        StatusRollup.PERIOD_DAY: timezone.timedelta(days=30),
+    }
+
+    def get(self, request, *args, **kwargs):
+        terminal = get_object_or_404(Terminal, id=kwargs.get('terminal'))
+        period = request.query_params.get('period', StatusRollup.PERIOD_HOUR)
+        if period not in self.default_ranges:
+            return Response({"msg": "Period not valid"}, status=400)
+        date_from = timezone.now() - self.default_ranges[period]
+        date_from_s = request.query_params.get('date_from')
+        if date_from_s:
+            try:
+                date_from = timezone.datetime.fromtimestamp(
+                    float(date_from_s), tz=timezone.utc
+                )
+            except ValueError:
+                return Response({"msg": "Date from not valid"}, status=400)
+        rollups = StatusRollup.objects.filter(
+            terminal=terminal, period=period, date_start__gte=date_from
+        )
+        data = {
+            'latest': StatusRollup.get_latest(terminal),
+            'trend': [rollup.to_dict() for rollup in rollups],
+        }
+        return Response(data)
+
+
+class SessionPagination(LimitOffsetPagination):
+    """
+    按 (date_start, id) 游标分页, 不统计总数, 翻到多少页耗时都一样,
+    传入 offset 时兼容原来的分页
+    """
+    default_limit = 100
+    max_limit = 1000
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    use_cursor = False
+    next_cursor = previous_cursor = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if self.offset_query_param in params:
+            return super().paginate_queryset(queryset, request, view=view)
+        if self.limit_query_param not in params and \
+                self.cursor_query_param not in params:
+            return None
+        self.use_cursor = True
+        self.request = request
+        self.limit = self.get_limit(request) or self.default_limit
+        try:
+            sessions, self.next_cursor, self.previous_cursor = paginate_sessions(
+                queryset, params.get(self.cursor_query_param), self.limit
+            )
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        return sessions
+
+    def get_cursor_link(self, cursor):
+        if not cursor:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        if not self.use_cursor:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_cursor_link(self.next_cursor)),
+            ('previous', self.get_cursor_link(self.previous_cursor)),
+            ('results', data)
+        ]))
+
+
 class SessionViewSet(BulkModelViewSet):
     queryset = Session.objects.all()
     serializer_class = SessionSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = SessionPagination
     permission_classes = (IsOrgAdminOrAppUser,)
 
     def get_queryset(self):
@@ -185,7 +254,31 @@ class SessionViewSet(BulkModelViewSet):
         if terminal_id:
             terminal = get_object_or_404(Terminal, id=terminal_id)
             self.queryset = terminal.session_set.all()
-        return self.queryset.all()
+        queryset = self.queryset.all()
+        if self.action == 'list':
+            queryset = queryset.filter(**self.get_filter_kwargs())
+        return queryset
+
+    def get_filter_kwargs(self):
+        """
+        过滤条件下推到数据库, 配合 (user|asset|system_user, date_start) 索引
+        """
+        params = self.request.query_params
+        filter_kwargs = {}
+        date_from = parse_date_param(params.get('date_from'))
+        date_to = parse_date_param(params.get('date_to'), end_of_day=True)
+        if date_from:
+            filter_kwargs['date_start__gte'] = date_from
+        if date_to:
+            filter_kwargs['date_start__lte'] = date_to
+        for field in ('user', 'asset', 'system_user'):
+            value = params.get(field)
+            if value:
+                filter_kwargs[field] = value
+        is_finished = params.get('is_finished')
+        if is_finished in ('0', '1', 'true', 'false'):
+            filter_kwargs['is_finished'] = is_finished in ('1', 'true')
+        return filter_kwargs
 
     def perform_create(self, serializer):
         if hasattr(self.request.user, 'terminal'):
@@ -203,24 +296,54 @@ class TaskViewSet(BulkModelViewSet):
     serializer_class = TaskSerializer
     permission_classes = (IsOrgAdminOrAppUser,)
 
+    def perform_create(self, serializer):
+        tasks = serializer.save()
+        if not isinstance(tasks, list):
+            tasks = [tasks]
+        TaskChannel.push_tasks(tasks)
+
+
+class TaskPollApi(APIView):
+    """
+    终端长轮询获取任务, 有新任务时立即返回, 否则等待 timeout 秒后返回空列表
+    """
+    permission_classes = (IsAppUser,)
+
+    def get(self, request, *args, **kwargs):
+        timeout = request.query_params.get('timeout', settings.TASK_POLL_MAX_TIMEOUT)
+        try:
+            timeout = int(timeout)
+        except ValueError:
+            return Response({"msg": "Timeout not valid"}, status=400)
+        channel = TaskChannel(request.user.terminal.id)
+        return Response(channel.poll(timeout))
+
 
 class KillSessionAPI(APIView):
     permission_classes = (IsOrgAdminOrAppUser,)
     model = Task
 
     def post(self, request, *args, **kwargs):
-        validated_session = []
-        for session_id in request.data:
-            session = get_object_or_none(Session, id=session_id)
-            if session and not session.is_finished:
-                validated_session.append(session_id)
-                self.model.objects.create(
-                    name="kill_session", args=session.id,
-                    terminal=session.terminal,
-                )
+        sessions_id = [i for i in request.data if is_uuid(str(i))]
+        sessions = Session.objects.filter(id__in=sessions_id, is_finished=False)
+        tasks = [
+            self.model(
+                name="kill_session", args=session.id,
+                terminal_id=session.terminal_id,
+            )
+            for session in sessions
+        ]
+        self.model.objects.bulk_create(tasks)
+        TaskChannel.push_tasks(tasks)
+        validated_session = [str(session.id) for session in sessions]
         return Response({"ok": validated_session})
 
 
+class CommandPagination(LimitOffsetPagination):
+    default_limit = 100
+    max_limit = 1000
+
+
 class CommandViewSet(viewsets.ViewSet):
     """接受app发送来的command log, 格式如下
     {
@@ -237,12 +360,31 @@ class CommandViewSet(viewsets.ViewSet):
     command_store = get_command_storage()
     multi_command_storage = get_multi_command_storage()
     serializer_class = SessionCommandSerializer
+    pagination_class = CommandPagination
     permission_classes = (IsOrgAdminOrAppUser,)
 
     def get_queryset(self):
-        self.command_store.filter(**dict(self.request.query_params))
+        return self.multi_command_storage.filter(**self.get_filter_kwargs())
+
+    def get_filter_kwargs(self):
+        """
+        过滤条件直接下推到每个命令存储, 翻页时可以把上一页最后一条的
+        timestamp 作为 date_to 传入, 避免 offset 过大
+        """
+        params = self.request.query_params
+        filter_kwargs = {
+            'date_from': parse_date_param(params.get('date_from')),
+            'date_to': parse_date_param(params.get('date_to'), end_of_day=True),
+        }
+        for field in ('user', 'asset', 'system_user', 'session', 'input'):
+            value = params.get(field)
+            if value:
+                filter_kwargs[field] = value
+        return filter_kwargs
 
     def create(self, request, *args, **kwargs):
+        if settings.COMMAND_INGEST_MODE == 'queue':
+            return self.create_to_queue(request)
         serializer = self.serializer_class(data=request.data, many=True)
         if serializer.is_valid():
             ok = self.command_store.bulk_save(serializer.validated_data)
@@ -255,10 +397,43 @@ class CommandViewSet(viewsets.ViewSet):
             logger.error(msg)
             return Response({"msg": msg}, status=401)
 
+    @staticmethod
+    def create_to_queue(request):
+        """
+        写入 redis 队列后立即返回, 由 celery 批量写入存储
+        队列满时返回 429, 终端会保留命令稍后重试
+        """
+        commands, err = CommandQueue.validate(request.data)
+        if err:
+            msg = "Command not valid: {}".format(err)
+            logger.error(msg)
+            return Response({"msg": msg}, status=401)
+        queue = CommandQueue()
+        if queue.is_full():
+            logger.error("Command queue is full")
+            return Response({"msg": "Command queue is full"}, status=429)
+        size = queue.push(commands)
+        if size >= settings.COMMAND_INGEST_BATCH_SIZE and \
+                cache.add('_TERMINAL_COMMAND_QUEUE_FLUSH_TRIGGERED', 1, 5):
+            flush_command_queue.delay()
+        return Response("ok", status=201)
+
     def list(self, request, *args, **kwargs):
-        queryset = self.multi_command_storage.filter()
-        serializer = self.serializer_class(queryset, many=True)
-        return Response(serializer.data)
+        queryset = self.get_queryset()
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = self.serializer_class(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class CommandQueueStatusApi(APIView):
+    """
+    命令写入队列的积压数量和写入耗时
+    """
+    permission_classes = (IsOrgAdmin,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(CommandQueue().get_metrics())
 
 
 class SessionReplayViewSet(viewsets.ViewSet):
@@ -307,6 +482,7 @@ class SessionReplayViewSet(viewsets.ViewSet):
                 msg = "Failed save replay `{}`: {}".format(session_id, err)
                 logger.error(msg)
                 return Response({'msg': str(err)}, status=400)
+            self.on_replay_saved(name)
             url = default_storage.url(name)
             return Response({'url': url}, status=201)
         else:
@@ -314,37 +490,159 @@ class SessionReplayViewSet(viewsets.ViewSet):
             logger.error(msg)
             return Response({'msg': serializer.errors}, status=401)
 
-    def retrieve(self, request, *args, **kwargs):
-        session_id = kwargs.get('pk')
-        self.session = get_object_or_404(Session, id=session_id)
-
+    def get_local_replay_path(self):
+        """
+        查找保存在 default storage 中的录像, 找到的路径缓存一段时间, 避免重复检查
+        """
+        key = REPLAY_LOCAL_PATH_CACHE_KEY.format(self.session.id)
+        path = cache.get(key)
+        if path:
+            return path
         # 新版本和老版本的文件后缀不同
         session_path = self.get_session_path()  # 存在外部存储上的路径
         local_path = self.get_local_path()
         local_path_v1 = self.get_local_path(version=1)
-
-        # 去default storage中查找
         for _local_path in (local_path, local_path_v1, session_path):
             if default_storage.exists(_local_path):
-                url = default_storage.url(_local_path)
-                return redirect(url)
+                cache.set(key, _local_path, 3600)
+                return _local_path
+        return None
+
+    def on_replay_saved(self, name):
+        """
+        录像保存到本地后即可播放, 后台推送到终端配置的录像存储
+        """
+        cache.delete(REPLAY_LOCAL_PATH_CACHE_KEY.format(self.session.id))
+        session_id = str(self.session.id)
+        Session._base_manager.filter(id=session_id).update(has_replay=True)
+        transaction.on_commit(lambda: push_session_replay.delay(session_id, name))
 
-        # 去定义的外部storage查找
+    @staticmethod
+    def get_external_storage_configs():
         configs = settings.TERMINAL_REPLAY_STORAGE
-        configs = {k: v for k, v in configs.items() if v['TYPE'] != 'server'}
+        return {k: v for k, v in configs.items() if v['TYPE'] != 'server'}
+
+    def retrieve(self, request, *args, **kwargs):
+        session_id = kwargs.get('pk')
+        self.session = get_object_or_404(Session, id=session_id)
+
+        # 去default storage中查找
+        local_path = self.get_local_replay_path()
+        if local_path:
+            return redirect(default_storage.url(local_path))
+
+        # 去定义的外部storage查找, 已缓存的直接返回, 否则后台下载并边下载边返回
+        configs = self.get_external_storage_configs()
         if not configs:
             return HttpResponseNotFound()
+        replay_cache = ReplayCache(self.get_session_path())
+        if replay_cache.exists():
+            replay_cache.touch()
+            return redirect(replay_cache.url)
+        replay_cache.start_download(configs)
+        url = reverse('api-terminal:session-replay-download', kwargs={'pk': session_id})
+        return redirect(url)
+
+
+class SessionReplayDownloadViewSet(SessionReplayViewSet):
+    """
+    返回录像文件内容, 支持 HTTP Range, 外部存储的录像在下载过程中即可读取
+    """
+
+    def retrieve(self, request, *args, **kwargs):
+        session_id = kwargs.get('pk')
+        self.session = get_object_or_404(Session, id=session_id)
+
+        local_path = self.get_local_replay_path()
+        if local_path:
+            return ranged_file_response(request, default_storage.path(local_path))
 
-        target_path = os.path.join(default_storage.base_location, local_path)   # 保存到storage的路径
-        target_dir = os.path.dirname(target_path)
-        if not os.path.isdir(target_dir):
-            os.makedirs(target_dir, exist_ok=True)
-        storage = jms_storage.get_multi_object_storage(configs)
-        ok, err = storage.download(session_path, target_path)
-        if not ok:
-            logger.error("Failed download replay file: {}".format(err))
+        configs = self.get_external_storage_configs()
+        if not configs:
             return HttpResponseNotFound()
-        return redirect(default_storage.url(local_path))
+        replay_cache = ReplayCache(self.get_session_path())
+        if replay_cache.exists():
+            replay_cache.touch()
+            return ranged_file_response(request, replay_cache.path)
+        replay_cache.start_download(configs)
+        return following_file_response(replay_cache, configs)
+
+
+class SessionReplayChunkViewSet(SessionReplayViewSet):
+    """
+    分块上传录像, 可断点续传
+    GET: 返回已上传的大小, 客户端从该位置继续上传
+    PUT: 请求体为分块内容, Content-Range: bytes start-end/total,
+         最后一块上传完成后保存录像
+    """
+    UPLOAD_DIR = 'replay_upload'
+    UPLOAD_LOCK_KEY = '_TERMINAL_REPLAY_UPLOAD_{}'
+    CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+    CHUNK_SIZE = 64 * 1024
+
+    def get_part_path(self):
+        filename = str(self.session.id) + '.replay.gz.part'
+        return default_storage.path(os.path.join(self.UPLOAD_DIR, filename))
+
+    def get_uploaded_size(self):
+        try:
+            return os.path.getsize(self.get_part_path())
+        except OSError:
+            return 0
+
+    def retrieve(self, request, *args, **kwargs):
+        self.session = get_object_or_404(Session, id=kwargs.get('pk'))
+        return Response({'offset': self.get_uploaded_size()})
+
+    def write_chunk(self, request, start, length):
+        part_path = self.get_part_path()
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        mode = 'r+b' if os.path.exists(part_path) else 'wb'
+        with open(part_path, mode) as f:
+            f.seek(start)
+            while length > 0:
+                chunk = request.stream.read(min(self.CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                f.write(chunk)
+                length -= len(chunk)
+        return length == 0
+
+    def save_uploaded(self):
+        part_path = self.get_part_path()
+        local_path = self.get_local_path()
+        target_path = default_storage.path(local_path)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        os.replace(part_path, target_path)
+        return local_path
+
+    def update(self, request, *args, **kwargs):
+        session_id = kwargs.get('pk')
+        self.session = get_object_or_404(Session, id=session_id)
+        matched = self.CONTENT_RANGE_RE.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+        if not matched:
+            return Response({'msg': 'Content-Range not valid'}, status=400)
+        start, end, total = [int(i) for i in matched.groups()]
+        if start > end or end >= total:
+            return Response({'msg': 'Content-Range not valid'}, status=400)
+
+        lock_key = self.UPLOAD_LOCK_KEY.format(session_id)
+        if not cache.add(lock_key, 1, 600):
+            return Response({'msg': 'Replay is uploading'}, status=409)
+        try:
+            offset = self.get_uploaded_size()
+            # 只能从已上传的位置继续, 重传已上传的分块会覆盖
+            if start > offset:
+                return Response({'offset': offset}, status=409)
+            if not self.write_chunk(request, start, end - start + 1):
+                return Response({'offset': self.get_uploaded_size()}, status=400)
+            if end + 1 < total:
+                return Response({'offset': end + 1}, status=200)
+            name = self.save_uploaded()
+        finally:
+            cache.delete(lock_key)
+        self.on_replay_saved(name)
+        return Response({'url': default_storage.url(name)}, status=201)
 
 
 class SessionReplayV2ViewSet(SessionReplayViewSet):
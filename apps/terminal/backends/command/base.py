@@ -16,7 +16,10 @@ class CommandBase(object):
     @abc.abstractmethod
     def filter(self, date_from=None, date_to=None,
                user=None, asset=None, system_user=None,
-               input=None, session=None):
+               input=None, session=None, limit=None):
+        """
+        返回按 timestamp 倒序排列的命令, limit 为最多返回的数量
+        """
         pass
 
     @abc.abstractmethod
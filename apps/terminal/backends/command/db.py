@@ -4,6 +4,7 @@ import datetime
 from django.utils import timezone
 
 from .base import CommandBase
+from .ngram import CommandInputIndex
 
 
 class CommandStore(CommandBase):
@@ -11,18 +12,24 @@ class CommandStore(CommandBase):
     def __init__(self, params):
         from terminal.models import Command
         self.model = Command
+        self.input_index = CommandInputIndex()
 
     def save(self, command):
         """
         保存命令到数据库
         """
 
-        self.model.objects.create(
+        instance = self.model.objects.create(
             user=command["user"], asset=command["asset"],
             system_user=command["system_user"], input=command["input"],
             output=command["output"], session=command["session"],
             org_id=command["org_id"], timestamp=command["timestamp"]
         )
+        if self.input_index.is_enabled():
+            self.input_index.build([instance])
+        else:
+            self.input_index.clear_indexed_from()
+        return instance
 
     def bulk_save(self, commands):
         """
@@ -35,7 +42,12 @@ class CommandStore(CommandBase):
                 input=c["input"], output=c["output"], session=c["session"],
                 org_id=c["org_id"], timestamp=c["timestamp"]
             ))
-        return self.model.objects.bulk_create(_commands)
+        created = self.model.objects.bulk_create(_commands)
+        if self.input_index.is_enabled():
+            self.input_index.build(created)
+        else:
+            self.input_index.clear_indexed_from()
+        return created
 
     @staticmethod
     def make_filter_kwargs(
@@ -66,13 +78,17 @@ class CommandStore(CommandBase):
 
     def filter(self, date_from=None, date_to=None,
                user=None, asset=None, system_user=None,
-               input=None, session=None):
+               input=None, session=None, limit=None):
         filter_kwargs = self.make_filter_kwargs(
             date_from=date_from, date_to=date_to, user=user,
             asset=asset, system_user=system_user, input=input,
             session=session,
         )
-        queryset = self.model.objects.filter(**filter_kwargs)
+        queryset = self.model.objects.filter(**filter_kwargs)\
+            .order_by('-timestamp')
+        queryset = self.input_index.filter_queryset(queryset, filter_kwargs)
+        if limit is not None:
+            queryset = queryset[:limit]
         return queryset
 
     def count(self, date_from=None, date_to=None,
@@ -83,7 +99,9 @@ class CommandStore(CommandBase):
             asset=asset, system_user=system_user, input=input,
             session=session,
         )
-        count = self.model.objects.filter(**filter_kwargs).count()
+        queryset = self.model.objects.filter(**filter_kwargs)
+        queryset = self.input_index.filter_queryset(queryset, filter_kwargs)
+        count = queryset.count()
         return count
 
 
@@ -7,16 +7,35 @@ from .models import AbstractSessionCommand
 
 
 class CommandStore(ESStorage, CommandBase):
+    # ES 默认 from + size 不能超过 index.max_result_window
+    max_result_window = 10000
+
     def __init__(self, params):
         super().__init__(params)
 
     def filter(self, date_from=None, date_to=None,
                user=None, asset=None, system_user=None,
-               input=None, session=None):
+               input=None, session=None, limit=None):
+        match = {}
+        exact = {}
+
+        if user:
+            exact["user"] = user
+        if asset:
+            exact["asset"] = asset
+        if system_user:
+            exact["system_user"] = system_user
+
+        if session:
+            match["session"] = str(session)
+        if input:
+            match["input"] = input
 
-        data = super().filter(date_from=date_from, date_to=date_to,
-                              user=user, asset=asset, system_user=system_user,
-                              input=input, session=session)
+        body = self.get_query_body(match, exact, date_from, date_to)
+        if limit is None or limit > self.max_result_window:
+            limit = self.max_result_window
+        body["size"] = limit
+        data = self.es.search(index=self.index, doc_type=self.doc_type, body=body)
         return AbstractSessionCommand.from_multi_dict(
-            [item["_source"] for item in data["hits"] if item]
+            [item["_source"] for item in data["hits"]["hits"] if item]
         )
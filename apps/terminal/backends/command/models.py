@@ -43,3 +43,17 @@ class AbstractSessionCommand(OrgModelMixin):
 
     def __str__(self):
         return self.input
+
+
+class AbstractPartitionCommand(AbstractSessionCommand):
+    """
+    按时间分表的命令记录, 每张分表只在 session 和 timestamp 上建索引,
+    其它字段的过滤在时间范围裁剪后的分表中进行
+    """
+    user = models.CharField(max_length=64, verbose_name=_("User"))
+    asset = models.CharField(max_length=128, verbose_name=_("Asset"))
+    system_user = models.CharField(max_length=64, verbose_name=_("System user"))
+    input = models.CharField(max_length=128, verbose_name=_("Input"))
+
+    class Meta:
+        abstract = True
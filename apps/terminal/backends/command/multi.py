@@ -1,25 +1,119 @@
 # -*- coding: utf-8 -*-
 #
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
+from django.db import connections
+
+from orgs.utils import get_current_org, set_current_org
 from .base import CommandBase
 
 
+def _timestamp_key(command):
+    return command.timestamp
+
+
+class CommandQuerySet:
+    """
+    多个存储查询结果的懒加载合并, 支持 count 和切片, 可以直接给 Paginator 使用
+
+    切片时每个存储只查询 offset+limit 条 (按时间倒序), 并发查询后做 k 路归并
+    """
+    ordered = True
+
+    def __init__(self, store, **filter_kwargs):
+        self.store = store
+        self.filter_kwargs = filter_kwargs
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.store.count(**self.filter_kwargs)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return self.store.iter_merged(**self.filter_kwargs)
+
+    def __bool__(self):
+        return self.count() > 0
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step is not None:
+                raise ValueError("Step is not supported")
+            offset = item.start or 0
+            if item.stop is None:
+                return itertools.islice(iter(self), offset, None)
+            limit = max(item.stop - offset, 0)
+            return self.store.fetch(offset=offset, limit=limit, **self.filter_kwargs)
+        commands = self.store.fetch(offset=item, limit=1, **self.filter_kwargs)
+        if not commands:
+            raise IndexError("Command index out of range")
+        return commands[0]
+
+
 class CommandStore(CommandBase):
+    max_workers = 8
+
     def __init__(self, storage_list):
-        self.storage_list = storage_list
+        self.storage_list = list(storage_list)
 
-    def filter(self, **kwargs):
-        queryset = []
+    def _run_concurrently(self, func, *args, **kwargs):
+        """
+        每个存储在单独的线程中执行, 线程结束时关闭该线程打开的数据库连接
+        当前组织保存在 thread local 中, 需要传递给工作线程
+        """
+        org = get_current_org()
+
+        def run(storage):
+            set_current_org(org)
+            try:
+                return func(storage, *args, **kwargs)
+            finally:
+                connections.close_all()
+
+        if len(self.storage_list) == 1:
+            return [func(self.storage_list[0], *args, **kwargs)]
+        workers = min(len(self.storage_list), self.max_workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(run, self.storage_list))
 
+    @staticmethod
+    def _fetch_one(storage, limit=None, **kwargs):
+        return list(storage.filter(limit=limit, **kwargs))
+
+    def fetch(self, offset=0, limit=None, **kwargs):
+        """
+        每个存储最多取 offset+limit 条, 归并后跳过 offset 条
+        """
+        fetch_limit = offset + limit if limit is not None else None
+        results = self._run_concurrently(self._fetch_one, limit=fetch_limit, **kwargs)
+        merged = heapq.merge(*results, key=_timestamp_key, reverse=True)
+        stop = offset + limit if limit is not None else None
+        return list(itertools.islice(merged, offset, stop))
+
+    def iter_merged(self, **kwargs):
+        """
+        不限制数量时按存储各自的迭代器懒加载归并, 不把全部结果放到内存中
+        """
+        iterators = []
         for storage in self.storage_list:
-            queryset.extend(storage.filter(**kwargs))
-        return sorted(queryset, key=lambda command: command.timestamp, reverse=True)
+            commands = storage.filter(**kwargs)
+            if hasattr(commands, 'iterator'):
+                commands = commands.iterator()
+            iterators.append(iter(commands))
+        return heapq.merge(*iterators, key=_timestamp_key, reverse=True)
+
+    def filter(self, **kwargs):
+        return CommandQuerySet(self, **kwargs)
 
     def count(self, **kwargs):
-        amount = 0
-        for storage in self.storage_list:
-            amount += storage.count(**kwargs)
-        return amount
+        counts = self._run_concurrently(lambda storage: storage.count(**kwargs))
+        return sum(counts)
 
     def save(self, command):
         pass
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+
+class CommandInputIndex:
+    """
+    Command input 的 3-gram 倒排索引
+
+    查询时先用索引找出包含全部 3-gram 的命令, 再用 icontains 校验,
+    索引只覆盖 timestamp >= indexed_from 的命令, 更早的命令由
+    build_command_input_index 任务向前补建, 未覆盖的部分仍然使用 icontains
+    """
+    GRAM_SIZE = 3
+    INDEXED_FROM_KEY = '_TERMINAL_COMMAND_INPUT_INDEXED_FROM'
+
+    def __init__(self):
+        from terminal.models import Command, CommandInputGram
+        self.command_model = Command
+        self.model = CommandInputGram
+
+    @staticmethod
+    def is_enabled():
+        return bool(settings.COMMAND_INPUT_INDEX_ENABLED)
+
+    @classmethod
+    def make_grams(cls, text):
+        text = (text or '').lower()
+        size = cls.GRAM_SIZE
+        return {text[i:i+size] for i in range(len(text) - size + 1)}
+
+    def build(self, commands):
+        grams = []
+        for command in commands:
+            for gram in self.make_grams(command.input):
+                grams.append(self.model(
+                    gram=gram, command_id=command.id,
+                    timestamp=command.timestamp,
+                ))
+        self.model.objects.bulk_create(grams, batch_size=2000)
+
+    def rebuild(self, commands):
+        self.model.objects.filter(
+            command_id__in=[command.id for command in commands]
+        ).delete()
+        self.build(commands)
+
+    def get_indexed_from(self):
+        return cache.get(self.INDEXED_FROM_KEY)
+
+    def set_indexed_from(self, timestamp):
+        cache.set(self.INDEXED_FROM_KEY, timestamp, None)
+
+    @classmethod
+    def clear_indexed_from(cls):
+        """
+        索引关闭期间写入的命令没有建立索引, 清除 indexed_from,
+        再次开启后从开启时向前重新补建, 补建完成前这些命令仍然使用 icontains 查询
+        """
+        cache.delete(cls.INDEXED_FROM_KEY)
+
+    def filter_queryset(self, queryset, filter_kwargs):
+        """
+        :param filter_kwargs: db.CommandStore.make_filter_kwargs 的返回值
+        """
+        keyword = filter_kwargs.get('input__icontains')
+        if not self.is_enabled() or not keyword or len(keyword) < self.GRAM_SIZE:
+            return queryset
+        indexed_from = self.get_indexed_from()
+        timestamp_from = filter_kwargs['timestamp__gte']
+        timestamp_to = filter_kwargs['timestamp__lte']
+        if indexed_from is None or timestamp_to < indexed_from:
+            return queryset
+
+        grams = self.make_grams(keyword)
+        candidates = self.model.objects.filter(
+            gram__in=grams,
+            timestamp__gte=max(timestamp_from, indexed_from),
+            timestamp__lte=timestamp_to,
+        ).values('command_id').annotate(matched=Count('gram'))\
+            .filter(matched=len(grams)).values('command_id')
+        q = Q(id__in=candidates)
+        if timestamp_from < indexed_from:
+            q |= Q(timestamp__lt=indexed_from)
+        return queryset.filter(q)
+
+    def backfill(self, limit=10000, batch_size=1000):
+        """
+        从 indexed_from 开始按时间向前补建索引
+        :return: 本次建立索引的命令数量
+        """
+        indexed_from = self.get_indexed_from()
+        if indexed_from is None:
+            # 开启索引后写入的命令都会建立索引
+            indexed_from = int(time.time())
+            self.set_indexed_from(indexed_from)
+
+        manager = self.command_model._base_manager
+        indexed = 0
+        while indexed < limit and indexed_from > 0:
+            timestamps = manager.filter(timestamp__lt=indexed_from)\
+                .order_by('-timestamp')\
+                .values_list('timestamp', flat=True)[:batch_size]
+            timestamps = list(timestamps)
+            if len(timestamps) < batch_size:
+                timestamp_from = 0
+            else:
+                timestamp_from = timestamps[-1]
+            # 同一秒的命令在同一批中处理, 保证 indexed_from 之后的都已建立索引
+            commands = list(manager.filter(
+                timestamp__gte=timestamp_from, timestamp__lt=indexed_from
+            ).only('id', 'input', 'timestamp'))
+            self.rebuild(commands)
+            indexed += len(commands)
+            indexed_from = timestamp_from
+            self.set_indexed_from(indexed_from)
+        return indexed
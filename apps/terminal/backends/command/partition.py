@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+#
+import datetime
+import re
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, DatabaseError
+
+from common.utils import get_logger
+from .db import CommandStore as DBCommandStore
+from .models import AbstractPartitionCommand
+
+logger = get_logger(__file__)
+
+
+class PartitionRouter:
+    """
+    根据 timestamp 计算命令所在的分表, 时间按 UTC 计算
+    按月: terminal_command_201810, 按天: terminal_command_20181018
+    """
+    TABLE_PREFIX = 'terminal_command_'
+    TABLE_NAMES_REFRESH_INTERVAL = 60
+    FORMATS = {'month': '%Y%m', 'day': '%Y%m%d'}
+
+    _models = {}
+    _table_names = set()
+    _table_names_refresh_at = 0
+    _lock = threading.Lock()
+
+    def __init__(self, interval='month'):
+        if interval not in self.FORMATS:
+            raise ValueError("Partition interval must be one of {}".format(
+                ', '.join(self.FORMATS)
+            ))
+        self.interval = interval
+        self.format = self.FORMATS[interval]
+        digits = 6 if interval == 'month' else 8
+        self.pattern = re.compile(
+            r'^{}(\d{{{}}})$'.format(self.TABLE_PREFIX, digits)
+        )
+
+    def get_period_start(self, timestamp):
+        date = datetime.datetime.utcfromtimestamp(timestamp)
+        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.interval == 'month':
+            date = date.replace(day=1)
+        return date
+
+    def get_next_period(self, date):
+        if self.interval == 'month':
+            return (date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        return date + datetime.timedelta(days=1)
+
+    def get_prev_period(self, date):
+        if self.interval == 'month':
+            return (date.replace(day=1) - datetime.timedelta(days=1)).replace(day=1)
+        return date - datetime.timedelta(days=1)
+
+    def get_table_name_by_period(self, date):
+        return self.TABLE_PREFIX + date.strftime(self.format)
+
+    def get_table_name(self, timestamp):
+        return self.get_table_name_by_period(self.get_period_start(timestamp))
+
+    def parse_period(self, table_name):
+        matched = self.pattern.match(table_name)
+        if not matched:
+            return None
+        return datetime.datetime.strptime(matched.group(1), self.format)
+
+    def iter_table_names(self, timestamp_from, timestamp_to):
+        """
+        时间范围内的分表名, 从新到旧
+        """
+        date_from = self.get_period_start(timestamp_from)
+        date = self.get_period_start(timestamp_to)
+        while date >= date_from:
+            yield self.get_table_name_by_period(date)
+            date = self.get_prev_period(date)
+
+    def get_model(self, table_name):
+        model = self._models.get(table_name)
+        if model:
+            return model
+        with self._lock:
+            model = self._models.get(table_name)
+            if model:
+                return model
+            meta = type('Meta', (), {
+                'db_table': table_name,
+                'app_label': 'terminal',
+                'managed': False,
+                'ordering': ('-timestamp',),
+            })
+            model_name = 'PartitionCommand{}'.format(
+                table_name[len(self.TABLE_PREFIX):]
+            )
+            model = type(model_name, (AbstractPartitionCommand,), {
+                '__module__': __name__,
+                'Meta': meta,
+            })
+            self._models[table_name] = model
+        return model
+
+    def refresh_table_names(self, force=False):
+        cls = self.__class__
+        now = time.time()
+        if not force and now - cls._table_names_refresh_at < self.TABLE_NAMES_REFRESH_INTERVAL:
+            return
+        with connection.cursor() as cursor:
+            table_names = connection.introspection.table_names(cursor)
+        cls._table_names = {
+            name for name in table_names if name.startswith(self.TABLE_PREFIX)
+        }
+        cls._table_names_refresh_at = now
+
+    def table_exists(self, table_name):
+        self.refresh_table_names()
+        return table_name in self._table_names
+
+    def ensure_table(self, table_name):
+        """
+        分表一般由 maintain_command_partitions 提前创建,
+        只有时间超出已创建范围的命令才会在写入时建表
+        """
+        model = self.get_model(table_name)
+        if self.table_exists(table_name):
+            return model
+        self.refresh_table_names(force=True)
+        if table_name in self._table_names:
+            return model
+        try:
+            with connection.schema_editor() as editor:
+                editor.create_model(model)
+            logger.info("Create command partition: {}".format(table_name))
+        except DatabaseError as e:
+            # 其它进程可能已经创建了该分表
+            self.refresh_table_names(force=True)
+            if table_name not in self._table_names:
+                raise e
+        self._table_names.add(table_name)
+        return model
+
+    def drop_table(self, table_name):
+        model = self.get_model(table_name)
+        with connection.schema_editor() as editor:
+            editor.delete_model(model)
+        self._table_names.discard(table_name)
+        logger.info("Drop command partition: {}".format(table_name))
+
+    def get_partitions(self):
+        """
+        :return: [(table_name, period_start), ...] 从旧到新
+        """
+        self.refresh_table_names(force=True)
+        partitions = []
+        for table_name in self._table_names:
+            period = self.parse_period(table_name)
+            if period:
+                partitions.append((table_name, period))
+        partitions.sort(key=lambda x: x[1])
+        return partitions
+
+
+class CommandStore(DBCommandStore):
+    """
+    按时间分表保存命令, 查询时根据 timestamp 范围裁剪分表,
+    过期数据直接删除整张分表, 不再执行 DELETE
+    启用分表前写入 terminal_command 的命令仍然可以查询
+    """
+
+    def __init__(self, params):
+        super().__init__(params)
+        interval = params.get('INTERVAL') or settings.COMMAND_PARTITION_INTERVAL
+        self.router = PartitionRouter(interval)
+
+    @staticmethod
+    def make_command(model, command):
+        return model(
+            user=command["user"], asset=command["asset"],
+            system_user=command["system_user"], input=command["input"],
+            output=command["output"], session=command["session"],
+            org_id=command["org_id"], timestamp=command["timestamp"]
+        )
+
+    def save(self, command):
+        return self.bulk_save([command])[0]
+
+    def bulk_save(self, commands):
+        grouped = defaultdict(list)
+        for command in commands:
+            table_name = self.router.get_table_name(command["timestamp"])
+            grouped[table_name].append(command)
+
+        created = []
+        for table_name, _commands in grouped.items():
+            model = self.router.ensure_table(table_name)
+            created.extend(model.objects.bulk_create(
+                [self.make_command(model, c) for c in _commands]
+            ))
+        return created
+
+    def get_querysets(self, filter_kwargs):
+        """
+        按时间从新到旧返回需要查询的分表的 queryset
+        """
+        querysets = []
+        table_names = self.router.iter_table_names(
+            filter_kwargs['timestamp__gte'], filter_kwargs['timestamp__lte']
+        )
+        for table_name in table_names:
+            if not self.router.table_exists(table_name):
+                continue
+            model = self.router.get_model(table_name)
+            querysets.append(
+                model.objects.filter(**filter_kwargs).order_by('-timestamp')
+            )
+        querysets.append(
+            self.model.objects.filter(**filter_kwargs).order_by('-timestamp')
+        )
+        return querysets
+
+    @staticmethod
+    def iter_commands(querysets, limit=None):
+        # 分表之间时间不重叠, 依次读取即可保证整体按时间倒序
+        for queryset in querysets:
+            if limit is not None:
+                if limit <= 0:
+                    return
+                queryset = queryset[:limit]
+            for command in queryset.iterator():
+                if limit is not None:
+                    limit -= 1
+                yield command
+
+    def filter(self, date_from=None, date_to=None,
+               user=None, asset=None, system_user=None,
+               input=None, session=None, limit=None):
+        filter_kwargs = self.make_filter_kwargs(
+            date_from=date_from, date_to=date_to, user=user,
+            asset=asset, system_user=system_user, input=input,
+            session=session,
+        )
+        querysets = self.get_querysets(filter_kwargs)
+        return self.iter_commands(querysets, limit=limit)
+
+    def count(self, date_from=None, date_to=None,
+              user=None, asset=None, system_user=None,
+              input=None, session=None):
+        filter_kwargs = self.make_filter_kwargs(
+            date_from=date_from, date_to=date_to, user=user,
+            asset=asset, system_user=system_user, input=input,
+            session=session,
+        )
+        querysets = self.get_querysets(filter_kwargs)
+        return sum(queryset.count() for queryset in querysets)
+
+    def create_partitions(self, ahead=1):
+        """
+        创建当前和之后 ahead 个周期的分表
+        """
+        date = self.router.get_period_start(time.time())
+        for i in range(ahead + 1):
+            self.router.ensure_table(self.router.get_table_name_by_period(date))
+            date = self.router.get_next_period(date)
+
+    def drop_expired_partitions(self, retention_days):
+        """
+        删除整个周期都早于保留期限的分表
+        :return: 删除的分表名
+        """
+        if not retention_days or retention_days <= 0:
+            return []
+        date_expired = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+        dropped = []
+        for table_name, period in self.router.get_partitions():
+            if self.router.get_next_period(period) > date_expired:
+                break
+            self.router.drop_table(table_name)
+            dropped.append(table_name)
+        return dropped
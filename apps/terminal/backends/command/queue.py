@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+import json
+import time
+
+from django.conf import settings
+
+from common.utils import get_redis_client, get_logger
+
+logger = get_logger(__file__)
+
+
+class CommandQueue:
+    """
+    终端上报的命令先写入 redis list, 再由 celery 批量写入 COMMAND_STORAGE
+
+    只有一个 flusher 在运行 (见 terminal.tasks.flush_command_queue),
+    所以先读取队首一批, 保存成功后再从队列中删除, 保证至少保存一次
+    """
+    QUEUE_KEY = 'TERMINAL_COMMAND_QUEUE'
+    FAILED_KEY = 'TERMINAL_COMMAND_QUEUE_FAILED'
+    METRICS_KEY = 'TERMINAL_COMMAND_QUEUE_METRICS'
+
+    REQUIRED_FIELDS = (
+        ('user', 64), ('asset', 128), ('system_user', 64),
+        ('input', 128), ('output', 1024), ('session', 36),
+    )
+
+    def __init__(self):
+        self.client = get_redis_client()
+
+    @classmethod
+    def validate(cls, commands):
+        """
+        比 SessionCommandSerializer 轻量的校验, 只检查字段和长度
+        :return: (valid_commands, error)
+        """
+        if not isinstance(commands, list):
+            return None, 'Commands must be a list'
+        valid_commands = []
+        for command in commands:
+            if not isinstance(command, dict):
+                return None, 'Command must be a dict: {}'.format(command)
+            _command = {}
+            for field, max_length in cls.REQUIRED_FIELDS:
+                value = command.get(field)
+                if not isinstance(value, str) or len(value) > max_length:
+                    return None, 'Command field `{}` invalid: {}'.format(field, command)
+                if not value and field != 'output':
+                    return None, 'Command field `{}` required: {}'.format(field, command)
+                _command[field] = value
+            try:
+                _command['timestamp'] = int(command.get('timestamp'))
+            except (TypeError, ValueError):
+                return None, 'Command field `timestamp` invalid: {}'.format(command)
+            _command['org_id'] = command.get('org_id') or ''
+            valid_commands.append(_command)
+        return valid_commands, None
+
+    @property
+    def size(self):
+        return self.client.llen(self.QUEUE_KEY)
+
+    def is_full(self):
+        return self.size >= settings.COMMAND_INGEST_MAX_QUEUE_SIZE
+
+    def push(self, commands):
+        if not commands:
+            return self.size
+        values = [json.dumps(command) for command in commands]
+        return self.client.rpush(self.QUEUE_KEY, *values)
+
+    def peek(self, count):
+        values = self.client.lrange(self.QUEUE_KEY, 0, count - 1)
+        return [json.loads(value.decode()) for value in values]
+
+    def remove(self, count):
+        self.client.ltrim(self.QUEUE_KEY, count, -1)
+
+    def move_to_failed(self, count):
+        values = self.client.lrange(self.QUEUE_KEY, 0, count - 1)
+        if values:
+            self.client.rpush(self.FAILED_KEY, *values)
+        self.remove(count)
+
+    def flush(self, storage, batch_size=None, timeout=50):
+        """
+        批量写入, 单次最多执行 timeout 秒, 剩余的由下一次任务处理
+        :return: 写入的命令数量
+        """
+        batch_size = batch_size or settings.COMMAND_INGEST_BATCH_SIZE
+        start = time.time()
+        flushed = 0
+        while time.time() - start < timeout:
+            commands = self.peek(batch_size)
+            if not commands:
+                break
+            batch_start = time.time()
+            try:
+                storage.bulk_save(commands)
+            except Exception as e:
+                self.on_flush_failed(commands, e)
+                break
+            self.remove(len(commands))
+            flushed += len(commands)
+            self.on_flush_success(commands, time.time() - batch_start)
+        return flushed
+
+    def on_flush_success(self, commands, latency):
+        pipe = self.client.pipeline()
+        pipe.hincrby(self.METRICS_KEY, 'flushed', len(commands))
+        pipe.hset(self.METRICS_KEY, 'last_flush_latency', round(latency, 3))
+        pipe.hset(self.METRICS_KEY, 'last_flush_size', len(commands))
+        pipe.hset(self.METRICS_KEY, 'last_flush_time', int(time.time()))
+        pipe.hset(self.METRICS_KEY, 'retry', 0)
+        pipe.execute()
+
+    def on_flush_failed(self, commands, error):
+        retry = self.client.hincrby(self.METRICS_KEY, 'retry', 1)
+        self.client.hincrby(self.METRICS_KEY, 'failed', 1)
+        logger.error("Flush {} commands failed ({} times): {}".format(
+            len(commands), retry, error
+        ))
+        # 多次失败的批次移到失败队列, 避免阻塞后面的命令
+        if retry >= settings.COMMAND_INGEST_MAX_RETRY:
+            logger.error("Move {} commands to failed queue".format(len(commands)))
+            self.move_to_failed(len(commands))
+            self.client.hset(self.METRICS_KEY, 'retry', 0)
+
+    def get_metrics(self):
+        metrics = {
+            k.decode(): v.decode()
+            for k, v in self.client.hgetall(self.METRICS_KEY).items()
+        }
+        metrics['queue_size'] = self.size
+        metrics['failed_queue_size'] = self.client.llen(self.FAILED_KEY)
+        return metrics
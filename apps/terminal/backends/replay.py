@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import re
+import time
+import uuid
+import socket
+import threading
+import mimetypes
+
+import jms_storage
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.http import StreamingHttpResponse, HttpResponse
+
+from common.utils import get_logger
+
+logger = get_logger(__file__)
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class ReplayCache:
+    """
+    外部存储中的录像缓存到本地 MEDIA_ROOT/replay_cache 目录,
+    按最近访问时间淘汰, 总大小不超过 REPLAY_CACHE_MAX_SIZE
+
+    缓存目录在每台主机本地, 所以下载锁按主机区分, 同一台主机上同一个录像同时只有一个下载,
+    下载在后台线程中执行, 其它请求跟随 .part 文件读取, 不需要等待下载完成
+    锁的过期时间很短, 下载线程定期续期, worker 退出后锁很快过期, 跟随的请求重新下载,
+    没有下载在进行的 .part 文件在淘汰缓存时删除
+    """
+    CACHE_DIR = 'replay_cache'
+    DOWNLOAD_LOCK_KEY = '_TERMINAL_REPLAY_DOWNLOAD_{}_{}'
+    DOWNLOAD_TIMEOUT = 3600
+    LOCK_TIMEOUT = 30
+    LOCK_RENEW_INTERVAL = 10
+    FOLLOW_INTERVAL = 0.2
+    FOLLOW_MAX_RESTART = 1
+
+    def __init__(self, session_path):
+        self.session_path = session_path
+        self.path = os.path.join(self.get_base_dir(), session_path)
+        self.part_path = self.path + '.part'
+        self.lock_key = self.get_lock_key(session_path)
+        self.token = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+
+    @classmethod
+    def get_base_dir(cls):
+        return os.path.join(default_storage.base_location, cls.CACHE_DIR)
+
+    @classmethod
+    def get_lock_key(cls, session_path):
+        return cls.DOWNLOAD_LOCK_KEY.format(socket.gethostname(), session_path)
+
+    @property
+    def url(self):
+        return default_storage.url(os.path.join(self.CACHE_DIR, self.session_path))
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def touch(self):
+        try:
+            os.utime(self.path, None)
+        except OSError:
+            pass
+
+    def is_downloading(self):
+        return cache.get(self.lock_key) is not None
+
+    def acquire_lock(self):
+        if cache.add(self.lock_key, self.token, self.LOCK_TIMEOUT):
+            return True
+        # 下载开始前会先创建 .part 文件, 没有 .part 文件时锁已失效
+        if os.path.exists(self.part_path) or self.exists():
+            return False
+        logger.debug("Replay download lock is stale: {}".format(self.session_path))
+        cache.delete(self.lock_key)
+        return cache.add(self.lock_key, self.token, self.LOCK_TIMEOUT)
+
+    def renew_lock(self, stopped):
+        while not stopped.wait(self.LOCK_RENEW_INTERVAL):
+            if cache.get(self.lock_key) != self.token:
+                break
+            cache.set(self.lock_key, self.token, self.LOCK_TIMEOUT)
+
+    def start_download(self, configs):
+        """
+        :return: 是否开始了新的下载
+        """
+        if self.exists():
+            return False
+        if not self.acquire_lock():
+            return False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # 先创建 .part 文件, 同时清空上次中断留下的内容
+            open(self.part_path, 'wb').close()
+        except OSError as e:
+            logger.error("Failed create replay cache file: {}".format(e))
+            cache.delete(self.lock_key)
+            return False
+        thread = threading.Thread(target=self.download, args=(configs,), daemon=True)
+        thread.start()
+        return True
+
+    def download(self, configs):
+        stopped = threading.Event()
+        renew = threading.Thread(target=self.renew_lock, args=(stopped,), daemon=True)
+        renew.start()
+        try:
+            storage = jms_storage.get_multi_object_storage(configs)
+            ok, err = storage.download(self.session_path, self.part_path)
+            if not ok:
+                logger.error("Failed download replay file: {}".format(err))
+                if os.path.exists(self.part_path):
+                    os.remove(self.part_path)
+                return
+            os.replace(self.part_path, self.path)
+        except Exception as e:
+            logger.error("Failed download replay file: {}".format(e))
+        finally:
+            stopped.set()
+            if cache.get(self.lock_key) == self.token:
+                cache.delete(self.lock_key)
+        self.evict()
+
+    def iter_following(self, configs=None):
+        """
+        读取下载中的文件, 直到下载结束,
+        下载中断 (锁过期且没有完成) 时重新下载, 继续从已读取的位置返回
+        """
+        offset = 0
+        restart = 0
+        start = time.time()
+        while time.time() - start < self.DOWNLOAD_TIMEOUT:
+            finished = self.exists()
+            if not finished and not self.is_downloading():
+                if configs and restart < self.FOLLOW_MAX_RESTART \
+                        and self.start_download(configs):
+                    restart += 1
+                else:
+                    finished = True
+            path = self.path if self.exists() else self.part_path
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    while True:
+                        chunk = f.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        offset += len(chunk)
+                        yield chunk
+            except FileNotFoundError:
+                pass
+            if finished:
+                break
+            time.sleep(self.FOLLOW_INTERVAL)
+
+    @classmethod
+    def clean_orphan_part(cls, path, mtime):
+        """
+        没有下载在进行 (本机的锁不存在) 的 .part 文件是 worker 退出时留下的
+        """
+        if time.time() - mtime < cls.LOCK_TIMEOUT:
+            return
+        session_path = os.path.relpath(path, cls.get_base_dir())[:-len('.part')]
+        if cache.get(cls.get_lock_key(session_path)) is not None:
+            return
+        try:
+            os.remove(path)
+            logger.debug("Remove orphan replay cache part: {}".format(path))
+        except OSError:
+            pass
+
+    @classmethod
+    def evict(cls):
+        """
+        删除遗留的 .part 文件, 再按最近访问时间删除缓存, 直到总大小不超过 REPLAY_CACHE_MAX_SIZE
+        """
+        files = []
+        for root, dirs, names in os.walk(cls.get_base_dir()):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.part'):
+                    cls.clean_orphan_part(path, stat.st_mtime)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(f[1] for f in files)
+        max_size = settings.REPLAY_CACHE_MAX_SIZE
+        for mtime, size, path in sorted(files):
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            logger.debug("Evict replay cache: {}".format(path))
+
+
+def get_content_headers(path):
+    content_type, encoding = mimetypes.guess_type(path)
+    headers = {'Content-Type': content_type or 'application/octet-stream'}
+    # 录像是 gzip 文件, 和 nginx 中 /media/ 的配置一致, 由浏览器解压
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return headers
+
+
+def iter_file(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def ranged_file_response(request, path):
+    """
+    返回本地文件, 支持 HTTP Range
+    """
+    size = os.path.getsize(path)
+    start, end = 0, size - 1
+    status = 200
+    range_header = request.META.get('HTTP_RANGE', '').strip()
+    matched = RANGE_RE.match(range_header)
+    if matched and (matched.group(1) or matched.group(2)):
+        first, last = matched.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start = max(size - int(last), 0)
+        if start > end or start >= size:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        status = 206
+
+    length = end - start + 1
+    response = StreamingHttpResponse(iter_file(path, start, length), status=status)
+    for k, v in get_content_headers(path).items():
+        response[k] = v
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Length'] = str(length)
+    if status == 206:
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+    return response
+
+
+def following_file_response(replay_cache, configs=None):
+    response = StreamingHttpResponse(replay_cache.iter_following(configs))
+    for k, v in get_content_headers(replay_cache.path).items():
+        response[k] = v
+    return response
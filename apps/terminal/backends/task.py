@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.utils.encoders import JSONEncoder
+
+from common.utils import get_redis_client, get_logger
+
+logger = get_logger(__file__)
+
+
+class TaskChannel:
+    """
+    每个终端一个 redis list, 创建任务后推送到终端对应的 list,
+    终端通过长轮询或心跳取走任务, 心跳不再每次查询 terminal_task
+
+    redis 数据丢失或终端没有取走的任务, 由心跳定期查询数据库补发 (见 need_check_db),
+    所以 list 在最后一次推送 CHANNEL_TIMEOUT 秒后过期, 不再使用的终端不会遗留数据
+
+    长轮询等待期间占用一个 web 线程, 最长等待时间见 settings.TASK_POLL_MAX_TIMEOUT
+    """
+    KEY_PREFIX = 'TERMINAL_TASK_CHANNEL_{}'
+    DB_CHECK_KEY = '_TERMINAL_TASK_DB_CHECK_{}'
+    DB_CHECK_INTERVAL = 300
+    CHANNEL_TIMEOUT = 3600
+
+    def __init__(self, terminal_id):
+        self.terminal_id = str(terminal_id)
+        self.key = self.KEY_PREFIX.format(self.terminal_id)
+        self.client = get_redis_client()
+
+    @classmethod
+    def push_tasks(cls, tasks):
+        """
+        事务提交后按终端推送任务
+        """
+        from ..serializers import TaskSerializer
+
+        tasks_by_terminal = {}
+        for task in tasks:
+            if not task.terminal_id:
+                continue
+            tasks_by_terminal.setdefault(task.terminal_id, []).append(task)
+
+        def push():
+            for terminal_id, _tasks in tasks_by_terminal.items():
+                data = TaskSerializer(_tasks, many=True).data
+                values = [json.dumps(d, cls=JSONEncoder) for d in data]
+                key = cls.KEY_PREFIX.format(terminal_id)
+                try:
+                    pipe = cls(terminal_id).client.pipeline()
+                    pipe.rpush(key, *values)
+                    pipe.expire(key, cls.CHANNEL_TIMEOUT)
+                    pipe.execute()
+                except Exception as e:
+                    logger.error("Push terminal tasks error: {}".format(e))
+        transaction.on_commit(push)
+
+    def pop_all(self):
+        pipe = self.client.pipeline()
+        pipe.lrange(self.key, 0, -1)
+        pipe.delete(self.key)
+        values, _ = pipe.execute()
+        return [json.loads(v.decode()) for v in values]
+
+    def poll(self, timeout):
+        """
+        阻塞等待任务, 最多等待 timeout 秒
+        """
+        timeout = max(1, min(int(timeout), settings.TASK_POLL_MAX_TIMEOUT))
+        item = self.client.blpop(self.key, timeout=timeout)
+        if not item:
+            return []
+        tasks = [json.loads(item[1].decode())]
+        tasks.extend(self.pop_all())
+        return tasks
+
+    def need_check_db(self):
+        key = self.DB_CHECK_KEY.format(self.terminal_id)
+        return cache.add(key, 1, self.DB_CHECK_INTERVAL)
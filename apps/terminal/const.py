@@ -5,3 +5,4 @@ ASSETS_CACHE_KEY = "terminal__session__assets"
 USERS_CACHE_KEY = "terminal__session__users"
 SYSTEM_USER_CACHE_KEY = "terminal__session__system_users"
 
+REPLAY_LOCAL_PATH_CACHE_KEY = "_TERMINAL_REPLAY_LOCAL_PATH_{}"
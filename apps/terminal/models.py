@@ -2,7 +2,10 @@ from __future__ import unicode_literals
 
 import uuid
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.core.cache import cache
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
 from django.conf import settings
@@ -118,6 +121,181 @@ class Status(models.Model):
         return self.date_created.strftime("%Y-%m-%d %H:%M:%S")
 
 
+class StatusRollup(models.Model):
+    """
+    终端状态按 1分钟/1小时/1天 汇总, 保存各指标的和与最大值, 平均值 = 和 / count
+    心跳只更新最新状态缓存和 1m 汇总, 1h/1d 由 compact_terminal_status 任务生成
+    """
+    PERIOD_MINUTE = '1m'
+    PERIOD_HOUR = '1h'
+    PERIOD_DAY = '1d'
+    PERIOD_CHOICES = (
+        (PERIOD_MINUTE, _('Minute')),
+        (PERIOD_HOUR, _('Hour')),
+        (PERIOD_DAY, _('Day')),
+    )
+    METRICS = ('cpu_used', 'memory_used', 'connections', 'session_online')
+    LATEST_CACHE_KEY = '_TERMINAL_STATUS_LATEST_{}'
+    LATEST_CACHE_TIMEOUT = 3600
+
+    terminal = models.ForeignKey(Terminal, on_delete=models.CASCADE)
+    period = models.CharField(max_length=2, choices=PERIOD_CHOICES)
+    date_start = models.DateTimeField()
+    count = models.IntegerField(default=0)
+    cpu_used_sum = models.FloatField(default=0)
+    cpu_used_max = models.FloatField(default=0)
+    memory_used_sum = models.FloatField(default=0)
+    memory_used_max = models.FloatField(default=0)
+    connections_sum = models.FloatField(default=0)
+    connections_max = models.FloatField(default=0)
+    session_online_sum = models.FloatField(default=0)
+    session_online_max = models.FloatField(default=0)
+
+    class Meta:
+        db_table = 'terminal_status_rollup'
+        unique_together = [('terminal', 'period', 'date_start')]
+        ordering = ('date_start',)
+
+    @classmethod
+    def truncate(cls, date, period):
+        date = timezone.localtime(date).replace(second=0, microsecond=0)
+        if period in (cls.PERIOD_HOUR, cls.PERIOD_DAY):
+            date = date.replace(minute=0)
+        if period == cls.PERIOD_DAY:
+            date = date.replace(hour=0)
+        return date
+
+    @classmethod
+    def set_latest(cls, terminal, data):
+        latest = {k: data.get(k) for k in cls.METRICS + ('threads', 'boot_time')}
+        latest['date_created'] = timezone.now()
+        key = cls.LATEST_CACHE_KEY.format(terminal.id)
+        cache.set(key, latest, cls.LATEST_CACHE_TIMEOUT)
+
+    @classmethod
+    def get_latest(cls, terminal):
+        return cache.get(cls.LATEST_CACHE_KEY.format(terminal.id))
+
+    @classmethod
+    def record(cls, terminal, data):
+        """
+        记录一次心跳的状态
+        """
+        cls.set_latest(terminal, data)
+        date_start = cls.truncate(timezone.now(), cls.PERIOD_MINUTE)
+        updates = {'count': F('count') + 1}
+        for metric in cls.METRICS:
+            value = data.get(metric) or 0
+            updates[metric + '_sum'] = F(metric + '_sum') + value
+            updates[metric + '_max'] = Greatest(metric + '_max', Value(value))
+        queryset = cls.objects.filter(
+            terminal=terminal, period=cls.PERIOD_MINUTE, date_start=date_start
+        )
+        if queryset.update(**updates):
+            return
+        values = {'count': 1}
+        for metric in cls.METRICS:
+            value = data.get(metric) or 0
+            values[metric + '_sum'] = values[metric + '_max'] = value
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    terminal=terminal, period=cls.PERIOD_MINUTE,
+                    date_start=date_start, **values
+                )
+        except IntegrityError:
+            queryset.update(**updates)
+
+    @classmethod
+    def rollup(cls, src_period, dst_period, date_from):
+        """
+        用 src_period 的数据重新计算 date_from 之后的 dst_period 汇总, 重复执行结果相同
+        """
+        date_from = cls.truncate(date_from, dst_period)
+        fields = ['count']
+        for metric in cls.METRICS:
+            fields.extend([metric + '_sum', metric + '_max'])
+
+        rollups = {}
+        src_rows = cls.objects.filter(period=src_period, date_start__gte=date_from)\
+            .values('terminal_id', 'date_start', *fields)
+        for row in src_rows:
+            key = (row['terminal_id'], cls.truncate(row['date_start'], dst_period))
+            rollup = rollups.setdefault(key, dict.fromkeys(fields, 0))
+            for field in fields:
+                if field.endswith('_max'):
+                    rollup[field] = max(rollup[field], row[field])
+                else:
+                    rollup[field] += row[field]
+
+        exists = {
+            (row.terminal_id, row.date_start): row
+            for row in cls.objects.filter(period=dst_period, date_start__gte=date_from)
+        }
+        to_create = []
+        for (terminal_id, date_start), values in rollups.items():
+            row = exists.get((terminal_id, date_start))
+            if row is None:
+                to_create.append(cls(
+                    terminal_id=terminal_id, period=dst_period,
+                    date_start=date_start, **values
+                ))
+                continue
+            if all(getattr(row, k) == v for k, v in values.items()):
+                continue
+            for k, v in values.items():
+                setattr(row, k, v)
+            row.save(update_fields=fields)
+        cls.objects.bulk_create(to_create)
+
+    @classmethod
+    def get_complete_from(cls, src_expired, dst_period):
+        """
+        src_expired 之前的源数据已被删除, 返回第一个源数据完整保留的 dst_period,
+        更早的汇总不再重新计算, 避免用不完整的数据覆盖正确的汇总
+        """
+        date_from = cls.truncate(src_expired, dst_period)
+        if date_from < src_expired:
+            length = timezone.timedelta(hours=1)
+            if dst_period == cls.PERIOD_DAY:
+                length = timezone.timedelta(days=1)
+            # 加 1.5 个周期后再截断, 跨夏令时切换时也能得到下一个周期的开始
+            date_from = cls.truncate(date_from + length * 1.5, dst_period)
+        return date_from
+
+    @classmethod
+    def compact(cls):
+        """
+        生成 1h/1d 汇总, 并删除过期的数据, 保留时间见 settings.STATUS_ROLLUP_RETENTION_DAYS
+        """
+        now = timezone.now()
+        retention = settings.STATUS_ROLLUP_RETENTION_DAYS
+        expired = {
+            period: now - timezone.timedelta(days=days)
+            for period, days in retention.items()
+        }
+        cls.rollup(
+            cls.PERIOD_MINUTE, cls.PERIOD_HOUR,
+            cls.get_complete_from(expired[cls.PERIOD_MINUTE], cls.PERIOD_HOUR)
+        )
+        cls.rollup(
+            cls.PERIOD_HOUR, cls.PERIOD_DAY,
+            max(now - timezone.timedelta(days=2),
+                cls.get_complete_from(expired[cls.PERIOD_HOUR], cls.PERIOD_DAY))
+        )
+        for period, days in retention.items():
+            date_expired = now - timezone.timedelta(days=days)
+            cls.objects.filter(period=period, date_start__lt=date_expired).delete()
+
+    def to_dict(self):
+        data = {'date_start': self.date_start, 'count': self.count}
+        for metric in self.METRICS:
+            total = getattr(self, metric + '_sum')
+            data[metric] = round(total / self.count, 2) if self.count else 0
+            data[metric + '_max'] = getattr(self, metric + '_max')
+        return data
+
+
 class Session(OrgModelMixin):
     LOGIN_FROM_CHOICES = (
         ('ST', 'SSH Terminal'),
@@ -146,11 +324,53 @@ class Session(OrgModelMixin):
     class Meta:
         db_table = "terminal_session"
         ordering = ["-date_start"]
+        # 游标分页和按用户/系统用户过滤使用, asset 过长不适合建联合索引
+        index_together = [
+            ('org_id', 'date_start', 'id'),
+            ('user', 'date_start'), ('system_user', 'date_start'),
+        ]
 
     def __str__(self):
         return "{0.id} of {0.user} to {0.asset}".format(self)
 
 
+class SessionDailyRollup(OrgModelMixin):
+    """
+    会话按 天/用户/资产 汇总, 首页统计使用, 由 rollup_session_daily 任务生成
+    """
+    date = models.DateField(db_index=True)
+    user = models.CharField(max_length=128, verbose_name=_("User"))
+    asset = models.CharField(max_length=1024, verbose_name=_("Asset"))
+    count = models.IntegerField(default=0)
+    date_last = models.DateTimeField(verbose_name=_("Date last"))
+
+    class Meta:
+        db_table = "terminal_session_daily_rollup"
+
+    @staticmethod
+    def get_date_range(date):
+        tz = timezone.get_current_timezone()
+        date_from = tz.localize(timezone.datetime.combine(date, timezone.datetime.min.time()))
+        return date_from, date_from + timezone.timedelta(days=1)
+
+    @classmethod
+    def rollup(cls, date):
+        """
+        重新计算某一天的汇总, 重复执行结果相同
+        """
+        date_from, date_to = cls.get_date_range(date)
+        rows = Session._base_manager.filter(
+            date_start__gte=date_from, date_start__lt=date_to
+        ).values('org_id', 'user', 'asset').annotate(
+            count=models.Count('id'), date_last=models.Max('date_start')
+        ).order_by()
+        rollups = [cls(date=date, **row) for row in rows]
+        with transaction.atomic():
+            cls._base_manager.filter(date=date).delete()
+            cls._base_manager.bulk_create(rollups)
+        return len(rollups)
+
+
 class Task(models.Model):
     NAME_CHOICES = (
         ("kill_session", "Kill Session"),
@@ -173,3 +393,16 @@ class Command(AbstractSessionCommand):
     class Meta:
         db_table = "terminal_command"
         ordering = ('-timestamp',)
+
+
+class CommandInputGram(models.Model):
+    """
+    Command input 的 3-gram 倒排索引, 用来代替 input__icontains 的全表扫描
+    """
+    gram = models.CharField(max_length=3)
+    command_id = models.UUIDField(db_index=True)
+    timestamp = models.IntegerField()
+
+    class Meta:
+        db_table = "terminal_command_input_gram"
+        index_together = [('gram', 'timestamp')]
@@ -6,7 +6,7 @@ from rest_framework import serializers
 from rest_framework_bulk.serializers import BulkListSerializer
 
 from common.mixins import BulkSerializerMixin
-from .models import Terminal, Status, Session, Task
+from .models import Terminal, Status, Session, Task, StatusRollup
 from .backends import get_multi_command_storage
 
 
@@ -28,15 +28,19 @@ class TerminalSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_is_alive(obj):
-        try:
-            status = obj.status_set.latest()
-        except Status.DoesNotExist:
-            status = None
+        latest = StatusRollup.get_latest(obj)
+        if latest:
+            date_last = latest['date_created']
+        else:
+            rollup = StatusRollup.objects.filter(
+                terminal=obj, period=StatusRollup.PERIOD_MINUTE
+            ).last()
+            date_last = rollup.date_start if rollup else None
 
-        if not status:
+        if not date_last:
             return False
 
-        delta = timezone.now() - status.date_created
+        delta = timezone.now() - date_last
         if delta < timezone.timedelta(seconds=600):
             return True
         else:
@@ -56,6 +60,17 @@ class SessionSerializer(BulkSerializerMixin, serializers.ModelSerializer):
         return self.command_store.count(session=str(obj.id))
 
 
+class SessionHeartbeatSerializer(serializers.ModelSerializer):
+    """
+    终端心跳中上报的会话, 只做字段校验, 不查询数据库, 由 handle_sessions 批量保存
+    """
+    id = serializers.UUIDField()
+
+    class Meta:
+        model = Session
+        exclude = ('terminal',)
+
+
 class StatusSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -2,10 +2,14 @@
 #
 from celery import shared_task
 from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
 from django.db.utils import ProgrammingError, OperationalError
+from django.dispatch import receiver
 
 from common.utils import get_logger
 from .const import ASSETS_CACHE_KEY, USERS_CACHE_KEY, SYSTEM_USER_CACHE_KEY
+from .models import Session
+from .utils import expire_online_counters
 
 RUNNING = False
 logger = get_logger(__file__)
@@ -26,3 +30,16 @@ def set_session_info_cache():
         cache.set(SYSTEM_USER_CACHE_KEY, system_users)
     except (ProgrammingError, OperationalError):
         pass
+
+
+@receiver(post_save, sender=Session)
+def on_session_changed_expire_online_counter(sender, instance=None, created=False, **kwargs):
+    # guacamole 通过 API 创建和结束会话, 不经过心跳
+    if created or instance.is_finished:
+        expire_online_counters([instance.org_id])
+
+
+@receiver(post_delete, sender=Session)
+def on_session_deleted_expire_online_counter(sender, instance=None, **kwargs):
+    if not instance.is_finished:
+        expire_online_counters([instance.org_id])
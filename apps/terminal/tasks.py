@@ -2,17 +2,34 @@
 #
 
 import datetime
+import os
 
+import jms_storage
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.utils import timezone
 
 from ops.celery.utils import register_as_period_task, after_app_ready_start, \
     after_app_shutdown_clean
-from .models import Status, Session
+from common.utils import get_logger
+from .models import Status, Session, StatusRollup, SessionDailyRollup
+from .backends import get_command_storage
+from .backends.command.queue import CommandQueue
+from .backends.command.ngram import CommandInputIndex
+from .const import REPLAY_LOCAL_PATH_CACHE_KEY
 
 
 CACHE_REFRESH_INTERVAL = 10
 RUNNING = False
+COMMAND_QUEUE_FLUSH_LOCK_KEY = '_TERMINAL_COMMAND_QUEUE_FLUSH_LOCK'
+COMMAND_INPUT_INDEX_LOCK_KEY = '_TERMINAL_COMMAND_INPUT_INDEX_LOCK'
+SESSION_ROLLUP_DONE_KEY = '_TERMINAL_SESSION_ROLLUP_DONE_{}'
+SESSION_ROLLUP_DAYS = 31
+PUSH_REPLAY_MAX_RETRIES = 12
+PUSH_REPLAY_RETRY_COUNTDOWN = 300
+logger = get_logger(__file__)
 
 
 @shared_task
@@ -24,6 +41,17 @@ def delete_terminal_status_period():
     Status.objects.filter(date_created__lt=yesterday).delete()
 
 
+@shared_task
+@register_as_period_task(interval=600)
+@after_app_ready_start
+@after_app_shutdown_clean
+def compact_terminal_status():
+    """
+    汇总终端状态, 删除过期的汇总数据
+    """
+    StatusRollup.compact()
+
+
 @shared_task
 @register_as_period_task(interval=3600)
 @after_app_ready_start
@@ -34,3 +62,121 @@ def clean_orphan_session():
         if not session.terminal or not session.terminal.is_active:
             session.is_finished = True
             session.save()
+
+
+@shared_task
+@register_as_period_task(interval=30)
+@after_app_ready_start
+@after_app_shutdown_clean
+def flush_command_queue():
+    """
+    把 redis 队列中的命令批量写入 COMMAND_STORAGE, 同一时间只运行一个
+    """
+    if settings.COMMAND_INGEST_MODE != 'queue':
+        return
+    if not cache.add(COMMAND_QUEUE_FLUSH_LOCK_KEY, 1, 300):
+        logger.debug("Command queue is flushing, pass")
+        return
+    try:
+        flushed = CommandQueue().flush(get_command_storage())
+        logger.debug("Flush command queue: {}".format(flushed))
+    finally:
+        cache.delete(COMMAND_QUEUE_FLUSH_LOCK_KEY)
+
+
+@shared_task
+@register_as_period_task(interval=3600)
+@after_app_ready_start
+@after_app_shutdown_clean
+def maintain_command_partitions():
+    """
+    使用分表存储命令时, 提前创建下个周期的分表, 并删除过期的分表
+    """
+    storage = get_command_storage()
+    if not hasattr(storage, 'drop_expired_partitions'):
+        return
+    storage.create_partitions()
+    dropped = storage.drop_expired_partitions(
+        settings.COMMAND_PARTITION_RETENTION_DAYS
+    )
+    if dropped:
+        logger.info("Drop expired command partitions: {}".format(dropped))
+
+
+@shared_task
+@register_as_period_task(interval=600)
+@after_app_ready_start
+@after_app_shutdown_clean
+def build_command_input_index():
+    """
+    为开启索引前写入的命令补建 input 索引, 每次最多处理
+    COMMAND_INPUT_INDEX_BACKFILL_SIZE 条
+    """
+    if not CommandInputIndex.is_enabled():
+        CommandInputIndex.clear_indexed_from()
+        return
+    if not cache.add(COMMAND_INPUT_INDEX_LOCK_KEY, 1, 600):
+        logger.debug("Command input index is building, pass")
+        return
+    try:
+        indexed = CommandInputIndex().backfill(
+            limit=settings.COMMAND_INPUT_INDEX_BACKFILL_SIZE
+        )
+        logger.debug("Build command input index: {}".format(indexed))
+    finally:
+        cache.delete(COMMAND_INPUT_INDEX_LOCK_KEY)
+
+
+@shared_task(bind=True, max_retries=PUSH_REPLAY_MAX_RETRIES)
+def push_session_replay(self, session_id, name):
+    """
+    把保存在本地的录像推送到终端配置的录像存储, 成功后删除本地文件,
+    推送失败时稍后重试, 期间录像从本地读取
+    """
+    session = Session._base_manager.filter(id=session_id)\
+        .select_related('terminal').first()
+    if not session:
+        logger.error("Push replay error, session not found: {}".format(session_id))
+        return
+    if session.terminal:
+        config = session.terminal.get_replay_storage()["TERMINAL_REPLAY_STORAGE"]
+    else:
+        config = settings.TERMINAL_REPLAY_STORAGE.get('default')
+
+    if not config or config.get('TYPE') == 'server':
+        return
+    if not default_storage.exists(name):
+        logger.error("Push replay error, file not found: {}".format(name))
+        return
+    date = session.date_start.strftime('%Y-%m-%d')
+    target = os.path.join(date, str(session.id) + '.replay.gz')
+    storage = jms_storage.get_object_storage(config)
+    ok, err = storage.upload(default_storage.path(name), target)
+    if not ok:
+        logger.error("Push replay {} error: {}".format(session_id, err))
+        if self.request.retries >= self.max_retries:
+            return
+        raise self.retry(countdown=PUSH_REPLAY_RETRY_COUNTDOWN)
+    default_storage.delete(name)
+    cache.delete(REPLAY_LOCAL_PATH_CACHE_KEY.format(session_id))
+
+
+@shared_task
+@register_as_period_task(interval=600)
+@after_app_ready_start
+@after_app_shutdown_clean
+def rollup_session_daily():
+    """
+    每次重新汇总今天和昨天的会话, 更早的日期只汇总一次
+    """
+    today = timezone.localtime().date()
+    for i in range(SESSION_ROLLUP_DAYS):
+        date = today - datetime.timedelta(days=i)
+        key = SESSION_ROLLUP_DONE_KEY.format(date)
+        if i > 1 and cache.get(key):
+            continue
+        SessionDailyRollup.rollup(date)
+        if i > 1:
+            cache.set(key, 1, 3600 * 24 * (SESSION_ROLLUP_DAYS + 1))
+    date_expired = today - datetime.timedelta(days=SESSION_ROLLUP_DAYS)
+    SessionDailyRollup._base_manager.filter(date__lt=date_expired).delete()
@@ -22,9 +22,20 @@ urlpatterns = [
     path('sessions/<uuid:pk>/replay/',
          api.SessionReplayV2ViewSet.as_view({'get': 'retrieve', 'post': 'create'}),
          name='session-replay'),
+    path('sessions/<uuid:pk>/replay/chunk/',
+         api.SessionReplayChunkViewSet.as_view({'get': 'retrieve', 'put': 'update'}),
+         name='session-replay-chunk'),
+    path('sessions/<uuid:pk>/replay/download/',
+         api.SessionReplayDownloadViewSet.as_view({'get': 'retrieve'}),
+         name='session-replay-download'),
     path('tasks/kill-session/', api.KillSessionAPI.as_view(), name='kill-session'),
+    path('tasks/poll/', api.TaskPollApi.as_view(), name='task-poll'),
+    path('command/queue/status/', api.CommandQueueStatusApi.as_view(),
+         name='command-queue-status'),
     path('terminal/<uuid:terminal>/access-key/', api.TerminalTokenApi.as_view(),
          name='terminal-access-key'),
+    path('terminal/<uuid:terminal>/status/trend/',
+         api.TerminalStatusTrendApi.as_view(), name='terminal-status-trend'),
     path('terminal/config/', api.TerminalConfig.as_view(), name='terminal-config'),
     # v2: get session's replay
     # path('v2/sessions/<uuid:pk>/replay/',
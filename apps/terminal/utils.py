@@ -1,21 +1,32 @@
 # -*- coding: utf-8 -*-
 #
 from django.core.cache import cache
-from .models import Session
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+import base64
+
+from common.utils import get_logger, is_uuid, bulk_update_fields
+from orgs.counter import sessions_online_counter, users_online_counter
+from .models import Session, Terminal
 
 from .const import USERS_CACHE_KEY, ASSETS_CACHE_KEY, SYSTEM_USER_CACHE_KEY
 
+logger = get_logger(__file__)
+
 
 def get_session_asset_list():
-    return set(list(Session.objects.values_list('asset', flat=True)))
+    return set(Session.objects.values_list('asset', flat=True).order_by().distinct())
 
 
 def get_session_user_list():
-    return set(list(Session.objects.values_list('user', flat=True)))
+    return set(Session.objects.values_list('user', flat=True).order_by().distinct())
 
 
 def get_session_system_user_list():
-    return set(list(Session.objects.values_list('system_user', flat=True)))
+    return set(Session.objects.values_list('system_user', flat=True).order_by().distinct())
 
 
 def get_user_list_from_cache():
@@ -30,4 +41,176 @@ def get_system_user_list_from_cache():
     return cache.get(SYSTEM_USER_CACHE_KEY)
 
 
-
+def bulk_update_sessions(changes):
+    """
+    一条 UPDATE 更新多个会话的不同字段
+    :param changes: {session_id: {field: value, ...}, ...}
+    """
+    return bulk_update_fields(Session._base_manager.all(), changes)
+
+
+def get_session_changes(sessions_data, sessions):
+    changes = {}
+    for session in sessions:
+        data = sessions_data.get(session.id)
+        if data is None:
+            continue
+        changed = {k: v for k, v in data.items() if getattr(session, k) != v}
+        if changed:
+            changes[session.id] = changed
+    return changes
+
+
+def reconcile_terminal_sessions(terminal, sessions_data):
+    """
+    根据终端心跳上报的会话批量创建或更新会话, 并关闭终端没有上报的会话,
+    多次或并发上报相同的数据, 结果一致
+    终端上报的会话可能属于不同组织, 所以不使用 OrgManager
+    """
+    from .serializers import SessionHeartbeatSerializer
+
+    validated_sessions = {}
+    sessions_active = []
+    for data in sessions_data:
+        if not data.get("is_finished") and is_uuid(str(data.get("id"))):
+            sessions_active.append(data["id"])
+        serializer = SessionHeartbeatSerializer(data=data)
+        if not serializer.is_valid():
+            logger.error("session data is not valid {}: {}".format(
+                serializer.errors, data
+            ))
+            continue
+        validated_sessions[serializer.validated_data["id"]] = serializer.validated_data
+
+    manager = Session._base_manager
+    sessions_exist = list(manager.filter(id__in=list(validated_sessions)))
+    ids_exist = {session.id for session in sessions_exist}
+    sessions_new = [
+        Session(terminal=terminal, **data)
+        for session_id, data in validated_sessions.items()
+        if session_id not in ids_exist
+    ]
+    if sessions_new:
+        try:
+            with transaction.atomic():
+                manager.bulk_create(sessions_new)
+        except IntegrityError:
+            # 并发的心跳已经创建了部分会话, 改为更新
+            ids_new = [session.id for session in sessions_new]
+            ids_created = set(
+                manager.filter(id__in=ids_new).values_list('id', flat=True)
+            )
+            manager.bulk_create([
+                session for session in sessions_new
+                if session.id not in ids_created
+            ])
+            sessions_exist.extend(manager.filter(id__in=ids_created))
+
+    changes = get_session_changes(validated_sessions, sessions_exist)
+    for session in sessions_exist:
+        if session.terminal_id != terminal.id:
+            changes.setdefault(session.id, {})['terminal_id'] = terminal.id
+    bulk_update_sessions(changes)
+
+    sessions_closed = manager.filter(terminal=terminal, is_finished=False)\
+        .exclude(id__in=sessions_active)
+    orgs_changed = set(sessions_closed.values_list('org_id', flat=True))
+    sessions_closed.update(is_finished=True, date_end=timezone.now())
+
+    # 在线会话有增减的组织, 在线计数失效, 读取时按 Session.is_finished 重新计算
+    orgs_changed.update(
+        session.org_id for session in sessions_new if not session.is_finished
+    )
+    orgs_changed.update(
+        session.org_id for session in sessions_exist
+        if 'is_finished' in changes.get(session.id, {})
+    )
+    expire_online_counters(orgs_changed)
+
+
+def expire_online_counters(orgs_id):
+    for org_id in orgs_id:
+        sessions_online_counter.expire(org_id)
+        users_online_counter.expire(org_id)
+
+
+def parse_date_param(value, end_of_day=False):
+    """
+    查询参数中的时间, 支持时间戳和 %Y-%m-%d 两种格式
+    """
+    if not value:
+        return None
+    try:
+        return timezone.datetime.fromtimestamp(
+            float(value), tz=timezone.get_current_timezone()
+        )
+    except (ValueError, OverflowError, OSError):
+        # 不是时间戳, 或者超出范围, 如 1e20, inf
+        pass
+    try:
+        date = timezone.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return None
+    if end_of_day:
+        date = date.replace(hour=23, minute=59, second=59)
+    return timezone.get_current_timezone().localize(date)
+
+
+def encode_session_cursor(session, reverse=False):
+    value = '{}|{}|{}'.format(int(reverse), session.date_start.isoformat(), session.id)
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_session_cursor(cursor):
+    """
+    :return: (reverse, date_start, id), 游标不合法时抛出 ValueError
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode()).decode()
+        reverse, date_start, session_id = value.split('|')
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+    date_start = parse_datetime(date_start)
+    if date_start is None or reverse not in ('0', '1') or not is_uuid(session_id):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+    return reverse == '1', date_start, session_id
+
+
+def paginate_sessions(queryset, cursor, limit):
+    """
+    按 (date_start, id) 倒序的游标分页, 每页只查询 limit + 1 条,
+    翻到多少页耗时都一样, 需要 terminal_session (date_start, id) 索引
+    :return: (sessions, next_cursor, previous_cursor)
+    """
+    reverse, date_start, session_id = False, None, None
+    if cursor:
+        reverse, date_start, session_id = decode_session_cursor(cursor)
+
+    if date_start is None:
+        queryset = queryset.order_by('-date_start', '-id')
+    elif not reverse:
+        queryset = queryset.filter(
+            Q(date_start__lt=date_start) |
+            Q(date_start=date_start, id__lt=session_id)
+        ).order_by('-date_start', '-id')
+    else:
+        queryset = queryset.filter(
+            Q(date_start__gt=date_start) |
+            Q(date_start=date_start, id__gt=session_id)
+        ).order_by('date_start', 'id')
+
+    sessions = list(queryset[:limit + 1])
+    has_more = len(sessions) > limit
+    sessions = sessions[:limit]
+    if reverse:
+        sessions.reverse()
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, date_start is not None
+
+    next_cursor = previous_cursor = None
+    if sessions and has_next:
+        next_cursor = encode_session_cursor(sessions[-1])
+    if sessions and has_previous:
+        previous_cursor = encode_session_cursor(sessions[0], reverse=True)
+    return sessions, next_cursor, previous_cursor
@@ -4,11 +4,10 @@
 from django.views.generic import ListView, View
 from django.conf import settings
 from django.utils.translation import ugettext as _
-from django.http import HttpResponse
-from django.template import loader
-import time
+from django.utils import timezone
 
 from common.mixins import DatetimeSearchMixin
+from common.export import CSVExporter
 from common.permissions import AdminUserRequiredMixin
 from ..models import Command
 from .. import utils
@@ -63,43 +62,57 @@ class CommandListView(DatetimeSearchMixin, AdminUserRequiredMixin, ListView):
         return super().get_context_data(**kwargs)
 
 
+class CommandExporter(CSVExporter):
+    """
+    params 中的时间使用时间戳, 方便在后台任务中传递
+    """
+    filename_prefix = 'commands'
+    field_names = ['user', 'asset', 'system_user', 'input', 'output', 'session']
+
+    def get_queryset(self):
+        filter_kwargs = {
+            'date_from': utils.parse_date_param(self.params.get('date_from')),
+            'date_to': utils.parse_date_param(self.params.get('date_to')),
+        }
+        for field in ('user', 'asset', 'system_user', 'input'):
+            value = self.params.get(field)
+            if value:
+                filter_kwargs[field] = value
+        return common_storage.filter(**filter_kwargs)
+
+    def get_header(self):
+        header = [
+            Command._meta.get_field(name).verbose_name
+            for name in self.field_names
+        ]
+        header.append(_('Datetime'))
+        return header
+
+    def get_row(self, command):
+        data = [getattr(command, name) for name in self.field_names]
+        date = timezone.datetime.fromtimestamp(
+            command.timestamp, tz=timezone.get_current_timezone()
+        )
+        data.append(date.strftime('%Y-%m-%d %H:%M:%S'))
+        return data
+
+
 class CommandExportView(DatetimeSearchMixin, AdminUserRequiredMixin, View):
     model = Command
     command = user = asset = system_user = action = ''
     date_from = date_to = None
 
     def get(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        template = 'terminal/command_report.html'
-        context = {
-            'queryset': queryset,
-            'total_count': len(queryset),
-            'now': time.time(),
-        }
-        content = loader.render_to_string(template, context, request)
-        content_type = 'application/octet-stream'
-        response = HttpResponse(content, content_type)
-        filename = 'command-report-{}.html'.format(int(time.time()))
-        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-        return response
+        return CommandExporter(self.get_export_params()).get_response(request)
 
-    def get_queryset(self):
+    def get_export_params(self):
         self.get_date_range()
-        self.action = self.request.GET.get('action', '')
-        self.command = self.request.GET.get('command', '')
-        self.user = self.request.GET.get("user", '')
-        self.asset = self.request.GET.get('asset', '')
-        self.system_user = self.request.GET.get('system_user', '')
-        filter_kwargs = dict()
-        filter_kwargs['date_from'] = self.date_from
-        filter_kwargs['date_to'] = self.date_to
-        if self.user:
-            filter_kwargs['user'] = self.user
-        if self.asset:
-            filter_kwargs['asset'] = self.asset
-        if self.system_user:
-            filter_kwargs['system_user'] = self.system_user
-        if self.command:
-            filter_kwargs['input'] = self.command
-        queryset = common_storage.filter(**filter_kwargs)
-        return queryset
+        params = {
+            'date_from': self.date_from.timestamp(),
+            'date_to': self.date_to.timestamp(),
+            'user': self.request.GET.get("user", ''),
+            'asset': self.request.GET.get('asset', ''),
+            'system_user': self.request.GET.get('system_user', ''),
+            'input': self.request.GET.get('command', ''),
+        }
+        return params
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 #
 
-from django.views.generic import ListView
+from django.http import Http404
+from django.views.generic import ListView, View
 from django.views.generic.edit import SingleObjectMixin
 from django.utils.translation import ugettext as _
 from django.utils import timezone
@@ -9,6 +10,7 @@ from django.conf import settings
 
 from common.permissions import AdminUserRequiredMixin
 from common.mixins import DatetimeSearchMixin
+from common.export import CSVExporter
 from ..models import Session, Command, Terminal
 from ..backends import get_multi_command_storage
 from .. import utils
@@ -16,7 +18,7 @@ from .. import utils
 
 __all__ = [
     'SessionOnlineListView', 'SessionOfflineListView',
-    'SessionDetailView',
+    'SessionDetailView', 'SessionExportView',
 ]
 
 command_store = get_multi_command_storage()
@@ -29,6 +31,7 @@ class SessionListView(AdminUserRequiredMixin, DatetimeSearchMixin, ListView):
     paginate_by = settings.DISPLAY_PER_PAGE
     user = asset = system_user = ''
     date_from = date_to = None
+    next_cursor = previous_cursor = None
 
     def get_queryset(self):
         self.queryset = super().get_queryset()
@@ -49,8 +52,31 @@ class SessionListView(AdminUserRequiredMixin, DatetimeSearchMixin, ListView):
             self.queryset = self.queryset.filter(**filter_kwargs)
         return self.queryset
 
+    def paginate_queryset(self, queryset, page_size):
+        """
+        按 (date_start, id) 游标翻页, 不使用 offset 和 count
+        """
+        cursor = self.request.GET.get('cursor')
+        try:
+            sessions, self.next_cursor, self.previous_cursor = \
+                utils.paginate_sessions(queryset, cursor, page_size)
+        except ValueError:
+            raise Http404(_("Invalid cursor"))
+        is_paginated = bool(self.next_cursor or self.previous_cursor)
+        return None, None, sessions, is_paginated
+
+    def get_cursor_url(self, cursor):
+        if not cursor:
+            return None
+        query = self.request.GET.copy()
+        query['cursor'] = cursor
+        query.pop('page', None)
+        return '?' + query.urlencode()
+
     def get_context_data(self, **kwargs):
         context = {
+            'next_url': self.get_cursor_url(self.next_cursor),
+            'previous_url': self.get_cursor_url(self.previous_cursor),
             'user_list': utils.get_session_user_list(),
             'asset_list': utils.get_session_asset_list(),
             'system_user_list': utils.get_session_system_user_list(),
@@ -118,3 +144,63 @@ class SessionDetailView(SingleObjectMixin, AdminUserRequiredMixin, ListView):
         kwargs.update(context)
         return super().get_context_data(**kwargs)
 
+
+class SessionExporter(CSVExporter):
+    """
+    params 中的时间使用时间戳, 方便在后台任务中传递
+    """
+    filename_prefix = 'sessions'
+    select_related = ('terminal',)
+    field_names = [
+        'id', 'user', 'asset', 'system_user', 'remote_addr', 'protocol',
+        'login_from', 'is_finished', 'has_replay', 'has_command',
+        'terminal', 'date_start', 'date_end',
+    ]
+
+    def get_queryset(self):
+        filter_kwargs = {}
+        date_from = utils.parse_date_param(self.params.get('date_from'))
+        date_to = utils.parse_date_param(self.params.get('date_to'))
+        if date_from:
+            filter_kwargs['date_start__gt'] = date_from
+        if date_to:
+            filter_kwargs['date_start__lt'] = date_to
+        for field in ('user', 'asset', 'system_user', 'is_finished'):
+            value = self.params.get(field)
+            if value not in (None, ''):
+                filter_kwargs[field] = value
+        return Session.objects.filter(**filter_kwargs).order_by('-date_start')
+
+    def get_header(self):
+        return [
+            Session._meta.get_field(name).verbose_name
+            for name in self.field_names
+        ]
+
+    def get_row(self, session):
+        data = []
+        for name in self.field_names:
+            value = getattr(session, name)
+            if isinstance(value, timezone.datetime):
+                value = timezone.localtime(value).strftime('%Y-%m-%d %H:%M:%S')
+            data.append(value)
+        return data
+
+
+class SessionExportView(DatetimeSearchMixin, AdminUserRequiredMixin, View):
+    def get(self, request, *args, **kwargs):
+        return SessionExporter(self.get_export_params()).get_response(request)
+
+    def get_export_params(self):
+        self.get_date_range()
+        params = {
+            'date_from': self.date_from.timestamp(),
+            'date_to': self.date_to.timestamp(),
+            'user': self.request.GET.get('user', ''),
+            'asset': self.request.GET.get('asset', ''),
+            'system_user': self.request.GET.get('system_user', ''),
+        }
+        session_type = self.request.GET.get('type')
+        if session_type in ('online', 'offline'):
+            params['is_finished'] = session_type == 'offline'
+        return params
@@ -3,11 +3,12 @@
 
 from django.dispatch import receiver
 from django_auth_ldap.backend import populate_user
-# from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 
 from common.utils import get_logger
+from orgs.counter import users_amount_counter, users_disabled_counter
 from .signals import post_user_create
-# from .models import User
+from .models import User
 
 logger = get_logger(__file__)
 
@@ -22,6 +23,18 @@ logger = get_logger(__file__)
 #             send_user_created_mail(instance)
 
 
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def on_user_changed_expire_counter(sender, instance=None, **kwargs):
+    # 登录等只更新部分字段的保存不影响计数
+    update_fields = kwargs.get('update_fields')
+    if update_fields and 'is_active' not in update_fields:
+        return
+    # 用户可能属于多个组织, 用户变更较少, 直接失效所有组织的计数
+    users_amount_counter.expire_all()
+    users_disabled_counter.expire_all()
+
+
 @receiver(post_user_create)
 def on_user_create(sender, user=None, **kwargs):
     logger.debug("Receive user `{}` create signal".format(user.name))
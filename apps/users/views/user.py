@@ -17,7 +17,6 @@ from django.core.cache import cache
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import redirect
 from django.urls import reverse_lazy, reverse
-from django.utils import timezone
 from django.utils.translation import ugettext as _
 from django.utils.decorators import method_decorator
 from django.views import View
@@ -32,6 +31,7 @@ from django.contrib.auth import logout as auth_logout
 
 from common.const import create_success_msg, update_success_msg
 from common.mixins import JSONResponseMixin
+from common.export import CSVExporter
 from common.utils import get_logger, get_object_or_none, is_uuid, ssh_key_gen
 from common.models import Setting, common_settings
 from common.permissions import AdminUserRequiredMixin
@@ -205,38 +205,41 @@ class UserDetailView(AdminUserRequiredMixin, DetailView):
         return queryset
 
 
-@method_decorator(csrf_exempt, name='dispatch')
-class UserExportView(View):
-    def get(self, request):
-        fields = [
+class UserExporter(CSVExporter):
+    filename_prefix = 'users'
+    prefetch_related = ('groups',)
+
+    def __init__(self, params=None):
+        super().__init__(params)
+        self.fields = [
             User._meta.get_field(name)
             for name in [
                 'id', 'name', 'username', 'email', 'role',
                 'wechat', 'phone', 'is_active', 'comment',
             ]
         ]
-        spm = request.GET.get('spm', '')
-        users_id = cache.get(spm, [])
-        filename = 'users-{}.csv'.format(
-            timezone.localtime(timezone.now()).strftime('%Y-%m-%d_%H-%M-%S')
-        )
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-        response.write(codecs.BOM_UTF8)
-        users = User.objects.filter(id__in=users_id)
-        writer = csv.writer(response, dialect='excel', quoting=csv.QUOTE_MINIMAL)
-
-        header = [field.verbose_name for field in fields]
+
+    def get_queryset(self):
+        return User.objects.filter(id__in=self.params.get('users_id', []))
+
+    def get_header(self):
+        header = [field.verbose_name for field in self.fields]
         header.append(_('User groups'))
-        writer.writerow(header)
+        return header
 
-        for user in users:
-            groups = ','.join([group.name for group in user.groups.all()])
-            data = [getattr(user, field.name) for field in fields]
-            data.append(groups)
-            writer.writerow(data)
+    def get_row(self, user):
+        groups = ','.join([group.name for group in user.groups.all()])
+        data = [getattr(user, field.name) for field in self.fields]
+        data.append(groups)
+        return data
 
-        return response
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UserExportView(View):
+    def get(self, request):
+        spm = request.GET.get('spm', '')
+        users_id = cache.get(spm, [])
+        return UserExporter({'users_id': users_id}).get_response(request)
 
     def post(self, request):
         try:
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+#
+# 对比命令 input 搜索使用 icontains 和 3-gram 索引的耗时
+# 使用前需要开启 COMMAND_INPUT_INDEX_ENABLED, 并等待 build_command_input_index 补建完成
+#
+# python bench_command_search.py "rm -rf" passwd --days 30 --repeat 5
+
+import os
+import sys
+import time
+import argparse
+import django
+
+if os.path.exists('../apps'):
+    sys.path.insert(0, '../apps')
+elif os.path.exists('./apps'):
+    sys.path.insert(0, './apps')
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+from django.conf import settings
+from django.utils import timezone
+
+from orgs.utils import set_to_root_org
+from terminal.backends.command.db import CommandStore
+
+
+def timeit(func, repeat):
+    costs = []
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        costs.append(time.time() - start)
+    return result, min(costs), sum(costs) / len(costs)
+
+
+def bench(store, keyword, date_from, repeat, page_size):
+    def count():
+        return store.count(date_from=date_from, input=keyword)
+
+    def first_page():
+        return list(store.filter(
+            date_from=date_from, input=keyword, limit=page_size
+        ))
+
+    result = {}
+    for name, enabled in (('icontains', False), ('index', True)):
+        settings.COMMAND_INPUT_INDEX_ENABLED = enabled
+        amount, count_min, count_avg = timeit(count, repeat)
+        _, page_min, page_avg = timeit(first_page, repeat)
+        result[name] = (amount, count_min, count_avg, page_min, page_avg)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('keywords', nargs='+')
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--page-size', type=int, default=settings.DISPLAY_PER_PAGE)
+    args = parser.parse_args()
+
+    set_to_root_org()
+    store = CommandStore({})
+    if store.input_index.get_indexed_from() is None:
+        print("Command input index not built, run build_command_input_index first")
+        return
+    date_from = timezone.now() - timezone.timedelta(days=args.days)
+
+    print("{:<20} {:<10} {:>10} {:>12} {:>12} {:>12} {:>12}".format(
+        'keyword', 'path', 'amount', 'count min', 'count avg',
+        'page min', 'page avg',
+    ))
+    for keyword in args.keywords:
+        result = bench(store, keyword, date_from, args.repeat, args.page_size)
+        for name, (amount, count_min, count_avg, page_min, page_avg) in result.items():
+            print("{:<20} {:<10} {:>10} {:>12.4f} {:>12.4f} {:>12.4f} {:>12.4f}".format(
+                keyword, name, amount, count_min, count_avg, page_min, page_avg
+            ))
+
+
+if __name__ == '__main__':
+    main()